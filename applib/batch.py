@@ -0,0 +1,218 @@
+# batch.py
+#
+####################################
+#
+# Run a chart designed in the browser over a whole directory of images,
+# without the browser or the servers:
+#
+#   ./runeffect.py batch chart.json photos/ out/ --processes 8
+#
+# chart.json is the CHART object, as the page's chart editor shows it. Each
+# image in photos/ takes the place of the chart's image (pick one with
+# --image if it has several), and what the chart's end ops output is
+# written to out/ as <name>.<effect>.png (or .json), as each image finishes.
+# --all writes every op's outputs instead.
+#
+# Ops run through jsApply in the same order and with the same args the
+# effect server would use, and complexes make the same JSON round trip, so
+# the outputs match the live view.
+#
+# At the end it prints images/s and how long each op took on average.
+#
+####################################
+
+import os, time
+import multiprocessing
+from glob import glob
+
+from .util import ejson
+from .chartgraph import ChartGraph
+from .uploadstore import IMAGE_EXTS
+from cvlib import INFO, jsApply, cv
+
+# Set up in each pool process by startWorker.
+WORKER = None
+
+# An opcall for every op with all its args filled in, the same as
+# refreshOutputs() in ops.js builds them.
+def chartCalls(chart):
+    graph = ChartGraph()
+    for uuid, op in chart.get('ops', {}).items():
+        opcall = dict(uuid = uuid, effect = op['effect'], args = dict(), dependencies = dict())
+        good = True
+        for arg in op['args']:
+            if arg.get('source') and arg['source'].get('sourceid'):
+                opcall['dependencies'][arg['name']] = arg['source']
+            elif 'value' in arg:
+                opcall['args'][arg['name']] = arg['value']
+            else:
+                good = False
+        if good:
+            graph.ops[uuid] = opcall
+    for uuid, image in chart.get('images', {}).items():
+        graph.images[uuid] = image['path']
+    for uuid, complex in chart.get('complexes', {}).items():
+        graph.complexes[uuid] = complex['json']
+    return graph.ordered()
+
+# Which of the chart's images the input files stand in for.
+def pickImage(chart, wanted):
+    images = chart.get('images', {})
+    if wanted:
+        for uuid, image in images.items():
+            if wanted in (uuid, image.get('name'), image.get('path')):
+                return uuid
+        raise SystemExit(f"No image '{wanted}' in chart.")
+    if len(images) != 1:
+        names = ', '.join(image.get('name', uuid) for uuid, image in images.items())
+        raise SystemExit(f"Chart has {len(images)} images ({names}). Pick one with --image.")
+    return next(iter(images))
+
+# The ops whose outputs get written: ones nothing else reads, unless 'every'.
+# Returns dict(uuid: label) with labels unique enough for filenames.
+def writtenOps(calls, every):
+    read = set(source['sourceid'] for call in calls for source in call.get('dependencies', {}).values())
+    ops = [call for call in calls if call['effect'] != 'saveComplex']
+    if not every:
+        ops = [call for call in ops if call['uuid'] not in read]
+
+    counts = dict()
+    for call in ops:
+        counts[call['effect']] = counts.get(call['effect'], 0) + 1
+    return dict((call['uuid'], call['effect'] if counts[call['effect']] == 1
+                                else f"{call['effect']}-{call['uuid']}") for call in ops)
+
+def readOnly(img):
+    if hasattr(img, 'flags'):
+        img = img.view()
+        img.flags.writeable = False
+    return img
+
+def startWorker(state, threads):
+    global WORKER
+    WORKER = state
+    if threads is not None:
+        cv.setNumThreads(threads)
+
+# Run calls in order, with 'values' holding what they read: (uuid, idx) ->
+# value, and images by uuid alone. Each output lands in values as it's
+# made, and onoutput(call, idx, output, value) hears about it. The time
+# each call took goes in timings, by uuid. Returns an error, or None.
+def runCalls(calls, values, timings, onoutput=None):
+    for call in calls:
+        args = dict(call['args'])
+        for name, source in call.get('dependencies', {}).items():
+            key = source['sourceid'] if source['sourceid'] in values else (source['sourceid'], str(source['idx']))
+            if key not in values:
+                return f"{call['effect']}: a dependency failed"
+            args[name] = values[key]
+
+        start = time.monotonic()
+        try:
+            results = jsApply(call['effect'], args)
+        except Exception as err:
+            return f"{call['effect']}: {err}"
+        timings[call['uuid']] = time.monotonic() - start
+
+        outputs = call['output']
+        pairs = list(zip(outputs, results)) if len(outputs) > 1 else [(outputs[0], results)]
+        for idx, (output, result) in enumerate(pairs):
+            # Complexes reach the next op the way they would from the
+            # effect server: through JSON.
+            if output['cname'] != 'image':
+                result = ejson.loads(ejson.dumps(result))
+            values[(call['uuid'], str(idx))] = readOnly(result)
+            if onoutput:
+                onoutput(call, idx, output, result)
+    return None
+
+# Run the chart over one file, in a pool process. Returns (filename,
+# dict(uuid: seconds), error or None).
+def runFile(filename):
+    stem = os.path.splitext(os.path.basename(filename))[0]
+    timings = dict()
+
+    values = dict()
+    for uuid, path in WORKER['images'].items():
+        img = cv.imread(filename if uuid == WORKER['input'] else f"html/{path}", cv.IMREAD_UNCHANGED)
+        if img is None:
+            return filename, timings, f"Unable to read {filename if uuid == WORKER['input'] else path}"
+        values[uuid] = readOnly(img)
+
+    def write(call, idx, output, result):
+        label = WORKER['written'].get(call['uuid'])
+        if label is None: return
+        suffix = f".{idx}" if len(call['output']) > 1 else ''
+        if output['cname'] == 'image':
+            cv.imwrite(f"{WORKER['outdir']}/{stem}.{label}{suffix}.{WORKER['ext']}", result)
+        else:
+            with open(f"{WORKER['outdir']}/{stem}.{label}{suffix}.json", 'w', encoding='utf-8') as fout:
+                ejson.dump(result, fout)
+
+    return filename, timings, runCalls(WORKER['calls'], values, timings, write)
+
+def addArguments(parser):
+    parser.add_argument('chart', help="Chart JSON, as in the page's chart editor")
+    parser.add_argument('indir', help="Directory of images to run it over")
+    parser.add_argument('outdir', help="Where to write outputs")
+    parser.add_argument('--image', help="Which of the chart's images the inputs replace (name, uuid or path)")
+    parser.add_argument('--all', action='store_true', help="Write every op's outputs, not just the end ones")
+    parser.add_argument('--processes', default=os.cpu_count() or 1, type=int)
+    parser.add_argument('--ext', default='png', help="Image format to write")
+
+def runBatch(args):
+    with open(args.chart, 'r', encoding='utf-8') as fin:
+        chart = ejson.load(fin)
+
+    calls = chartCalls(chart)
+    for call in calls:
+        if call['effect'] not in INFO['effects']:
+            raise SystemExit(f"Unknown effect '{call['effect']}' in chart.")
+        call['output'] = [dict(cname = out['cname'])
+                          for out in ejson.loads(ejson.dumps(INFO['effects'][call['effect']]['output']))]
+
+    files = sorted(f for f in glob(f"{args.indir}/*") if f.lower().endswith(IMAGE_EXTS))
+    if not files:
+        raise SystemExit(f"No images in {args.indir}.")
+    os.makedirs(args.outdir, exist_ok=True)
+
+    state = dict(
+        calls = calls,
+        images = dict((uuid, image['path']) for uuid, image in chart.get('images', {}).items()),
+        input = pickImage(chart, args.image),
+        written = writtenOps(calls, args.all),
+        outdir = args.outdir,
+        ext = args.ext.lstrip('.'),
+    )
+    names = dict((call['uuid'], f"{call['effect']} ({call['uuid']})") for call in calls)
+
+    # A process per core already keeps them all busy; opencv's own threads
+    # on top of that just fight over them.
+    threads = 1 if args.processes > 1 else None
+
+    print(f"Running {len(calls)} ops over {len(files)} images with {args.processes} processes.")
+    totals = dict()
+    failed = 0
+    start = time.monotonic()
+    ctx = multiprocessing.get_context('fork')
+    with ctx.Pool(args.processes, initializer=startWorker, initargs=(state, threads)) as pool:
+        for done, (filename, timings, error) in enumerate(pool.imap_unordered(runFile, files), 1):
+            for uuid, seconds in timings.items():
+                count, total = totals.get(uuid, (0, 0.0))
+                totals[uuid] = (count + 1, total + seconds)
+            if error:
+                failed += 1
+                print(f"{filename}: {error}")
+            if done % 50 == 0 or done == len(files):
+                elapsed = time.monotonic() - start
+                print(f"{done}/{len(files)} images, {done / elapsed:.2f} images/s")
+
+    elapsed = time.monotonic() - start
+    print(f"Done: {len(files) - failed} images in {elapsed:.2f}s ({len(files) / elapsed:.2f} images/s), {failed} failed.")
+    print("Per op (ms per image):")
+    for call in calls:
+        if call['uuid'] in totals:
+            count, total = totals[call['uuid']]
+            print(f"  {names[call['uuid']]:<40} {total * 1000 / count:10.2f}")
+
+    return 1 if failed else 0
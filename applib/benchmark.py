@@ -0,0 +1,206 @@
+# benchmark.py
+#
+####################################
+#
+# Times every registered effect, the way imagegen.py walks them for samples:
+# default args, on the demo image, scaled to a few sizes, in color and in
+# gray. Ops run through jsApply, just as the effect server runs them.
+#
+#   python -m applib.benchmark                      # Table, slowest first.
+#   python -m applib.benchmark --json bench.json    # Save results.
+#   python -m applib.benchmark --compare bench.json # Flag regressions.
+#
+# For each effect, size and color it reports the median and 95th percentile
+# time over --repeat runs (after a warm up), and the peak bytes allocated
+# during a separate, traced run. With --compare, anything whose median got
+# more than --threshold slower than the baseline is listed, and the exit
+# status is 1.
+#
+####################################
+
+import os, sys, time, math, argparse, platform
+import tracemalloc
+import numpy as np
+
+cwd = os.getcwd()
+if cwd not in sys.path:
+    sys.path.append(cwd)
+
+from cvlib import cv, INFO, jsApply
+from applib.util import ejson
+from applib.imagegen import POLY_PTS
+
+DEMO_FILES = ['html/uploads/demo_landscape.png', 'html/uploads/demo_sunset.png']
+
+# Megapixels.
+SIZES = [0.5, 2, 12, 24]
+
+# Effects that need more than an image, like imagegen.py's SPECIAL. Given
+# the input and a second image the same size and color, returns the args.
+# POLY_PTS is drawn for the demo image, so scale it with the input.
+SPECIAL = {
+    'drawPoly': lambda img, other, scale: dict(image = img, poly = [(POLY_PTS * scale).astype(int).tolist()]),
+    'npZeros': lambda img, other, scale: dict(shape = list(img.shape)),
+}
+
+# Not image effects: nothing to time.
+SKIP = ['saveComplex']
+
+# Don't flag regressions smaller than this, however big a fraction they are.
+MIN_REGRESSION_MS = 0.5
+
+# The demo image resized to about 'mp' megapixels. Returns (image, scale).
+def scaledImage(path, mp, gray):
+    img = cv.imread(path)
+    scale = math.sqrt(mp * 1e6 / (img.shape[0] * img.shape[1]))
+    size = (max(1, round(img.shape[1] * scale)), max(1, round(img.shape[0] * scale)))
+    img = cv.resize(img, size, interpolation=cv.INTER_AREA if scale < 1 else cv.INTER_LINEAR)
+    if gray:
+        img = cv.cvtColor(img, cv.COLOR_BGR2GRAY)
+    img.flags.writeable = False
+    return img, scale
+
+# Every image arg gets an image: the first the input, the rest the other.
+def effectArgs(eff, img, other, scale):
+    if eff['name'] in SPECIAL:
+        return SPECIAL[eff['name']](img, other, scale)
+    names = [arg['name'] for arg in eff['args'] if arg.get('cname') == 'image']
+    if not names:
+        return None
+    return dict((name, img if idx == 0 else other) for idx, name in enumerate(names))
+
+def percentile(times, pct):
+    times = sorted(times)
+    return times[min(len(times) - 1, max(0, math.ceil(pct / 100 * len(times)) - 1))]
+
+# One effect on one input: median/p95 ms and peak bytes. 'error' if it fails.
+def benchEffect(name, args, repeat):
+    try:
+        jsApply(name, args)
+    except Exception as err:
+        # opencv's errors run to several lines. The first says what.
+        message = (str(err).strip().splitlines() or [''])[0]
+        return dict(error = f"{type(err).__name__}: {message}")
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        jsApply(name, args)
+        times.append((time.perf_counter() - start) * 1000)
+
+    # Traced separately: tracemalloc slows everything down.
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    result = jsApply(name, args)
+    peak = tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+    del result
+
+    return dict(
+        median_ms = round(percentile(times, 50), 3),
+        p95_ms = round(percentile(times, 95), 3),
+        bytes = peak,
+    )
+
+def runBenchmark(sizes, repeat, effects=None):
+    results = []
+    for mp in sizes:
+        for gray in (False, True):
+            img, scale = scaledImage(DEMO_FILES[0], mp, gray)
+            other, _ = scaledImage(DEMO_FILES[1], mp, gray)
+            other = cv.resize(other, (img.shape[1], img.shape[0]))
+            color = 'gray' if gray else 'color'
+            print(f"{mp} MP {color} ({img.shape[1]}x{img.shape[0]})", file=sys.stderr)
+
+            for eff in INFO['effects'].values():
+                name = eff['name']
+                if name in SKIP or (effects and name not in effects): continue
+                args = effectArgs(eff, img, other, scale)
+                if args is None: continue
+
+                result = dict(effect = name, mp = mp, color = color,
+                              width = img.shape[1], height = img.shape[0], runs = repeat)
+                result.update(benchEffect(name, args, repeat))
+                results.append(result)
+    return results
+
+def resultKey(result):
+    return (result['effect'], result['mp'], result['color'])
+
+def printTable(results):
+    good = sorted((r for r in results if 'error' not in r), key=lambda r: -r['median_ms'])
+    print(f"{'effect':<20} {'MP':>5} {'color':<6} {'median ms':>10} {'p95 ms':>10} {'MB':>9}")
+    for r in good:
+        print(f"{r['effect']:<20} {r['mp']:>5} {r['color']:<6} {r['median_ms']:>10.2f} {r['p95_ms']:>10.2f} {r['bytes'] / 1e6:>9.1f}")
+    for r in results:
+        if 'error' in r:
+            print(f"{r['effect']:<20} {r['mp']:>5} {r['color']:<6} failed: {r['error']}")
+
+# Results whose median is more than 'threshold' (a fraction) slower than in
+# 'baseline'. Returns [(result, baseline result)].
+def regressions(results, baseline, threshold):
+    before = dict((resultKey(r), r) for r in baseline['results'] if 'error' not in r)
+    slower = []
+    for r in results:
+        old = before.get(resultKey(r))
+        if old is None or 'error' in r: continue
+        if r['median_ms'] > old['median_ms'] * (1 + threshold) and \
+                r['median_ms'] - old['median_ms'] >= MIN_REGRESSION_MS:
+            slower.append((r, old))
+    return slower
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='python -m applib.benchmark',
+        description="Time every registered effect at several sizes, in color and gray.",
+    )
+    parser.add_argument('--sizes', nargs='+', type=float, default=SIZES, help="Megapixels")
+    parser.add_argument('--repeat', type=int, default=7, help="Timed runs per effect and size")
+    parser.add_argument('--effects', nargs='+', help="Only these effects")
+    parser.add_argument('--json', help="Write results here")
+    parser.add_argument('--compare', help="Baseline results to flag regressions against")
+    parser.add_argument('--threshold', type=float, default=0.2, help="Fraction slower that counts as a regression")
+    parser.add_argument('--threads', type=int, help="cv.setNumThreads() for the run")
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        cv.setNumThreads(args.threads)
+
+    results = runBenchmark(args.sizes, max(1, args.repeat), args.effects)
+    report = dict(
+        meta = dict(
+            opencv = cv.__version__,
+            numpy = np.__version__,
+            python = platform.python_version(),
+            machine = platform.machine(),
+            cpus = os.cpu_count(),
+            threads = cv.getNumThreads(),
+            repeat = args.repeat,
+            time = time.strftime('%Y-%m-%dT%H:%M:%S'),
+        ),
+        results = results,
+    )
+
+    printTable(results)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as fout:
+            ejson.dump(report, fout, indent=1)
+        print(f"Wrote {args.json}")
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as fin:
+            baseline = ejson.load(fin)
+        slower = regressions(results, baseline, args.threshold)
+        if not slower:
+            print(f"No regressions against {args.compare}.")
+            return 0
+        print(f"{len(slower)} regressions against {args.compare}:")
+        for r, old in slower:
+            print(f"  {r['effect']:<20} {r['mp']:>5} {r['color']:<6} "
+                  f"{old['median_ms']:.2f} -> {r['median_ms']:.2f} ms (+{(r['median_ms'] / old['median_ms'] - 1) * 100:.0f}%)")
+        return 1
+    return 0
+
+if (__name__ == "__main__"):
+    sys.exit(main())
@@ -0,0 +1,157 @@
+# cacheindex.py
+#
+####################################
+#
+# A persistent index of everything in html/cached/: how big each file is,
+# when it was last used, and how long it took to make. Kept in SQLite so the
+# effect server's workers, its reaper, and flask can all share it.
+#
+#   index = CacheIndex(INDEX_FILE, 'html')
+#   index.record('cached/abc.0.npy', cost=0.25)   # Just written.
+#   index.touch('cached/abc.0.npy')               # Just read.
+#   index.count(), index.bytes()                  # O(1), from a totals row.
+#   index.reap(budget)                            # Evict down to budget bytes.
+#
+# Eviction goes cheapest-to-lose first: a file that took little time to make,
+# hasn't been used in a while, and takes up a lot of room goes before one
+# that was expensive, recent, or small.
+#
+####################################
+
+import os, time, sqlite3
+from glob import glob
+from threading import Lock, Thread
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS entries (
+    path  TEXT PRIMARY KEY,
+    bytes INTEGER NOT NULL,
+    atime REAL NOT NULL,
+    cost  REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS totals (
+    id    INTEGER PRIMARY KEY CHECK (id = 0),
+    count INTEGER NOT NULL,
+    bytes INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO totals VALUES (0, 0, 0);
+CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries BEGIN
+    UPDATE totals SET count = count + 1, bytes = bytes + NEW.bytes;
+END;
+CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries BEGIN
+    UPDATE totals SET count = count - 1, bytes = bytes - OLD.bytes;
+END;
+CREATE TRIGGER IF NOT EXISTS entries_update AFTER UPDATE OF bytes ON entries BEGIN
+    UPDATE totals SET bytes = bytes - OLD.bytes + NEW.bytes;
+END;
+'''
+
+# Where runeffect.py and flask both find it.
+INDEX_FILE = '.cacheindex.sqlite'
+
+# Floors so that free-to-make or brand new files don't divide by zero.
+COST_FLOOR = 0.01
+AGE_FLOOR = 60.0
+
+# Only reap down to this fraction of the budget, so we don't reap again the
+# moment the next file gets written.
+REAP_TO = 0.9
+
+class CacheIndex(object):
+    def __init__(self, dbpath, basepath):
+        self.dbpath = dbpath
+        self.basepath = basepath
+        self.lock = Lock()
+        self.db = None
+        self.pid = None
+
+    # Connections don't survive a fork, so each process opens its own.
+    def conn(self):
+        if self.db is None or self.pid != os.getpid():
+            self.db = sqlite3.connect(self.dbpath, timeout=10, check_same_thread=False,
+                                      isolation_level=None)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.executescript(SCHEMA)
+            self.pid = os.getpid()
+        return self.db
+
+    def execute(self, sql, args=()):
+        with self.lock:
+            return self.conn().execute(sql, args).fetchall()
+
+    # 'path' is relative to basepath, e.g: 'cached/abc.0.npy'
+    def record(self, path, cost=0.0):
+        try:
+            size = os.path.getsize(f"{self.basepath}/{path}")
+        except OSError:
+            return
+        self.execute('''INSERT INTO entries VALUES (?, ?, ?, ?)
+                        ON CONFLICT(path) DO UPDATE SET
+                          bytes = excluded.bytes, atime = excluded.atime, cost = excluded.cost''',
+                     (path, size, time.time(), cost))
+
+    def touch(self, path):
+        self.execute('UPDATE entries SET atime = ? WHERE path = ?', (time.time(), path))
+
+    def forget(self, path):
+        self.execute('DELETE FROM entries WHERE path = ?', (path,))
+
+    def count(self):
+        return self.execute('SELECT count FROM totals')[0][0]
+
+    def bytes(self):
+        return self.execute('SELECT bytes FROM totals')[0][0]
+
+    def clear(self):
+        self.execute('DELETE FROM entries')
+
+    # Make the index match what's actually on disk: add files it doesn't
+    # know about (free to make, as far as we know), and drop rows for files
+    # that are gone. Run once at startup.
+    def sync(self, pattern):
+        known = set(row[0] for row in self.execute('SELECT path FROM entries'))
+        ondisk = set(os.path.relpath(f, self.basepath) for f in glob(f"{self.basepath}/{pattern}"))
+        for path in ondisk - known:
+            self.record(path)
+        for path in known - ondisk:
+            self.execute('DELETE FROM entries WHERE path = ?', (path,))
+
+    # Delete files, least worth keeping first, until we're under budget.
+    # Returns how many went.
+    def reap(self, budget):
+        total = self.bytes()
+        if total <= budget:
+            return 0
+
+        now = time.time()
+        victims = self.execute(f'''SELECT path, bytes FROM entries ORDER BY
+                                     (cost + {COST_FLOOR}) / ((? - atime) + {AGE_FLOOR}) / MAX(bytes, 1)''',
+                               (now,))
+        reaped = 0
+        for path, size in victims:
+            if total <= budget * REAP_TO: break
+            try:
+                os.remove(f"{self.basepath}/{path}")
+            except FileNotFoundError:
+                pass
+            except OSError:
+                continue
+            self.execute('DELETE FROM entries WHERE path = ?', (path,))
+            total -= size
+            reaped += 1
+        return reaped
+
+    # A daemon thread that reaps every 'interval' seconds.
+    def startReaper(self, budget, interval=30):
+        def reaper():
+            while True:
+                time.sleep(interval)
+                try:
+                    reaped = self.reap(budget)
+                    if reaped:
+                        print(f"Reaped {reaped} cached files.")
+                except sqlite3.Error as err:
+                    print(f"Cache reaper: {err}")
+        thread = Thread(target=reaper, daemon=True)
+        thread.start()
+        return thread
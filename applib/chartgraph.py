@@ -0,0 +1,266 @@
+# chartgraph.py
+#
+####################################
+#
+# The chart, as the effect server needs to see it, kept in flask per browser
+# session.
+#
+# The page used to rebuild and send every ready op on each change. Now it
+# sends only what changed since last time (a delta), and the session's
+# ChartGraph works out which ops that makes dirty:
+#
+#   chart = ChartGraph()
+#   chart.apply(dict(ops = {uuid: opcall, gone: None}, images = {...}, complexes = {...}))
+#   prepared, dirty = chart.plan()   # [(uuid, jsargs, result)], set(uuids).
+#   chart.finished(uuid, hash)       # Its outputs are up to date.
+#
+# A preview leaves the page showing .preview.png outputs, so the ops it sent
+# go in chart.previewed. The next full run sends them again even if they're
+# done (a drag that ends where it started): the effect server has them
+# cached, and the page gets their full-size outputs back.
+#
+# Hold chart.lock around those: a preview and a full run can overlap.
+#
+# opcalls are shaped just as refreshOutputs() in ops.js builds them. An
+# op's hash covers its args and the hashes of everything upstream, so an op
+# is dirty exactly when its hash isn't the one it last finished with. Change one arg, and that op
+# and everything below it are dirty; the rest of the chart doesn't generate
+# any work at all.
+#
+# Hashes are the cache keys for outputs (cached/<hash>.<idx>.png), so they
+# also cover what the page can't see: given imagekey and codekey, the
+# content of each image the chart reads (not just its path), and the
+# fingerprint of each effect's code. Re-upload a different demo.png, or edit
+# an effect, and the ops that use it get new keys instead of old results;
+# the same image under another name gets the same ones. The page takes the
+# hashes from the reply.
+#
+####################################
+
+import hashlib, math
+from decimal import Decimal
+from threading import Lock
+
+# The same as TYPE in jschart.js.
+TYPE_OP = 'ops'
+TYPE_IMAGE = 'images'
+TYPE_COMPLEX = 'complexes'
+
+# How JS's String(number) writes a number. The page used to make the
+# hashes; this keeps them as they were.
+def jsNumber(num):
+    if isinstance(num, bool):
+        return 'true' if num else 'false'
+    if isinstance(num, int):
+        return str(num)
+    if math.isnan(num): return 'NaN'
+    if math.isinf(num): return 'Infinity' if num > 0 else '-Infinity'
+    if num == 0: return '0'
+    if num < 0: return '-' + jsNumber(-num)
+
+    # Shortest digits that round trip, and where the decimal point goes.
+    sign, digits, exponent = Decimal(repr(num)).normalize().as_tuple()
+    digits = ''.join(map(str, digits))
+    k = len(digits)
+    n = exponent + k
+
+    if k <= n <= 21:
+        return digits + '0' * (n - k)
+    if 0 < n <= 21:
+        return digits[:n] + '.' + digits[n:]
+    if -6 < n <= 0:
+        return '0.' + '0' * -n + digits
+    e = n - 1
+    mantissa = digits if k == 1 else digits[0] + '.' + digits[1:]
+    return f"{mantissa}e{'+' if e >= 0 else '-'}{abs(e)}"
+
+# A hash of obj that doesn't depend on key order: its keys and values, in
+# sorted key order, joined with '.' (numbers as javascript prints them).
+def hashObject(obj):
+    values = []
+    def add(v):
+        if isinstance(v, dict):
+            for k in sorted(v.keys()):
+                add(k)
+                add(v[k])
+        elif isinstance(v, (list, tuple)):
+            for k in sorted(str(i) for i in range(len(v))):
+                add(k)
+                add(v[int(k)])
+        elif v is None:
+            values.append('')
+        elif isinstance(v, (int, float)):
+            values.append(jsNumber(v))
+        else:
+            values.append(str(v))
+    add(obj)
+    return hashlib.md5('.'.join(values).encode('utf-8')).hexdigest()
+
+# What the effect server gets for an op (jsargs), and what the page needs
+# once it's done (result). 'hashes' has the hash (or for
+# images, the path) of everything upstream, by uuid. 'inputs' has a key for
+# the content of each image, and 'code' is the effect's fingerprint: both
+# go in the hash.
+def prepareOpCall(opcall, hashes, preview=False, inputs=None, code=None):
+    imageExt = '.preview.png' if preview else '.png'
+
+    jsargs = dict(
+        effect = opcall['effect'],
+        args = opcall['args'],
+        dependencies = dict(),
+        outputs = [],
+    )
+    if preview:
+        jsargs['preview'] = True
+    if code:
+        jsargs['code'] = code
+
+    for name, source in opcall.get('dependencies', {}).items():
+        if source['cname'].startswith('complex'):
+            jsargs['dependencies'][name] = f"cached/{hashes[source['sourceid']]}.{source['idx']}.json"
+        elif source['sourceid'].startswith('images'):
+            jsargs['dependencies'][name] = hashes[source['sourceid']]
+            if inputs and source['sourceid'] in inputs:
+                jsargs.setdefault('inputs', dict())[name] = inputs[source['sourceid']]
+        else:
+            jsargs['dependencies'][name] = f"cached/{hashes[source['sourceid']]}.{source['idx']}{imageExt}"
+
+    # An image known by its content is hashed by that, not where it is: the
+    # same picture uploaded under two names shares its outputs.
+    keyed = jsargs
+    if 'inputs' in jsargs:
+        keyed = dict(jsargs, dependencies = dict(jsargs['dependencies'], **jsargs['inputs']))
+        del keyed['inputs']
+
+    result = dict(uuid = opcall['uuid'], outputs = [])
+    result['hash'] = hashObject(keyed)
+    jsargs['hash'] = result['hash']
+
+    for idx, output in enumerate(opcall['output']):
+        ret = dict(uuid = opcall['uuid'])
+        if output['cname'] == 'image':
+            ret['path'] = f"cached/{result['hash']}.{idx}{imageExt}"
+            ret['type'] = TYPE_IMAGE
+        else:
+            ret['path'] = f"cached/{result['hash']}.{idx}.json"
+            ret['type'] = TYPE_COMPLEX
+        ret['idx'] = str(idx)
+        result['outputs'].append(ret)
+        jsargs['outputs'].append(ret)
+
+    return jsargs, result
+
+class ChartGraph(object):
+    # present(result), if given, says whether an op's outputs are still on
+    # disk. Ones that were cleared or reaped get run again. imagekey(path)
+    # and codekey(effect), if given, key images by content and effects by
+    # their code.
+    def __init__(self, present=None, imagekey=None, codekey=None):
+        self.present = present
+        self.imagekey = imagekey
+        self.codekey = codekey
+        self.lock = Lock()
+        self.ops = dict()
+        self.images = dict()
+        self.complexes = dict()
+        # uuid: hash, for ops whose outputs are up to date.
+        self.done = dict()
+        # uuids of ops the page was last sent as previews.
+        self.previewed = set()
+
+    # delta is dict(ops, images, complexes), each dict(uuid: value). A value
+    # of None removes it. ops are ready opcalls, images are paths, and
+    # complexes are their json.
+    def apply(self, delta):
+        for name in ('ops', 'images', 'complexes'):
+            table = getattr(self, name)
+            for uuid, value in delta.get(name, {}).items():
+                if value is None:
+                    table.pop(uuid, None)
+                    self.done.pop(uuid, None)
+                    self.previewed.discard(uuid)
+                else:
+                    table[uuid] = value
+
+    # Complexes run as saveComplex ops, just as the page does it.
+    def complexCall(self, uuid):
+        return dict(uuid = uuid, effect = 'saveComplex', type = TYPE_COMPLEX,
+                    args = dict(inp = self.complexes[uuid]), output = [dict(cname = 'complex')])
+
+    # Ops in dependency order, complexes first. Ops that depend on anything
+    # the chart doesn't have are left out, as are those downstream of them.
+    def ordered(self):
+        calls = [self.complexCall(uuid) for uuid in self.complexes]
+        ready = set(self.images) | set(self.complexes)
+        state = dict()
+
+        def visit(uuid):
+            if uuid in ready: return True
+            if uuid not in self.ops or state.get(uuid) == 'visiting': return False
+            if uuid in state: return state[uuid]
+            state[uuid] = 'visiting'
+            ok = all(visit(source['sourceid']) for source in self.ops[uuid].get('dependencies', {}).values())
+            state[uuid] = ok
+            if ok:
+                ready.add(uuid)
+                calls.append(self.ops[uuid])
+            return ok
+
+        for uuid in self.ops:
+            visit(uuid)
+        return calls
+
+    # Returns (prepared, dirty): prepared is [(uuid, jsargs, result)] for
+    # what needs running, in order, and dirty is the uuids of the ops whose
+    # outputs change.
+    #
+    # Full runs are just the dirty ops, and those still shown as previews. A
+    # preview also needs whatever the dirty ops read from upstream at preview
+    # scale; the effect server runs those again too, since the scale it picks
+    # can change between runs.
+    def plan(self, preview=False):
+        inputs = dict((uuid, self.imagekey(path)) for uuid, path in self.images.items()) \
+                 if self.imagekey else None
+        codes = dict()
+        def code(effect):
+            if self.codekey and effect not in codes:
+                codes[effect] = self.codekey(effect)
+            return codes.get(effect)
+
+        hashes = dict(self.images)
+        prepared = []
+        for opcall in self.ordered():
+            jsargs, result = prepareOpCall(opcall, hashes, preview, inputs, code(opcall['effect']))
+            hashes[opcall['uuid']] = result['hash']
+            prepared.append((opcall['uuid'], jsargs, result))
+
+        if not preview:
+            prepared = [call for call in prepared
+                        if call[0] in self.previewed or not self.isDone(call[0], call[2])]
+            return prepared, set(call[0] for call in prepared)
+
+        # Full hashes say what's dirty, even for previews.
+        fullhashes = dict(self.images)
+        dirty = set()
+        for opcall in self.ordered():
+            jsargs, result = prepareOpCall(opcall, fullhashes, False, inputs, code(opcall['effect']))
+            fullhashes[opcall['uuid']] = result['hash']
+            if not self.isDone(opcall['uuid'], result):
+                dirty.add(opcall['uuid'])
+
+        self.previewed |= dirty
+        needed = set(dirty)
+        for uuid, jsargs, result in reversed(prepared):
+            if uuid in needed:
+                call = self.ops.get(uuid)
+                for source in (call or {}).get('dependencies', {}).values():
+                    needed.add(source['sourceid'])
+        return [call for call in prepared if call[0] in needed], dirty
+
+    def isDone(self, uuid, result):
+        if self.done.get(uuid) != result['hash']: return False
+        return self.present is None or self.present(result)
+
+    def finished(self, uuid, hash):
+        self.done[uuid] = hash
+        self.previewed.discard(uuid)
@@ -17,57 +17,450 @@
 # Hence the server-server solution! :-D.
 #
 ####################################
-import os, sys, socket
-import base64
+import os, sys, re, time, hashlib, itertools
 from glob import glob
+from collections import OrderedDict
+from threading import Thread, Lock
 
-from flask import request
+from flask import request, Response, g
 
-from cvlib import INFO, Effects, jsApply
-from .flaskapp import app, ejson
+from .flaskapp import app, ejson, FILE_MAKERS, UPLOAD_HOOKS, Artifact, RENDITION_WIDTHS
 from .util import debug
+from .protocol import EFClient
+from .cacheindex import CacheIndex, INDEX_FILE
+from .events import SessionEvents
+from .chartgraph import ChartGraph
+from .metrics import prometheus
+from .tracing import Tracer, TRACE_HEADER, newSpan, chromeTrace
+from .registry import loadRegistry, effectCode
+from .uploadstore import storeKey, isImage, STORE_DIR
+from .videorelay import VideoRelay, posterVideo, MJPEG_MIMETYPE
 
 EF_BIND = 'localhost'
 EF_PORT = 8839
 EF_RESTART = True
+EF_CLIENT = None
 
-# Launch the runeffect.py fork server. Fire and forget because
+# runeffect.py keeps this up to date. We only read totals from it, and empty
+# it along with html/cached/.
+CACHE_INDEX = CacheIndex(INDEX_FILE, 'html')
+
+# Pushes op results to each browser page.
+EVENTS = SessionEvents()
+
+# Each page's chart, by session; see /cv/chartgen. Only the most recently
+# used are kept. A page whose chart has gone is asked to send it all again.
+# Requests come in on many threads: hold CHARTS_LOCK to touch it.
+CHARTS = OrderedDict()
+CHARTS_LOCK = Lock()
+MAX_CHARTS = 64
+
+# Video streams being watched, by session, then 'op.idx': their relays.
+# Each stream's job is tagged with the next generation, so it supersedes any
+# older stream of the same output, and a cancel with a newer one stops it.
+# Hold VIDEOS_LOCK to change VIDEOS or take a generation, so a cancel never
+# overtakes a newer stream.
+VIDEOS = dict()
+VIDEOS_LOCK = Lock()
+VIDEO_GENERATIONS = itertools.count(1)
+
+# Recent traces, from the page's X-Trace-Id; see applib/tracing.py.
+TRACER = Tracer('flask')
+
+# Launch the runeffect.py worker-pool server. Fire and forget because
 # it'll exit if it's already running, which is no problem.
-def EFLaunchServer(bind, port):
+def EFLaunchServer(bind, port, cachemb=512, workers=4, diskmb=2048):
     global EF_BIND, EF_PORT
 
     EF_BIND = bind
     EF_PORT = port
 
-    os.spawnl(os.P_NOWAIT, './runeffect.py', './runeffect.py', 'detach', bind, f"{port}")
+    os.spawnl(os.P_NOWAIT, './runeffect.py', './runeffect.py', 'detach', bind, f"{port}",
+              f"--cache-mb={cachemb}", f"--workers={workers}", f"--disk-mb={diskmb}")
     os.wait()
 
-# Fetch a JSON object of all known INFO
+# Fetch a JSON object of all known INFO. Read from applib/registry.py's
+# file rather than cvlib, and rebuilt only when cvlib changes.
+EFFECTS_JSON = dict(fingerprint = None, artifact = None)
+
 @app.route('/cv/effects.json', methods=['GET'])
 def getCVEffects():
-    return ejson.loads(ejson.dumps(INFO))
+    text, fingerprint = loadRegistry()
+    if EFFECTS_JSON['fingerprint'] != fingerprint:
+        EFFECTS_JSON.update(fingerprint = fingerprint, artifact = Artifact(text.encode(), 'application/json'))
+    return EFFECTS_JSON['artifact'].response()
 
 # Clear our cache.
 @app.route('/cv/clearCache', methods=['POST'])
 def clearCache():
     for file in glob('html/cached/*'):
         os.remove(file)
+    CACHE_INDEX.clear()
+    return dict(
+        cachesize = CACHE_INDEX.count(),
+    )
+
+# Send a request to runeffect.py over a pooled connection and return its
+# reply: status, success, cached, error, timings and so on. timings for an
+# op are seconds per phase (decode, deps, compute, encode, write; see
+# applib/metrics.py), plus queue, handle and total for the request.
+#
+# onprogress gets any progress runeffect.py sends before its reply.
+#
+# Traced jobs get a span for the round trip, and runeffect.py's own spans
+# are taken out of the reply and kept.
+def EFRequest(job, onprogress=None):
+    global EF_CLIENT
+    if EF_CLIENT is None:
+        EF_CLIENT = EFClient(EF_BIND or 'localhost', EF_PORT)
+    trace = job.get('trace')
+    if not trace:
+        return EF_CLIENT.request(job, onprogress)
+
+    with TRACER.timed(trace, 'effect server'):
+        reply = EF_CLIENT.request(job, onprogress)
+    TRACER.add(trace, reply.pop('spans', []))
+    return reply
+
+# Any request from the page with a trace id gets a span for the whole route.
+@app.before_request
+def startTrace():
+    g.trace = request.headers.get(TRACE_HEADER)
+    g.tracestart = time.time()
+
+@app.after_request
+def endTrace(response):
+    if getattr(g, 'trace', None):
+        TRACER.span(g.trace, f"{request.method} {request.path}", g.tracestart,
+                    status = response.status_code)
+    return response
+
+# Pass the page's trace id on to runeffect.py.
+def traced(job):
+    if getattr(g, 'trace', None):
+        job['trace'] = g.trace
+    return job
+
+# The parts of a runeffect.py reply the browser cares about.
+def replyFields(reply):
     return dict(
-        cachesize = len(glob('html/cached/*')),
+        status = reply.get('status'),
+        success = reply.get('success', 0),
+        cached = reply.get('cached', 0),
+        error = reply.get('error', ''),
+        timings = reply.get('timings', {}),
+        imagecache = reply.get('imagecache'),
     )
 
-# Generate an opencv image, using passed parameters.
-@app.route('/cv/imagegen')
-def generateCVImage():
-    b64input = request.args.get('p')
-    sock = socket.socket()
-    sock.connect((EF_BIND, EF_PORT))
-    bout = bytes(b64input, 'utf-8')
-    sock.send(bout)
-    sock.shutdown(socket.SHUT_WR)
-    ret = str(sock.recv(1), 'utf-8')
+RENDITION_RE = re.compile(r'^(cached/.+)\.w(\d+)\.png$')
+
+# Cached image outputs are stored raw (.npy) by runeffect.py. The .png the
+# browser asks for is only encoded the first time it's actually wanted.
+# Likewise renditions (cached/<hash>.<idx>.w<width>.png), which are resized
+# from the raw output. Only in RENDITION_WIDTHS, or anyone could fill the
+# disk with sizes nobody asked /rendition for.
+def encodeCachedPNG(path):
+    if not (path.startswith('cached/') and path.endswith('.png')):
+        return False
+    m = RENDITION_RE.match(path)
+    if m and int(m[2]) not in RENDITION_WIDTHS:
+        return False
+    if m:
+        job = dict(rendition = path, source = f"{m[1]}.png", width = int(m[2]))
+    else:
+        job = dict(encode = path)
+    return EFRequest(job).get('success', 0)
+
+# Thumbnails of stored uploads (uploads/.store/<md5>.w<width>.png), made
+# from the decoded upload and its pyramid; see applib/uploadstore.py.
+STORE_THUMB_RE = re.compile(r'^' + re.escape(STORE_DIR) + r'/([0-9a-f]{32})\.w(\d+)\.png$')
+
+def renderUploadThumb(path):
+    m = STORE_THUMB_RE.match(path)
+    if not m or int(m[2]) not in RENDITION_WIDTHS:
+        return False
+    job = dict(rendition = path, source = f"{STORE_DIR}/{m[1]}.npy", width = int(m[2]))
+    return EFRequest(job).get('success', 0)
+
+# Decode each new image upload in the effect server, in the background: the
+# page doesn't wait on it, and until it's done reads just decode the file.
+def ingestUpload(path):
+    if not isImage(path):
+        return
+    Thread(target=EFRequest, args=(dict(ingest = path),), daemon=True).start()
+
+UPLOAD_HOOKS.append(ingestUpload)
+
+# Video posters (see applib/videostream.py): the effect server decodes them.
+def makeVideoPoster(path):
+    if posterVideo(path) is None:
+        return False
+    return EFRequest(dict(poster = path)).get('success', 0)
+
+FILE_MAKERS.append(encodeCachedPNG)
+FILE_MAKERS.append(renderUploadThumb)
+FILE_MAKERS.append(makeVideoPoster)
+
+# What's in an image the chart reads, for its cache keys: the md5 of the
+# file, worked out again only when it changes. Files that aren't there (yet)
+# are keyed by path. Uploads in the store are named by theirs already.
+UPLOAD_HASHES = dict()
+
+def uploadKey(path):
+    filename = f"html/{path}"
+    key = storeKey(filename)
+    if key:
+        return key
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return path
+    stamp = (st.st_mtime_ns, st.st_size)
+    known = UPLOAD_HASHES.get(path)
+    if known and known[0] == stamp:
+        return known[1]
+    h = hashlib.md5()
+    with open(filename, 'rb') as fin:
+        for block in iter(lambda: fin.read(1 << 20), b''):
+            h.update(block)
+    UPLOAD_HASHES[path] = (stamp, h.hexdigest())
+    return h.hexdigest()
+
+# Whether an op's outputs are in html/cached/. Images are kept as .npy.
+def outputsPresent(result):
+    for out in result['outputs']:
+        path = f"html/{out['path']}"
+        if not (os.path.exists(re.sub(r'\.png$', '.npy', path)) or os.path.exists(path)):
+            return False
+    return True
+
+# Update a page's chart and run whatever that made dirty. The body is JSON:
+#
+#   {session, generation, preview, stream, reset, delta: {ops, images, complexes}}
+#
+# See applib/chartgraph.py for the delta. reset starts the chart from
+# scratch. The reply has ops: {uuid: result} for every op whose outputs
+# change, shaped like prepareOpCall()'s result, so the page can match them
+# up. Ops that weren't touched aren't in it, and if nothing's dirty nothing
+# is run.
+#
+# Output names are always made here, from the chart: the page never says
+# where anything gets written (they're served as immutable).
+#
+# With preview: {budget: seconds}, the graph runs on inputs scaled down to
+# fit the budget. 'scale' in the reply is what was picked.
+#
+# session and generation are passed along so that a newer refresh from the
+# same page supersedes this one: its status comes back 'superseded'.
+#
+# With stream: true, and the page listening on /cv/events, this returns
+# straight away with status 'accepted'. Each op's outcome is then pushed as
+# an 'op' event as soon as it's done, and a 'graph' event (shaped like the
+# usual reply) says the whole graph is. Both carry the generation.
+#
+# Unless the chart is reset, a session the server doesn't know gets status
+# 'resync'.
+@app.route('/cv/chartgen', methods=['POST'])
+def generateCVChart():
+    body = request.get_json()
+    session = body.get('session')
+    preview = body.get('preview')
+
+    with CHARTS_LOCK:
+        if body.get('reset'):
+            CHARTS[session] = ChartGraph(outputsPresent, uploadKey, effectCode)
+            while len(CHARTS) > MAX_CHARTS:
+                CHARTS.popitem(last=False)
+        chart = CHARTS.get(session)
+        if chart is not None:
+            CHARTS.move_to_end(session)
+    if chart is None:
+        return dict(status = 'resync', success = 0, cached = 0, error = 'Unknown session',
+                    cachesize = CACHE_INDEX.count())
+
+    with chart.lock:
+        chart.apply(body.get('delta', {}))
+        prepared, dirty = chart.plan(bool(preview))
+
+    ops = dict((uuid, result) for uuid, jsargs, result in prepared if uuid in dirty)
+    if not prepared:
+        return dict(status = 'ok', success = 1, cached = 0, error = '', ops = ops,
+                    results = {}, errors = {}, scale = 1.0, cachesize = CACHE_INDEX.count())
+
+    # Full runs that worked bring the chart up to date.
+    def finished(reply):
+        if preview: return
+        results = reply.get('results', {})
+        with chart.lock:
+            for uuid, jsargs, result in prepared:
+                if results.get(result['hash']):
+                    chart.finished(uuid, result['hash'])
 
+    job = traced(dict(graph = [jsargs for uuid, jsargs, result in prepared], preview = preview,
+                      session = session, generation = body.get('generation', 0)))
+
+    if body.get('stream') and EVENTS.listening(session):
+        job['stream'] = True
+        Thread(target=streamGraph, args=(job, finished), daemon=True).start()
+        return dict(status = 'accepted', success = 1, cached = 0, error = '', ops = ops,
+                    cachesize = CACHE_INDEX.count())
+
+    reply = EFRequest(job)
+    finished(reply)
+    return dict(graphReply(reply), ops = ops)
+
+def graphReply(reply):
     return dict(
-        success = int(ret),
-        cachesize = len(glob('html/cached/*')),
+        **replyFields(reply),
+        results = reply.get('results', {}),
+        errors = reply.get('errors', {}),
+        optimings = reply.get('optimings', {}),
+        scale = reply.get('scale', 1.0),
+        cachesize = CACHE_INDEX.count(),
     )
+
+# Run a graph job, pushing its ops to the page as they finish. Ops that
+# never went through a worker (all cached, say) are pushed from the reply.
+# onreply, if given, gets the reply before the page hears it's done.
+def streamGraph(job, onreply=None):
+    session = job['session']
+    generation = job['generation']
+    pushed = set()
+
+    def pushOp(op):
+        pushed.add(op['hash'])
+        EVENTS.push(session, 'op', dict(op, generation = generation))
+
+    reply = EFRequest(job, onprogress=pushOp)
+    cached = reply.get('cached', {})
+    errors = reply.get('errors', {})
+    optimings = reply.get('optimings', {})
+    for hash, success in reply.get('results', {}).items():
+        if hash not in pushed:
+            pushOp(dict(hash = hash, success = success, cached = cached.get(hash, 0),
+                        error = errors.get(hash, ''), timings = optimings.get(hash, {})))
+
+    if onreply:
+        onreply(reply)
+    EVENTS.push(session, 'graph', dict(graphReply(reply), generation = generation))
+
+# The page's event stream; see applib/events.py.
+@app.route('/cv/events')
+def cvEvents():
+    return Response(EVENTS.stream(request.args['session']), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# Play an op's output over the video in the page's chart, as MJPEG: an <img>
+# can show it straight off. ?session=&op=&idx= and the chart is the one
+# /cv/chartgen knows for that session. The chart runs in the effect server,
+# frame by frame; we only pass its JPEGs on. See applib/videorelay.py.
+#
+# The stream stops once the browser lets go of it.
+@app.route('/cv/video.mjpg')
+def cvVideo():
+    session = request.args['session']
+    op = request.args['op']
+    idx = request.args.get('idx', 0, type=int)
+
+    with CHARTS_LOCK:
+        chart = CHARTS.get(session)
+    if chart is None:
+        return dict(status = 'resync', success = 0, error = 'Unknown session'), 404
+    with chart.lock:
+        video = dict(calls = chart.ordered(), images = dict(chart.images), show = op, idx = idx)
+
+    name = f"{op}.{idx}"
+    target = f"{name}.video"
+    relay = VideoRelay()
+    with VIDEOS_LOCK:
+        VIDEOS.setdefault(session, dict())[name] = relay
+        job = dict(video = video, session = session, op = target,
+                   generation = next(VIDEO_GENERATIONS), stream = True)
+    Thread(target=lambda: relay.finish(EFRequest(job, relay.onprogress)), daemon=True).start()
+
+    # Done with, unless a newer stream of the same output has taken over.
+    # Returns the generation to cancel it with, or None.
+    def release():
+        with VIDEOS_LOCK:
+            streams = VIDEOS.get(session, {})
+            if streams.get(name) is not relay:
+                return None
+            del streams[name]
+            if not streams:
+                VIDEOS.pop(session, None)
+            return next(VIDEO_GENERATIONS)
+
+    error = relay.wait()
+    if error:
+        release()
+        return dict(status = 'error', success = 0, error = error), 404
+
+    def frames():
+        try:
+            yield from relay.frames()
+        finally:
+            generation = release()
+            if generation is not None and relay.running:
+                EFRequest(dict(cancel = True, session = session, op = target, generation = generation))
+
+    return Response(frames(), mimetype=MJPEG_MIMETYPE,
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# How the session's video streams are keeping up: sustained fps, frames
+# dropped, ms per stage. By 'op.idx'.
+@app.route('/cv/videostats')
+def cvVideoStats():
+    with VIDEOS_LOCK:
+        streams = dict(VIDEOS.get(request.args['session'], {}))
+    return dict((name, relay.stats()) for name, relay in streams.items())
+
+# Effect server metrics: per-effect phase histograms, requests by kind, the
+# worker pool and the disk cache. JSON, or Prometheus text with
+# ?format=prometheus (or when a scraper asks for text/plain).
+@app.route('/cv/stats')
+def cvStats():
+    reply = EFRequest(dict(stats = True))
+    if not reply.get('success'):
+        return dict(status = 'error', success = 0, error = reply.get('error', '')), 503
+    stats = reply['stats']
+
+    accept = request.headers.get('Accept', '')
+    if request.args.get('format') == 'prometheus' or \
+            (request.args.get('format') != 'json' and ('openmetrics' in accept or accept.startswith('text/plain'))):
+        return Response(prometheus(stats), mimetype='text/plain; version=0.0.4')
+    return stats
+
+# The page's own spans for a trace: {trace, spans: [{name, ts, dur, args}]},
+# times in seconds since the epoch.
+@app.route('/cv/tracespans', methods=['POST'])
+def cvTraceSpans():
+    body = ejson.loads(request.get_data())
+    spans = []
+    for span in body.get('spans', [])[:100]:
+        args = span.get('args', {})
+        if not isinstance(args, dict):
+            return dict(success = 0, error = 'Span args must be an object'), 400
+        # Taken as they are, not as keywords: the page can call an arg anything.
+        made = newSpan(str(span['name']), float(span['ts']), float(span['ts']) + float(span['dur']), 'browser')
+        spans.append(dict(made, args = dict(args), thread = 'page'))
+    TRACER.add(body.get('trace'), spans)
+    return dict(success = 1)
+
+# Recent traces: id, start, duration and span count for each.
+@app.route('/cv/traces')
+def cvTraces():
+    return dict(traces = TRACER.summary())
+
+# Chrome trace-event JSON, for chrome://tracing or ui.perfetto.dev. One
+# trace with ?trace=, or every trace starting with ?prefix= (a page's
+# session, say, for all of its refreshes on one timeline). Everything kept
+# otherwise.
+@app.route('/cv/traces.json')
+def cvTraceExport():
+    trace = request.args.get('trace')
+    if trace:
+        traces = {trace: TRACER.get(trace)}
+    else:
+        traces = TRACER.matching(request.args.get('prefix', ''))
+    return Response(ejson.dumps(chromeTrace(traces)), mimetype='application/json',
+                    headers={'Content-Disposition': 'attachment; filename="trace.json"'})
@@ -0,0 +1,65 @@
+# events.py
+#
+####################################
+#
+# Server-sent event streams from flask to the browser, one per page session.
+#
+# The browser opens /cv/events?session=<id> once (an EventSource) and keeps
+# it open. Anything flask wants to tell that page, e.g: each op finishing
+# in a graph run, is pushed down it, so a whole chart's results share one
+# connection and show up as they happen.
+#
+#   EVENTS = SessionEvents()
+#   return Response(EVENTS.stream(session), mimetype='text/event-stream')
+#   EVENTS.push(session, 'op', dict(hash='abc', success=1))
+#
+# Events for a session nobody's listening to are dropped.
+#
+####################################
+
+from queue import Queue, Empty
+from threading import Lock
+
+from .util import ejson
+
+# Send a comment this often, so proxies and the browser don't give up on a
+# quiet stream.
+KEEPALIVE = 15
+
+class SessionEvents(object):
+    def __init__(self):
+        self.queues = dict()
+        self.lock = Lock()
+
+    def listening(self, session):
+        with self.lock:
+            return session in self.queues
+
+    def push(self, session, kind, data):
+        with self.lock:
+            queue = self.queues.get(session)
+        if queue is not None:
+            queue.put((kind, data))
+
+    # A generator of text/event-stream chunks, for as long as the browser
+    # stays connected. A reconnect replaces the old stream.
+    def stream(self, session):
+        queue = Queue()
+        with self.lock:
+            self.queues[session] = queue
+
+        def events():
+            try:
+                yield 'retry: 1000\n\n'
+                while True:
+                    try:
+                        kind, data = queue.get(timeout=KEEPALIVE)
+                    except Empty:
+                        yield ': keepalive\n\n'
+                        continue
+                    yield f"event: {kind}\ndata: {ejson.dumps(data)}\n\n"
+            finally:
+                with self.lock:
+                    if self.queues.get(session) is queue:
+                        del self.queues[session]
+        return events()
@@ -29,38 +29,179 @@ TEMPLATE_OUT = 'html/index.html'
 #
 ####################################
 
-from flask import Flask, request, redirect, url_for, send_from_directory
-import os, sys, json
+from flask import Flask, request, redirect, url_for, send_from_directory, Response
+from werkzeug.security import safe_join
+import os, re, sys, json, gzip, hashlib, mimetypes
 from glob import glob
+from threading import Lock
 from .util import ejson, buildTemplates
+from .uploadstore import storeUpload, storeKey, isIngested, thumbPath
 
+# No built-in static route: its '/<filename>' rule would shadow
+# static_files() below, which does everything it did and more.
 app = Flask('cvliveserver',
-    static_url_path = '',
-    static_folder   = STATIC_DIR,
+    static_folder   = None,
 )
 
+####################################
+#
+# Artifacts: responses built once and served many times, each with an ETag
+# and a gzipped copy made up front.
+#
+#   artifact = Artifact(html.encode(), 'text/html')
+#   return artifact.response()
+#
+# A browser that already has it (If-None-Match) gets a 304. The browser
+# still asks each time (no-cache), so a rebuilt artifact shows up at once;
+# unless it's given a maxage, for things that never change.
+#
+####################################
+
+class Artifact(object):
+    def __init__(self, data, mimetype):
+        self.data = data
+        self.gzipped = gzip.compress(data, 9, mtime=0)
+        self.etag = hashlib.md5(data).hexdigest()
+        self.mimetype = mimetype
+
+    # The gzipped bytes are a different representation, so they get their
+    # own (strong) ETag.
+    def response(self, maxage=None):
+        gzipped = 'gzip' in request.accept_encodings
+        etag = f"{self.etag}-gz" if gzipped else self.etag
+        if request.if_none_match.contains(etag):
+            resp = Response(status=304)
+        elif gzipped:
+            resp = Response(self.gzipped, mimetype=self.mimetype)
+            resp.headers['Content-Encoding'] = 'gzip'
+        else:
+            resp = Response(self.data, mimetype=self.mimetype)
+        resp.set_etag(etag)
+        if maxage:
+            immutable(resp, maxage)
+        else:
+            resp.headers['Cache-Control'] = 'no-cache'
+        resp.vary.add('Accept-Encoding')
+        return resp
+
+def immutable(resp, maxage):
+    resp.cache_control.no_cache = None
+    resp.cache_control.public = True
+    resp.cache_control.max_age = maxage
+    resp.cache_control.immutable = True
+    return resp
+
 ####################################
 #
 # Routes for stuff not directly related to CV.
 #
 ####################################
 
-# Index.html
-@app.route('/')
-def static_index():
-    indexhtml = buildTemplates(TEMPLATE_BASE, TEMPLATE_DIR)
+# The built index.html, and the templates it was built from.
+INDEX = dict(fingerprint = None, artifact = None)
+INDEX_LOCK = Lock()
 
-    with open(TEMPLATE_OUT, 'w', encoding='utf-8') as fout:
-        fout.write(indexhtml)
+def templateFingerprint():
+    return tuple((path, os.stat(path).st_mtime_ns) for path in sorted(glob(f"{TEMPLATE_DIR}/*.html")))
 
-    return send_from_directory('html', 'index.html')
+# Index.html, rebuilt only when a template changes.
+@app.route('/')
+def static_index():
+    fingerprint = templateFingerprint()
+    with INDEX_LOCK:
+        if INDEX['fingerprint'] != fingerprint:
+            indexhtml = buildTemplates(TEMPLATE_BASE, TEMPLATE_DIR)
+            with open(TEMPLATE_OUT, 'w', encoding='utf-8') as fout:
+                fout.write(indexhtml)
+            INDEX.update(fingerprint = fingerprint, artifact = Artifact(indexhtml.encode(), 'text/html'))
+        artifact = INDEX['artifact']
+
+    return artifact.response()
+
+# Files that don't exist yet, but can be made on request. Other modules add
+# functions here: maker(path) returns True if it created STATIC_DIR/path.
+FILE_MAKERS = []
+
+# Outputs in cached/ are named for the hash of what made them (effect, args
+# and inputs), so what's at one of those paths never changes: browsers can
+# keep them for good without asking again. Not previews, though: how far a
+# preview is scaled down depends on how fast the server is at the time.
+CONTENT_ADDRESSED_RE = re.compile(r'^cached/[0-9a-f]{32}\.\d+(\.w\d+)?\.(png|json)$')
+IMMUTABLE_AGE = 365 * 24 * 3600
+
+# Text is sent gzipped (see Artifact), compressed once per version of the
+# file and kept. Those in cached/ are compressed as they're asked for: with
+# IMMUTABLE_AGE, that's about once each.
+TEXT_EXTS = ('.js', '.css', '.html', '.json', '.svg', '.txt', '.map')
+MAX_TEXT_BYTES = 16 * 1024 * 1024
+TEXT_ARTIFACTS = dict()
+
+# An Artifact of STATIC_DIR/path, or None if it isn't a (reasonably sized)
+# file.
+def textArtifact(path):
+    filename = safe_join(STATIC_DIR, path)
+    try:
+        st = os.stat(filename) if filename else None
+    except OSError:
+        return None
+    if st is None or not os.path.isfile(filename) or st.st_size > MAX_TEXT_BYTES:
+        return None
+
+    key = (st.st_mtime_ns, st.st_size)
+    kept = TEXT_ARTIFACTS.get(path)
+    if kept and kept[0] == key:
+        return kept[1]
+    with open(filename, 'rb') as fin:
+        artifact = Artifact(fin.read(), mimetypes.guess_type(path)[0] or 'text/plain')
+    if not path.startswith('cached/'):
+        TEXT_ARTIFACTS[path] = (key, artifact)
+    return artifact
 
 # Static files, including from uploads.
 @app.route('/<path:path>')
 def static_files(path):
-    return send_from_directory('html', path)
+    if '..' not in path.split('/') and not os.path.exists(os.path.join(STATIC_DIR, path)):
+        for maker in FILE_MAKERS:
+            if maker(path): break
+
+    maxage = IMMUTABLE_AGE if CONTENT_ADDRESSED_RE.match(path) else None
+    if path.endswith(TEXT_EXTS):
+        artifact = textArtifact(path)
+        if artifact:
+            return artifact.response(maxage)
+    resp = send_from_directory('html', path)
+    return immutable(resp, maxage) if maxage else resp
+
+# Resized renditions: /rendition/cached/abc.0.png?w=300 serves
+# cached/abc.0.w320.png, made (once) by whichever FILE_MAKERS knows how.
+# Widths snap up to RENDITION_WIDTHS so there are only a few of each. No w,
+# or wider than the largest, gets the original.
+RENDITION_WIDTHS = [80, 160, 320, 640, 1280]
 
-# Upload files to the server's UPLOAD_DIR
+#
+# Uploads in the store (see applib/uploadstore.py) get theirs there, named by
+# content, once they've been decoded; until then, the original.
+@app.route('/rendition/<path:path>')
+def static_rendition(path):
+    width = request.args.get('w', type=int)
+    if width:
+        width = next((w for w in RENDITION_WIDTHS if w >= width), None)
+    if not width:
+        return static_files(path)
+    if path.startswith('uploads/'):
+        key = storeKey(os.path.join(STATIC_DIR, path))
+        if key is None or not isIngested(STATIC_DIR.rstrip('/'), key):
+            return static_files(path)
+        return static_files(thumbPath(key, width))
+    root, ext = os.path.splitext(path)
+    return static_files(f"{root}.w{width}{ext}")
+
+# Called with each upload's path (as the page knows it) once it's saved.
+# Other modules add functions here.
+UPLOAD_HOOKS = []
+
+# Upload files to the server's UPLOAD_DIR, through the upload store: see
+# applib/uploadstore.py.
 #
 @app.route('/upload', methods=['POST'])
 def uploadFile():
@@ -72,7 +213,10 @@ def uploadFile():
 
     for data in request.files.getlist("file"):
         if data.filename:
-            data.save(os.path.join(UPLOAD_DIR, data.filename))
+            name = os.path.basename(data.filename)
+            storeUpload(STATIC_DIR.rstrip('/'), name, data.stream)
+            for hook in UPLOAD_HOOKS:
+                hook(UPLOAD_TO_PATH(os.path.join(UPLOAD_DIR, name)))
 
     return ejson.dumps("UPLOADED")
 
@@ -0,0 +1,94 @@
+# imagecache.py
+#
+####################################
+#
+# An in-memory LRU cache of decoded images for runeffect.py, so an op that
+# reads its parent's output doesn't have to decode a PNG the parent just
+# encoded.
+#
+# Keyed by path under html/ (e.g: 'cached/<hash>.0.png'). Those are
+# content-addressed, so an entry never goes stale. Uploads are keyed by path
+# and version (see cvread in runeffect.py), so a replaced upload gets a new
+# key rather than the old image. Bounded by the total bytes
+# of the arrays it holds: the least recently used go first.
+#
+#   cache = ImageCache(512 * 1024 * 1024)
+#   cache.put('cached/abc.0.png', img)
+#   img = cache.get('cached/abc.0.png')   # None if it isn't there.
+#
+####################################
+
+from collections import OrderedDict
+from threading import Lock
+
+import numpy as np
+
+class ImageCache(object):
+    def __init__(self, budget):
+        self.budget = budget
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # Only keys that change with what's in the file: content-addressed
+    # outputs, and uploads keyed by version ('<path>@<mtime>:<size>'), since
+    # those can be replaced under the same name. Previews are rewritten under
+    # the same name at a new scale, by whichever worker, so they're out.
+    def cacheable(self, key):
+        if '.preview.' in key:
+            return False
+        return key.startswith('cached/') or '@' in key
+
+    def get(self, key):
+        if not self.cacheable(key): return None
+        with self.lock:
+            img = self.entries.get(key)
+            if img is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return img
+
+    # Cached arrays are shared, so they're made read-only. Anything that
+    # wants to scribble on one has to copy it first.
+    def put(self, key, img):
+        if not isinstance(img, np.ndarray): return
+        if not self.cacheable(key): return
+        if img.nbytes > self.budget: return
+
+        img = img.view()
+        img.flags.writeable = False
+
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old.nbytes
+
+            self.entries[key] = img
+            self.size += img.nbytes
+
+            while self.size > self.budget:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= evicted.nbytes
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            return dict(
+                entries = len(self.entries),
+                bytes = self.size,
+                budget = self.budget,
+                hits = self.hits,
+                misses = self.misses,
+                evictions = self.evictions,
+            )
@@ -7,26 +7,37 @@
 # Samples are generated from html/effimages/demo.png. You are welcome to create
 # your own samples, just plop it there and run this script.
 #
+# Only effects that changed since their sample was made are run again: each
+# sample's fingerprint (the effect's source, its INFO entry with the default
+# args, and the demo images) is kept in FINGERPRINT_FILE, with whether it
+# failed. The stale ones are spread over a pool of processes.
+#
+#   python -m applib.imagegen               # Just what's out of date.
+#   python -m applib.imagegen --all         # Every sample.
+#
+# liveserver.py runs it in the background once the server is up.
+#
 ####################################
 
-import os, sys
+import os, sys, time, inspect, hashlib, argparse
+import multiprocessing
 import numpy as np
 
 cwd = os.getcwd()
 if cwd not in sys.path:
     sys.path.append(cwd)
 
-from cvlib import EF, cv, INFO, Effects
+from cvlib import EF, cv, INFO
+from applib.util import ejson
 
 EFFECT_IMAGE_DIR="html/samples/"
+FINGERPRINT_FILE = f"{EFFECT_IMAGE_DIR}/.fingerprints.json"
 
-DEMO_FILES = [
-    cv.imread('html/uploads/demo_landscape.png'),
-    cv.imread('html/uploads/demo_sunset.png'),
-]
+DEMO_PATHS = ['html/uploads/demo_landscape.png', 'html/uploads/demo_sunset.png']
+DEMO_FILES = [cv.imread(path) for path in DEMO_PATHS]
 
-POLY_PTS = np.array([[250, 700], [250, 900], 
-                [800, 200], [200, 1300], 
+POLY_PTS = np.array([[250, 700], [250, 900],
+                [800, 200], [200, 1300],
                 [200, 700], [1000, 200]])
 
 def defaultCall(name, img):
@@ -38,36 +49,113 @@ SPECIAL = {
     'cutPoly': lambda use: EF.apply(use, EF.cutPoly([POLY_PTS], [255, 255, 255])),
 }
 
-# Read first demo image as colored, add a grayscale version, then go through
-# every Effect, passing it either image as needed.
-#
-# We have a second demo image for when we need two (merge/blend/etc).
-def rebuildEffectImages():
-    colored = DEMO_FILES[0]
-    grayed = EF.apply(colored,
-        EF.grayscale()
-    )
+def sourceOf(obj):
+    try:
+        return inspect.getsource(obj)
+    except (OSError, TypeError):
+        return ''
+
+# What every sample depends on: the demo images, and how they're labelled.
+def commonFingerprint():
+    h = hashlib.md5()
+    for path in DEMO_PATHS:
+        st = os.stat(path)
+        h.update(f"{path}:{st.st_mtime_ns}:{st.st_size}\n".encode())
+    h.update(INFO['effects']['writeOn']['fingerprint'].encode())
+    return h.hexdigest()
+
+# Changes when the effect's code, args or defaults do. Its INFO entry has
+# all three: register() fingerprints the code.
+def effectFingerprint(eff, common):
+    name = eff['name']
+    h = hashlib.md5(common.encode())
+    h.update(ejson.dumps(eff, sort_keys=True).encode())
+    if name in SPECIAL:
+        h.update(sourceOf(SPECIAL[name]).encode())
+    return h.hexdigest()
+
+def loadFingerprints():
+    try:
+        with open(FINGERPRINT_FILE, 'r', encoding='utf-8') as fin:
+            return ejson.load(fin)
+    except (OSError, ValueError):
+        return dict()
 
-    print("Loaded...")
+def saveFingerprints(fingerprints):
+    with open(f"{FINGERPRINT_FILE}.tmp", 'w', encoding='utf-8') as fout:
+        ejson.dump(fingerprints, fout, indent=1, sort_keys=True)
+    os.replace(f"{FINGERPRINT_FILE}.tmp", FINGERPRINT_FILE)
+
+# dict(name: fingerprint) of effects whose sample is missing or out of date.
+# FINGERPRINT_FILE has dict(name: dict(fingerprint, failed)).
+def staleEffects(every=False):
+    common = commonFingerprint()
+    old = loadFingerprints()
+    stale = dict()
     for eff in INFO['effects'].values():
         name = eff['name']
-        filename = f"{EFFECT_IMAGE_DIR}/{name}.png"
+        fingerprint = effectFingerprint(eff, common)
+        made = old.get(name, dict())
+        if every or made.get('fingerprint') != fingerprint or \
+                (not made.get('failed') and not os.path.exists(f"{EFFECT_IMAGE_DIR}/{name}.png")):
+            stale[name] = fingerprint
+    return stale
 
-        use = colored
+# Render one sample, in a pool process. Returns (name, error or None).
+def renderSample(name):
+    filename = f"{EFFECT_IMAGE_DIR}/{name}.png"
+    use = DEMO_FILES[0]
+    try:
+        if name in SPECIAL:
+            img = SPECIAL[name](use)
+        else:
+            img = defaultCall(name, use)
 
-        try:
-            if name in SPECIAL:
-                img = SPECIAL[name](use)
-            else:
-                img = defaultCall(name, use)
+        img = EF.apply(img, EF.writeOn(name, ypct=0.3))
 
-            img = EF.apply(img, EF.writeOn(name, ypct=0.3))
+        cv.imwrite(filename, img)
+        return name, None
+    except Exception as err:
+        return name, str(err)
 
-            cv.imwrite(filename, img)
-            print(f"{name}: {filename} written")
-        except Exception as err:
-            print(f"{name}: {filename} failed:")
-            print(err)
+# Go through every Effect that's changed since its sample was made, and run
+# it on the first demo image.
+#
+# We have a second demo image for when we need two (merge/blend/etc).
+#
+# Failures are remembered too, so an effect that can't make a sample from
+# its defaults isn't retried until it changes.
+def rebuildEffectImages(every=False, processes=None):
+    stale = staleEffects(every)
+    if not stale:
+        print("Samples up to date.")
+        return
+
+    fingerprints = loadFingerprints()
+    start = time.monotonic()
+    print(f"Generating {len(stale)} samples...")
+    ctx = multiprocessing.get_context('fork')
+    with ctx.Pool(processes or os.cpu_count() or 1) as pool:
+        for name, error in pool.imap_unordered(renderSample, sorted(stale)):
+            if error:
+                print(f"{name}: {EFFECT_IMAGE_DIR}/{name}.png failed:")
+                print(error)
+            else:
+                print(f"{name}: {EFFECT_IMAGE_DIR}/{name}.png written")
+            fingerprints[name] = dict(fingerprint = stale[name], failed = bool(error))
+
+    # Forget effects that are gone.
+    fingerprints = dict((name, fingerprint) for name, fingerprint in fingerprints.items()
+                        if name in INFO['effects'])
+    saveFingerprints(fingerprints)
+    print(f"Generated {len(stale)} samples in {time.monotonic() - start:.2f}s.")
 
 if (__name__ == "__main__"):
-    rebuildEffectImages()
+    parser = argparse.ArgumentParser(
+        prog='python -m applib.imagegen',
+        description="Make sample images for effects whose code or defaults changed.",
+    )
+    parser.add_argument('--all', action='store_true', help="Remake every sample")
+    parser.add_argument('--processes', type=int, help="Pool size (default: a process per core)")
+    args = parser.parse_args()
+    rebuildEffectImages(args.all, args.processes)
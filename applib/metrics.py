@@ -0,0 +1,172 @@
+# metrics.py
+#
+####################################
+#
+# Where the effect server's time goes, kept in the server process.
+#
+# Every op a worker runs comes back with how long it spent in each phase:
+#
+#   decode:  reading JSON (complex) dependencies
+#   deps:    loading image dependencies (memory, mmapped .npy or disk)
+#   compute: the effect itself
+#   encode:  turning outputs into bytes (JSON, or images not kept raw)
+#   write:   writing them to html/cached/
+#
+# and those go into a histogram per effect and phase. Requests as a whole
+# are counted by kind, and whether they were answered from cache.
+#
+#   METRICS = Metrics()
+#   METRICS.effect('blurMedian', dict(compute=0.012, write=0.003, ...))
+#   METRICS.request('op', 0.02, cached=False)
+#   stats = METRICS.snapshot()      # Plain dicts, for JSON.
+#   text = prometheus(stats)         # Prometheus text format.
+#
+####################################
+
+import time
+from bisect import bisect_left
+from threading import Lock
+
+PHASES = ('decode', 'deps', 'compute', 'encode', 'write')
+
+# Upper bounds, in seconds. Anything slower lands in +Inf.
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+PREFIX = 'cvlive'
+
+def newPhases():
+    return dict((phase, 0.0) for phase in PHASES)
+
+class Histogram(object):
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(self.buckets, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    # An estimate from the buckets: the bound of the one 'pct' falls in.
+    def quantile(self, pct):
+        if not self.count: return 0.0
+        wanted = pct / 100 * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= wanted:
+                return bound
+        return float('inf')
+
+    # buckets is [[upper bound, how many at or under it]], Prometheus style.
+    def toDict(self):
+        cumulative = []
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            cumulative.append([bound, seen])
+        cumulative.append(['+Inf', self.count])
+        return dict(
+            count = self.count,
+            sum = round(self.sum, 6),
+            mean = round(self.sum / self.count, 6) if self.count else 0.0,
+            p50 = self.quantile(50),
+            p95 = self.quantile(95),
+            buckets = cumulative,
+        )
+
+class Metrics(object):
+    def __init__(self):
+        self.lock = Lock()
+        self.started = time.time()
+        # effect: phase: Histogram
+        self.effects = dict()
+        # kind: Histogram, and kind: count answered from cache.
+        self.requests = dict()
+        self.cached = dict()
+
+    def effect(self, name, phases):
+        with self.lock:
+            hists = self.effects.get(name)
+            if hists is None:
+                hists = self.effects[name] = dict((phase, Histogram()) for phase in PHASES)
+            for phase, seconds in phases.items():
+                if phase in hists:
+                    hists[phase].observe(seconds)
+
+    def request(self, kind, seconds, cached=False):
+        with self.lock:
+            if kind not in self.requests:
+                self.requests[kind] = Histogram()
+                self.cached[kind] = 0
+            self.requests[kind].observe(seconds)
+            if cached:
+                self.cached[kind] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return dict(
+                uptime = round(time.time() - self.started, 1),
+                effects = dict((name, dict((phase, hist.toDict()) for phase, hist in hists.items()))
+                               for name, hists in self.effects.items()),
+                requests = dict((kind, dict(hist.toDict(), cached = self.cached[kind]))
+                                for kind, hist in self.requests.items()),
+            )
+
+def labels(**kwargs):
+    return '{' + ','.join(f'{k}="{v}"' for k, v in kwargs.items()) + '}'
+
+def histogramLines(name, hist, **kwargs):
+    lines = []
+    for bound, count in hist['buckets']:
+        lines.append(f"{name}_bucket{labels(**kwargs, le=bound)} {count}")
+    lines.append(f"{name}_sum{labels(**kwargs)} {hist['sum']}")
+    lines.append(f"{name}_count{labels(**kwargs)} {hist['count']}")
+    return lines
+
+# 'stats' is a snapshot(), plus optionally pool (WorkerPool.stats()) and
+# cache (files, bytes).
+def prometheus(stats):
+    lines = [
+        f"# HELP {PREFIX}_effect_phase_seconds Time spent in each phase of running an effect.",
+        f"# TYPE {PREFIX}_effect_phase_seconds histogram",
+    ]
+    for name, phases in sorted(stats.get('effects', {}).items()):
+        for phase, hist in phases.items():
+            lines += histogramLines(f"{PREFIX}_effect_phase_seconds", hist, effect=name, phase=phase)
+
+    lines += [
+        f"# HELP {PREFIX}_request_seconds Time to answer a request to the effect server.",
+        f"# TYPE {PREFIX}_request_seconds histogram",
+    ]
+    for kind, hist in sorted(stats.get('requests', {}).items()):
+        lines += histogramLines(f"{PREFIX}_request_seconds", hist, kind=kind)
+
+    lines += [
+        f"# HELP {PREFIX}_requests_cached_total Requests answered from cache.",
+        f"# TYPE {PREFIX}_requests_cached_total counter",
+    ]
+    for kind, hist in sorted(stats.get('requests', {}).items()):
+        lines.append(f"{PREFIX}_requests_cached_total{labels(kind=kind)} {hist['cached']}")
+
+    gauges = dict(
+        workers = ('pool', 'workers', "Worker processes."),
+        workers_busy = ('pool', 'busy', "Workers running a job."),
+        jobs_queued = ('pool', 'queued', "Jobs waiting for a worker."),
+        cores = ('pool', 'cores', "Cores the workers' jobs share."),
+        cores_allocated = ('pool', 'allocated', "Threads granted to running jobs."),
+        cache_files = ('cache', 'files', "Files in html/cached/."),
+        cache_bytes = ('cache', 'bytes', "Bytes in html/cached/."),
+    )
+    for name, (section, key, help) in gauges.items():
+        if key in stats.get(section, {}):
+            lines += [f"# HELP {PREFIX}_{name} {help}", f"# TYPE {PREFIX}_{name} gauge",
+                      f"{PREFIX}_{name} {stats[section][key]}"]
+    if 'cancelled' in stats.get('pool', {}):
+        lines += [f"# HELP {PREFIX}_jobs_superseded_total Jobs dropped or stopped for newer ones.",
+                  f"# TYPE {PREFIX}_jobs_superseded_total counter",
+                  f"{PREFIX}_jobs_superseded_total {stats['pool']['cancelled']}"]
+
+    return '\n'.join(lines) + '\n'
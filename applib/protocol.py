@@ -0,0 +1,175 @@
+# protocol.py
+#
+####################################
+#
+# How flask and runeffect.py talk to each other.
+#
+# Everything goes over long-lived TCP connections as frames:
+#
+#   [4 bytes: header length][4 bytes: blob length][JSON header][blob]
+#
+# Lengths are big-endian. The blob is raw bytes and is usually empty.
+#
+# Requests are {id, job} where job is what used to be the whole request
+# (an op call, or {graph: [...]}). Replies carry the same id, so one
+# connection can have many requests in flight and they can come back in any
+# order. A reply looks like:
+#
+#   {id, status: 'ok' or 'error', success, cached, error, timings, ...}
+#
+# Before its reply, a request may get any number of {id, progress: {...}}
+# frames, e.g: one per op as a graph runs. Those go to the onprogress
+# callback the request was made with. A progress frame's blob (e.g: a video
+# frame's JPEG) is passed along as progress['blob'].
+#
+# EFClient is the flask side: a small pool of connections, each with a
+# reader thread that hands replies back to whoever is waiting on them.
+#
+#   client = EFClient('localhost', 8839)
+#   reply = client.request(dict(effect='invert', ...))
+#   reply = client.request(dict(graph=[...], stream=True), onprogress=print)
+#
+####################################
+
+import socket, struct
+from threading import Thread, Lock, Event
+
+from .util import ejson
+
+FRAME_HEAD = struct.Struct('>II')
+
+def recvExactly(sock, count):
+    chunks = []
+    while count > 0:
+        chunk = sock.recv(min(count, 1 << 20))
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        count -= len(chunk)
+    return b''.join(chunks)
+
+def sendFrame(sock, header, blob=b''):
+    body = bytes(ejson.dumps(header), 'utf-8')
+    sock.sendall(FRAME_HEAD.pack(len(body), len(blob)) + body + blob)
+
+# Returns (header, blob), or None once the other end hangs up.
+def recvFrame(sock):
+    head = recvExactly(sock, FRAME_HEAD.size)
+    if head is None:
+        return None
+    hlen, blen = FRAME_HEAD.unpack(head)
+    body = recvExactly(sock, hlen)
+    blob = recvExactly(sock, blen) if blen else b''
+    if body is None or blob is None:
+        return None
+    return ejson.loads(body), blob
+
+# What a request gets when the connection dies underneath it.
+def errorReply(msg):
+    return dict(status = 'error', success = 0, cached = 0, error = msg, timings = {})
+
+####################################
+#
+# Flask side.
+#
+####################################
+
+class Pending(object):
+    def __init__(self, onprogress=None):
+        self.onprogress = onprogress
+        self.reply = None
+        self.done = Event()
+
+class EFConnection(object):
+    def __init__(self, bind, port):
+        self.sock = socket.create_connection((bind, port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.wlock = Lock()
+        self.plock = Lock()
+        self.pending = dict()
+        self.nextid = 0
+        self.alive = True
+
+        self.reader = Thread(target=self.readReplies, daemon=True)
+        self.reader.start()
+
+    def readReplies(self):
+        try:
+            while True:
+                frame = recvFrame(self.sock)
+                if frame is None: break
+                header, blob = frame
+                if 'progress' in header:
+                    with self.plock:
+                        waiting = self.pending.get(header.get('id'))
+                    if waiting and waiting.onprogress:
+                        waiting.onprogress(dict(header['progress'], blob = blob) if blob
+                                           else header['progress'])
+                    continue
+                with self.plock:
+                    waiting = self.pending.pop(header.get('id'), None)
+                if waiting:
+                    waiting.reply = header
+                    waiting.done.set()
+        except OSError:
+            pass
+        self.close()
+
+    # Fail everything still waiting: the server went away (usually a
+    # restart because a file changed).
+    def close(self):
+        self.alive = False
+        try: self.sock.close()
+        except OSError: pass
+        with self.plock:
+            waiting, self.pending = self.pending, dict()
+        for pend in waiting.values():
+            pend.reply = errorReply("Lost connection to effect server")
+            pend.done.set()
+
+    def inflight(self):
+        return len(self.pending)
+
+    # Raises OSError if the request couldn't be sent at all.
+    def request(self, job, onprogress=None):
+        pend = Pending(onprogress)
+        with self.plock:
+            self.nextid += 1
+            reqid = self.nextid
+            self.pending[reqid] = pend
+        try:
+            with self.wlock:
+                sendFrame(self.sock, dict(id = reqid, job = job))
+        except OSError:
+            with self.plock:
+                self.pending.pop(reqid, None)
+            self.close()
+            raise
+        pend.done.wait()
+        return pend.reply
+
+class EFClient(object):
+    def __init__(self, bind, port, size=2):
+        self.bind = bind
+        self.port = port
+        self.size = size
+        self.conns = [None] * size
+        self.lock = Lock()
+
+    # The least busy live connection, (re)connecting as needed.
+    def connection(self):
+        with self.lock:
+            for idx, conn in enumerate(self.conns):
+                if conn is None or not conn.alive:
+                    self.conns[idx] = EFConnection(self.bind, self.port)
+            return min(self.conns, key=lambda c: c.inflight())
+
+    # A pooled connection can have gone stale since its last use, so a
+    # failed send gets one retry on a fresh one.
+    def request(self, job, onprogress=None):
+        for attempt in range(2):
+            try:
+                return self.connection().request(job, onprogress)
+            except OSError as err:
+                failure = err
+        return errorReply(f"Unable to reach effect server: {failure}")
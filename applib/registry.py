@@ -0,0 +1,92 @@
+# registry.py
+#
+####################################
+#
+# The effect registry's metadata (cvlib's INFO), without loading opencv.
+#
+# The flask front end only ever needs INFO as JSON, for /cv/effects.json.
+# Importing cvlib for that means importing cv2 and every effect module, so
+# instead it's written out once to REGISTRY_FILE, along with a fingerprint
+# of cvlib's sources, and read back from there:
+#
+#   text, fingerprint = loadRegistry()   # INFO as JSON text.
+#   effectCode('blurMedian')             # Its code fingerprint.
+#
+# If cvlib has changed since (or there's no file yet), it's rebuilt by
+# running this module in a separate process, which is the only place cvlib
+# gets imported:
+#
+#   python -m applib.registry
+#
+####################################
+
+import os, sys, hashlib, subprocess
+from glob import glob
+from threading import Lock
+
+cwd = os.getcwd()
+if cwd not in sys.path:
+    sys.path.append(cwd)
+
+from applib.util import ejson
+
+REGISTRY_FILE = '.effects.json'
+SOURCES = 'cvlib/*.py'
+
+# What's been read, so a request only costs a stat() of each source.
+CACHED = dict(fingerprint = None, text = None, info = None)
+LOCK = Lock()
+
+# Changes whenever any of cvlib's files do.
+def sourceFingerprint():
+    h = hashlib.md5()
+    for path in sorted(glob(SOURCES)):
+        st = os.stat(path)
+        h.update(f"{path}:{st.st_mtime_ns}:{st.st_size}\n".encode())
+    return h.hexdigest()
+
+# Needs cvlib. Run in its own process by loadRegistry().
+def writeRegistry():
+    fingerprint = sourceFingerprint()
+    from cvlib import INFO
+    data = dict(fingerprint = fingerprint, info = ejson.dumps(INFO))
+    with open(f"{REGISTRY_FILE}.tmp", 'w', encoding='utf-8') as fout:
+        ejson.dump(data, fout)
+    os.replace(f"{REGISTRY_FILE}.tmp", REGISTRY_FILE)
+
+def readRegistry():
+    try:
+        with open(REGISTRY_FILE, 'r', encoding='utf-8') as fin:
+            return ejson.load(fin)
+    except (OSError, ValueError):
+        return dict()
+
+# Returns (INFO as JSON text, fingerprint), rebuilding REGISTRY_FILE first
+# if it's out of date.
+def loadRegistry():
+    fingerprint = sourceFingerprint()
+    with LOCK:
+        if CACHED['fingerprint'] != fingerprint:
+            data = readRegistry()
+            if data.get('fingerprint') != fingerprint:
+                print("Rebuilding effect registry")
+                subprocess.run([sys.executable, '-m', 'applib.registry'], check=True)
+                data = readRegistry()
+            CACHED.update(fingerprint = data['fingerprint'], text = data['info'], info = None)
+        return CACHED['text'], CACHED['fingerprint']
+
+# INFO itself, parsed once per version.
+def loadInfo():
+    loadRegistry()
+    with LOCK:
+        if CACHED['info'] is None:
+            CACHED['info'] = ejson.loads(CACHED['text'])
+        return CACHED['info']
+
+# The fingerprint register() took of an effect's code (see cvlib/effects.py),
+# or '' if there's no such effect.
+def effectCode(name):
+    return loadInfo()['effects'].get(name, {}).get('fingerprint', '')
+
+if (__name__ == "__main__"):
+    writeRegistry()
@@ -0,0 +1,133 @@
+# tracing.py
+#
+####################################
+#
+# Where a request's time goes, from the browser to the worker and back.
+#
+# The page tags each request with a trace id (the X-Trace-Id header: one per
+# op update, or per chart refresh). Flask passes it on to runeffect.py in the
+# job as 'trace', and each stage records spans under it:
+#
+#   browser    the whole fetch, as the page saw it
+#   flask      the route, and the round trip to the effect server
+#   runeffect  the request in the server process: cache check, queue
+#   worker     handling it: each op's deps, compute, encode and write
+#
+# runeffect.py's spans come back in the reply, the browser's are posted to
+# /cv/tracespans. Flask keeps the last MAX_TRACES traces, and exports them
+# as Chrome trace-event JSON, to load in chrome://tracing or Perfetto:
+#
+#   TRACER = Tracer()
+#   with TRACER.timed(trace, 'effect server'):
+#       ...
+#   TRACER.add(trace, reply.pop('spans', []))
+#   chromeTrace(TRACER.get(trace))
+#
+# Times are wall clock seconds (time.time()), so spans from every process
+# line up on the same machine.
+#
+####################################
+
+import time
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+TRACE_HEADER = 'X-Trace-Id'
+MAX_TRACES = 200
+
+def newSpan(name, start, end, process, cat='', **args):
+    return dict(
+        name = name,
+        cat = cat or process,
+        process = process,
+        thread = threading.current_thread().name,
+        ts = start,
+        dur = max(0.0, end - start),
+        args = args,
+    )
+
+class Tracer(object):
+    def __init__(self, process='flask', maxtraces=MAX_TRACES):
+        self.process = process
+        self.maxtraces = maxtraces
+        self.lock = threading.Lock()
+        self.traces = OrderedDict()
+
+    def add(self, trace, spans):
+        if not trace or not spans: return
+        with self.lock:
+            if trace not in self.traces:
+                self.traces[trace] = []
+                while len(self.traces) > self.maxtraces:
+                    self.traces.popitem(last=False)
+            self.traces[trace].extend(spans)
+
+    def span(self, trace, name, start, end=None, **args):
+        if not trace: return
+        self.add(trace, [newSpan(name, start, end or time.time(), self.process, **args)])
+
+    @contextmanager
+    def timed(self, trace, name, **args):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.span(trace, name, start, **args)
+
+    def get(self, trace):
+        with self.lock:
+            return list(self.traces.get(trace, []))
+
+    # Traces whose id starts with 'prefix' (e.g: a page's session), oldest
+    # first, as dict(id: spans).
+    def matching(self, prefix=''):
+        with self.lock:
+            return OrderedDict((trace, list(spans)) for trace, spans in self.traces.items()
+                               if trace.startswith(prefix))
+
+    # A line per trace: when, how long, and how many spans.
+    def summary(self):
+        with self.lock:
+            traces = list(self.traces.items())
+        rows = []
+        for trace, spans in traces:
+            start = min(span['ts'] for span in spans)
+            end = max(span['ts'] + span['dur'] for span in spans)
+            rows.append(dict(trace = trace, start = start, duration = round(end - start, 6),
+                             spans = len(spans)))
+        return rows
+
+# Chrome's trace-event format: complete ('X') events, in microseconds from
+# the earliest span, with a track per process and thread. 'traces' is
+# dict(id: spans); each span is tagged with its trace id.
+def chromeTrace(traces):
+    spans = [(trace, span) for trace, tspans in traces.items() for span in tspans]
+    if not spans:
+        return dict(traceEvents = [], displayTimeUnit = 'ms')
+    origin = min(span['ts'] for trace, span in spans)
+
+    pids, tids = dict(), dict()
+    events = []
+    for trace, span in sorted(spans, key=lambda pair: pair[1]['ts']):
+        if span['process'] not in pids:
+            pids[span['process']] = len(pids) + 1
+            events.append(dict(name = 'process_name', ph = 'M', pid = pids[span['process']],
+                               args = dict(name = span['process'])))
+        thread = (span['process'], span['thread'])
+        if thread not in tids:
+            tids[thread] = len(tids) + 1
+            events.append(dict(name = 'thread_name', ph = 'M', pid = pids[span['process']],
+                               tid = tids[thread], args = dict(name = span['thread'])))
+        events.append(dict(
+            name = span['name'],
+            cat = span['cat'],
+            ph = 'X',
+            ts = round((span['ts'] - origin) * 1e6, 1),
+            dur = round(span['dur'] * 1e6, 1),
+            pid = pids[span['process']],
+            tid = tids[thread],
+            args = dict(span['args'], trace = trace),
+        ))
+    return dict(traceEvents = events, displayTimeUnit = 'ms',
+                otherData = dict(origin = origin))
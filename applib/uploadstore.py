@@ -0,0 +1,114 @@
+# uploadstore.py
+#
+####################################
+#
+# Uploads, stored once by what's in them.
+#
+# Each upload is saved as uploads/.store/<md5><ext>, and uploads/<name> is a
+# symlink to it. The same bytes uploaded twice, under any names, are stored
+# once; uploading a new file under an old name just repoints the link. The
+# md5 is the upload's cache key (see uploadKey in applib/cveffects.py), so
+# it's known without reading the file again.
+#
+#   key, new = storeUpload('html', 'photo.png', fileobj)
+#   storeKey('html/uploads/photo.png')      # key, or None if not stored.
+#
+# The effect server then ingests each upload in the background (see
+# ingestUpload in runeffect.py), decoding it once into:
+#
+#   uploads/.store/<md5>.L1.npy ...   the pyramid: half size, quarter size,
+#                                     down to PYRAMID_MIN pixels across
+#   uploads/.store/<md5>.npy          the decoded image, written last
+#
+# Reads map the .npy rather than decoding the file again, and previews and
+# thumbnails (uploads/.store/<md5>.w<width>.png) start from the smallest
+# level that's still big enough.
+#
+# Only images are ingested (isImage): videos and anything else are just
+# stored. Uploads from before the store (plain files) work as they always did.
+#
+####################################
+
+import os, re, hashlib, threading
+
+# Under the static dir, as are the uploads themselves.
+UPLOAD_DIR = 'uploads'
+STORE_DIR = 'uploads/.store'
+
+# The pyramid stops at the first level no more than this wide or high.
+PYRAMID_MIN = 256
+
+IMAGE_EXTS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff', '.webp')
+
+KEY_RE = re.compile(r'^([0-9a-f]{32})(\.|$)')
+
+# The content key of an upload (the link, or anything in the store), or None.
+def storeKey(filename):
+    if os.path.basename(os.path.dirname(filename)) != os.path.basename(STORE_DIR):
+        if not os.path.islink(filename):
+            return None
+        filename = os.readlink(filename)
+        if os.path.basename(os.path.dirname(filename)) != os.path.basename(STORE_DIR):
+            return None
+    m = KEY_RE.match(os.path.basename(filename))
+    return m[1] if m else None
+
+def isImage(filename):
+    return filename.lower().endswith(IMAGE_EXTS)
+
+def rawPath(base, key):
+    return f"{base}/{STORE_DIR}/{key}.npy"
+
+def levelPath(base, key, level):
+    return f"{base}/{STORE_DIR}/{key}.L{level}.npy"
+
+def thumbPath(key, width):
+    return f"{STORE_DIR}/{key}.w{width}.png"
+
+# Whether the effect server has decoded it yet.
+def isIngested(base, key):
+    return os.path.exists(rawPath(base, key))
+
+# The deepest pyramid level that's at least 'scale' of the full size, as
+# (level, path), or None if there's no such level on disk.
+def pyramidLevel(base, key, scale):
+    best = None
+    level = 1
+    while 0.5 ** level >= scale:
+        path = levelPath(base, key, level)
+        if not os.path.exists(path):
+            break
+        best = (level, path)
+        level += 1
+    return best
+
+# Save what's read from fileobj as upload 'name'. Returns (key, new): new is
+# False if the store already had those bytes.
+def storeUpload(base, name, fileobj):
+    name = os.path.basename(name)
+    store = f"{base}/{STORE_DIR}"
+    os.makedirs(store, exist_ok=True)
+
+    tmpname = f"{store}/.{os.getpid()}.{threading.get_ident()}.tmp"
+    h = hashlib.md5()
+    with open(tmpname, 'wb') as fout:
+        for block in iter(lambda: fileobj.read(1 << 20), b''):
+            h.update(block)
+            fout.write(block)
+    key = h.hexdigest()
+
+    blob = f"{store}/{key}{os.path.splitext(name)[1].lower()}"
+    new = not os.path.exists(blob)
+    if new:
+        os.replace(tmpname, blob)
+    else:
+        os.remove(tmpname)
+
+    # Link under a hidden name, then rename it over whatever had the name.
+    link = f"{base}/{UPLOAD_DIR}/{name}"
+    tmplink = f"{base}/{UPLOAD_DIR}/.{name}.link"
+    if os.path.lexists(tmplink):
+        os.remove(tmplink)
+    os.symlink(os.path.relpath(blob, os.path.dirname(link)), tmplink)
+    os.replace(tmplink, link)
+    return key, new
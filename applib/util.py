@@ -57,7 +57,6 @@ def optimize(content):
     return re.sub(r'>\s+<','><', stripped)
 
 def buildTemplates(filename, dirname):
-    print("buildTemplates called")
     with open(f"{dirname}/{filename}.html", 'r', encoding='utf-8') as fin:
         body = fin.read()
 
@@ -0,0 +1,90 @@
+# videorelay.py
+#
+####################################
+#
+# The flask side of playing a chart over a video (see videostream.py, which
+# runs in the effect server).
+#
+# Flask doesn't load opencv, so it never touches a frame. It sends the
+# effect server a streaming job ({video: {calls, images, show, idx}}), and
+# a worker runs the chart over the video there. Each JPEG comes back as a
+# progress frame, with the stream's stats, and VideoRelay passes them on to
+# the browser as MJPEG:
+#
+#   relay = VideoRelay()
+#   Thread(target=lambda: relay.finish(EFRequest(job, relay.onprogress))).start()
+#   error = relay.wait()   # None once the first frame's in.
+#   Response(relay.frames(), mimetype=MJPEG_MIMETYPE)
+#   relay.stats()          # fps, dropped frames, ms per stage.
+#
+# The stream runs until the effect server's job ends: it fails, or it's
+# superseded (a newer stream of the same output, or a cancel once the
+# browser lets go). It holds a worker, and that worker's share of the cores,
+# for as long as it plays.
+#
+####################################
+
+from threading import Condition
+
+VIDEO_EXTS = ('.mp4', '.avi', '.mov', '.mkv', '.webm', '.m4v', '.mpg', '.mpeg')
+POSTER_SUFFIX = '.poster.png'
+MJPEG_MIMETYPE = 'multipart/x-mixed-replace; boundary=frame'
+
+def isVideo(path):
+    return path.lower().endswith(VIDEO_EXTS)
+
+# 'uploads/a.mp4.poster.png' -> 'uploads/a.mp4'. None if it's not a poster.
+def posterVideo(path):
+    if not path.endswith(POSTER_SUFFIX): return None
+    video = path[:-len(POSTER_SUFFIX)]
+    return video if isVideo(video) else None
+
+class VideoRelay(object):
+    def __init__(self):
+        self.cond = Condition()
+        self.jpeg = None
+        self.sequence = 0
+        self.running = True
+        self.error = None
+        self.laststats = dict()
+
+    # A progress frame from the effect server: the next JPEG, as its blob.
+    def onprogress(self, msg):
+        with self.cond:
+            self.jpeg = msg.get('blob', self.jpeg)
+            self.sequence += 1
+            self.laststats = msg.get('stats', self.laststats)
+            self.cond.notify_all()
+
+    # The job's reply: the stream's over.
+    def finish(self, reply):
+        with self.cond:
+            self.running = False
+            if not reply.get('success'):
+                self.error = reply.get('error') or reply.get('status')
+            self.cond.notify_all()
+
+    # Block until the first frame. Returns the error if it never comes.
+    def wait(self):
+        with self.cond:
+            while self.running and self.sequence == 0:
+                self.cond.wait()
+            return None if self.sequence else (self.error or "Video stream ended")
+
+    # The multipart body: each new frame as it comes. A viewer that's slower
+    # than the stream just misses some.
+    def frames(self):
+        seen = 0
+        while True:
+            with self.cond:
+                while self.running and self.sequence == seen:
+                    self.cond.wait()
+                if not self.running: return
+                seen = self.sequence
+                jpeg = self.jpeg
+            yield (b'--frame\r\nContent-Type: image/jpeg\r\n'
+                   + f"Content-Length: {len(jpeg)}\r\n\r\n".encode() + jpeg + b'\r\n')
+
+    def stats(self):
+        with self.cond:
+            return dict(self.laststats, running = self.running, error = self.error or '')
@@ -0,0 +1,287 @@
+# videostream.py
+#
+####################################
+#
+# Play a chart over a video file, frame by frame, as a stream of JPEGs.
+#
+# Videos are uploaded like images. In the library and the chart they show up
+# as their first frame, uploads/<name>.poster.png, so every op works on them
+# just like a still. Ask for an op's output as a stream, and that poster is
+# replaced by each frame of the video in turn:
+#
+#   stream = VideoStream(chart.ordered(), chart.images, 'ops123', 0)
+#   stream.start()
+#   for jpeg in stream.jpegs(): ...
+#   stream.stats()        # fps, dropped frames, ms per stage.
+#   stream.stop()
+#
+# This runs in an effect server worker (see streamVideo in runeffect.py),
+# which sends each JPEG back as progress; flask only relays them to the
+# browser (see videorelay.py).
+#
+# Three threads pass frames along: decode (paced to the file's own frame
+# rate, looping at the end), process (the ops, through jsApply) and encode
+# (to JPEG). Each hands over through a one-frame slot. If the next stage
+# hasn't taken the last frame yet, it's dropped and replaced with the newer
+# one, so a slow chart skips frames instead of falling further and further
+# behind.
+#
+# Only ops between the video and the one being shown run per frame. Anything
+# that doesn't depend on the video (complexes, other images) runs once.
+#
+####################################
+
+import os, time
+from collections import deque
+from threading import Thread, Condition
+
+from .batch import runCalls, readOnly
+from .videorelay import posterVideo
+from cvlib import cv
+
+# sustained fps is counted over this many seconds.
+FPS_WINDOW = 2.0
+# For files that don't say.
+DEFAULT_FPS = 25.0
+
+# A poster: the video's first frame.
+def makePoster(path):
+    video = posterVideo(path)
+    if video is None or not os.path.exists(f"html/{video}"):
+        return False
+    cap = cv.VideoCapture(f"html/{video}")
+    ok, frame = cap.read()
+    cap.release()
+    return bool(ok) and cv.imwrite(f"html/{path}", frame)
+
+# Hands one item at a time from a thread to the next. A put() before the
+# last item was taken replaces it.
+class Slot(object):
+    def __init__(self):
+        self.cond = Condition()
+        self.item = None
+        self.closed = False
+
+    # Returns True if an untaken item was dropped.
+    def put(self, item):
+        with self.cond:
+            dropped = self.item is not None
+            self.item = item
+            self.cond.notify()
+            return dropped
+
+    # Blocks for the next item. None once closed.
+    def get(self):
+        with self.cond:
+            while self.item is None and not self.closed:
+                self.cond.wait()
+            item, self.item = self.item, None
+            return item
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+class VideoStream(object):
+    # calls are the chart's opcalls in order, images its dict(uuid: path).
+    # Shows output 'idx' of op 'show'.
+    def __init__(self, calls, images, show, idx=0, quality=80):
+        self.show = show
+        self.idx = str(idx)
+        self.quality = quality
+        self.videos = dict((uuid, posterVideo(path)) for uuid, path in images.items() if posterVideo(path))
+        self.images = dict((uuid, path) for uuid, path in images.items() if uuid not in self.videos)
+
+        # Just what the shown op needs, split into what changes each frame
+        # and what doesn't.
+        bycall = dict((call['uuid'], call) for call in calls)
+        needed = set()
+        def need(uuid):
+            if uuid in needed or uuid not in bycall: return
+            needed.add(uuid)
+            for source in bycall[uuid].get('dependencies', {}).values():
+                need(source['sourceid'])
+        need(show)
+
+        moving = set(self.videos)
+        self.perframe = []
+        self.once = []
+        for call in calls:
+            if call['uuid'] not in needed: continue
+            if any(source['sourceid'] in moving for source in call.get('dependencies', {}).values()):
+                moving.add(call['uuid'])
+                self.perframe.append(call)
+            else:
+                self.once.append(call)
+
+        self.values = dict()
+        self.caps = dict()
+        self.decoded = Slot()
+        self.processed = Slot()
+        self.jpeg = None
+        self.sequence = 0
+        self.shown = Condition()
+        self.threads = []
+        self.running = False
+        self.error = None
+
+        self.fps = DEFAULT_FPS
+        self.counts = dict(decoded = 0, processed = 0, encoded = 0, dropped = 0, failed = 0)
+        self.busy = dict(decode = 0.0, process = 0.0, encode = 0.0)
+        self.times = deque()
+        self.started = time.monotonic()
+
+    # Returns an error, or None once the threads are running.
+    def start(self):
+        if not self.videos:
+            return "No video in the chart"
+        shown = next((call for call in self.perframe if call['uuid'] == self.show), None)
+        if shown is None:
+            return "That op doesn't depend on a video"
+        if int(self.idx) >= len(shown['output']) or shown['output'][int(self.idx)]['cname'] != 'image':
+            return "That output isn't an image"
+
+        for uuid, path in self.images.items():
+            img = cv.imread(f"html/{path}", cv.IMREAD_UNCHANGED)
+            if img is None:
+                return f"Unable to read {path}"
+            self.values[uuid] = readOnly(img)
+        error = runCalls(self.once, self.values, dict())
+        if error:
+            return error
+
+        self.caps = dict()
+        for uuid, path in self.videos.items():
+            cap = cv.VideoCapture(f"html/{path}")
+            if not cap.isOpened():
+                return f"Unable to open {path}"
+            self.caps[uuid] = cap
+        self.fps = next(iter(self.caps.values())).get(cv.CAP_PROP_FPS) or DEFAULT_FPS
+
+        # A chart that fails on the first frame will fail on all of them.
+        frames = dict()
+        for uuid, cap in self.caps.items():
+            ok, frame = cap.read()
+            if not ok:
+                return f"Unable to read {self.videos[uuid]}"
+            frames[uuid] = readOnly(frame)
+            cap.set(cv.CAP_PROP_POS_FRAMES, 0)
+        error = runCalls(self.perframe, dict(self.values, **frames), dict())
+        if error:
+            return error
+
+        self.running = True
+        self.started = time.monotonic()
+        for target in (self.decode, self.process, self.encode):
+            thread = Thread(target=target, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        return None
+
+    # Wind down all three threads, and anyone waiting on jpegs().
+    def halt(self, error=None):
+        if error:
+            self.error = error
+        self.running = False
+        self.decoded.close()
+        self.processed.close()
+        with self.shown:
+            self.shown.notify_all()
+
+    def stop(self):
+        self.halt()
+        for thread in self.threads:
+            thread.join()
+        for cap in self.caps.values():
+            cap.release()
+
+    # Read frames in real time, as a player would.
+    def decode(self):
+        interval = 1.0 / self.fps
+        due = time.monotonic()
+        while self.running:
+            start = time.monotonic()
+            frames = dict()
+            for uuid, cap in self.caps.items():
+                ok, frame = cap.read()
+                if not ok:
+                    cap.set(cv.CAP_PROP_POS_FRAMES, 0)
+                    ok, frame = cap.read()
+                if not ok:
+                    self.halt(f"Unable to read {self.videos[uuid]}")
+                    return
+                frames[uuid] = readOnly(frame)
+            self.busy['decode'] += time.monotonic() - start
+            self.counts['decoded'] += 1
+            if self.decoded.put(frames):
+                self.counts['dropped'] += 1
+
+            # Behind? Carry on from now rather than rushing to catch up.
+            due = max(due + interval, time.monotonic())
+            time.sleep(max(0.0, due - time.monotonic()))
+
+    def process(self):
+        while self.running:
+            frames = self.decoded.get()
+            if frames is None: break
+            start = time.monotonic()
+            values = dict(self.values, **frames)
+            error = runCalls(self.perframe, values, dict())
+            self.busy['process'] += time.monotonic() - start
+            if error:
+                self.counts['failed'] += 1
+                self.halt(error)
+                break
+            self.counts['processed'] += 1
+            if self.processed.put(values.get((self.show, self.idx))):
+                self.counts['dropped'] += 1
+
+    def encode(self):
+        while self.running:
+            img = self.processed.get()
+            if img is None: break
+            start = time.monotonic()
+            ok, buf = cv.imencode('.jpg', img, [cv.IMWRITE_JPEG_QUALITY, self.quality])
+            self.busy['encode'] += time.monotonic() - start
+            if not ok:
+                self.counts['failed'] += 1
+                continue
+            now = time.monotonic()
+            with self.shown:
+                self.jpeg = buf.tobytes()
+                self.sequence += 1
+                self.counts['encoded'] += 1
+                self.times.append(now)
+                self.shown.notify_all()
+
+    # Each new frame as it's encoded. A reader that's slower than us just
+    # misses some.
+    def jpegs(self):
+        seen = 0
+        while True:
+            with self.shown:
+                while self.running and self.sequence == seen:
+                    self.shown.wait()
+                if not self.running: return
+                seen = self.sequence
+                jpeg = self.jpeg
+            yield jpeg
+
+    def stats(self):
+        now = time.monotonic()
+        with self.shown:
+            while self.times and self.times[0] < now - FPS_WINDOW:
+                self.times.popleft()
+            fps = len(self.times) / max(min(FPS_WINDOW, now - self.started), 0.001)
+        done = dict(decode = self.counts['decoded'], process = self.counts['processed'] + self.counts['failed'],
+                    encode = self.counts['encoded'])
+        return dict(
+            running = self.running,
+            fps = round(fps, 2),
+            sourcefps = round(self.fps, 2),
+            error = self.error or '',
+            ms = dict((stage, round(self.busy[stage] * 1000 / done[stage], 2) if done[stage] else 0)
+                      for stage in self.busy),
+            **self.counts,
+        )
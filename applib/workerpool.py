@@ -0,0 +1,290 @@
+# workerpool.py
+#
+####################################
+#
+# A fixed-size pool of long-lived worker processes for runeffect.py.
+#
+# Workers are forked from a forkserver: a process started clean, before
+# any of the server's threads, which loads the server's main module (so cv2
+# and cvlib) once. They then keep taking jobs for as long as they live.
+# Anything they keep around (e.g: decoded images) stays warm between
+# requests. Forking the server itself isn't safe once it has threads: a
+# replacement worker would inherit any lock (the cache index's, metrics',
+# stdio's) another thread held at that moment, and wait on it forever.
+#
+# Since workers don't inherit the server's state, anything set at startup
+# (e.g: budgets from the command line) goes to initializer(*initargs), run
+# in each worker before its first job.
+#
+# Each worker is fed by its own dispatcher thread in the server process,
+# which takes jobs off a shared queue and passes them to the worker over a
+# pipe. If a worker dies mid-job (opencv does segfault now and again), its
+# job fails with whatever failure() returns, the worker is replaced, and the
+# server carries on. That's the crash isolation fork-per-request used to give
+# us.
+#
+# Jobs can be submitted with a key and a generation (e.g: a browser session
+# and its refresh count). Once a newer generation for the same key comes in,
+# older ones are superseded: if they're still queued they're dropped, and if
+# a worker is already on one it gets killed and replaced. Either way they
+# finish with whatever superseded() returns, and onexit(pid) is called for
+# each worker that gets replaced. While a slider is being dragged
+# this keeps the workers on the latest parameters instead of stale ones.
+#
+#   pool = WorkerPool(4, handle, failure=lambda: dict(success=0),
+#                     superseded=lambda: dict(success=0))
+#   pool.start()
+#   job = pool.submit(jsobj)      # Blocks until a worker's done with it.
+#   job = pool.submit(jsobj, key=('abc', 'graph'), generation=12)
+#   job.reply, job.waited         # Its reply, and seconds spent queued.
+#   pool.stop()
+#
+# A handler can report progress before it's done by calling progress(msg) in
+# the worker. The message goes to the onprogress callback the job was
+# submitted with, if any.
+#
+#   job = pool.submit(jsobj, onprogress=lambda msg: print(msg))
+#
+# The workers share a budget of cores (CoreBudget). Opencv runs its own
+# thread pool in each worker, so four workers each using every core thrash,
+# while one busy worker on its own should get them all. Each job is granted
+# a share when a worker picks it up: the cores split between it, the jobs
+# already running and the jobs still queued, and never more than what's
+# free (but always at least one). The worker is told before it starts, and
+# onthreads(threads) is called there with it (e.g: cv.setNumThreads);
+# handlers can ask for it with jobThreads().
+#
+#   pool = WorkerPool(4, handle, failure, cores=8, onthreads=cv.setNumThreads)
+#   pool.stats()['grants']        # Threads each worker's job has, 0 if idle.
+#
+####################################
+
+import multiprocessing
+import os, time
+from threading import Thread, Event, Lock
+from queue import Queue
+
+FORKSERVER = multiprocessing.get_context('forkserver')
+
+# In a worker process: the pipe back to its dispatcher, and how many
+# threads its current job was granted.
+WORKER_CONN = None
+WORKER_THREADS = None
+
+# How progress messages are told apart from replies on that pipe.
+class Progress(object):
+    def __init__(self, msg):
+        self.msg = msg
+
+# Report progress on the current job. Does nothing outside a worker.
+def progress(msg):
+    if WORKER_CONN is not None:
+        WORKER_CONN.send(Progress(msg))
+
+# The threads the current job may use. Outside a worker, every core.
+def jobThreads():
+    return WORKER_THREADS or os.cpu_count() or 1
+
+# What each worker process runs: handle requests until the pipe closes.
+def workerLoop(conn, handler, onthreads=None, initializer=None, initargs=()):
+    global WORKER_CONN
+    global WORKER_THREADS
+    WORKER_CONN = conn
+    if initializer:
+        initializer(*initargs)
+    while True:
+        try:
+            request, threads = conn.recv()
+        except (EOFError, OSError):
+            break
+        if threads != WORKER_THREADS:
+            WORKER_THREADS = threads
+            if onthreads:
+                onthreads(threads)
+        conn.send(handler(request))
+
+# The cores the pool's jobs share, and how many each running job has.
+# Always used with the pool's lock held.
+class CoreBudget(object):
+    def __init__(self, cores):
+        self.cores = max(1, cores)
+        self.grants = dict()
+
+    def allocated(self):
+        return sum(self.grants.values())
+
+    # A share for the job worker 'idx' is starting, with 'queued' more
+    # waiting behind it.
+    def grant(self, idx, queued):
+        free = self.cores - self.allocated()
+        share = self.cores // (len(self.grants) + 1 + queued)
+        self.grants[idx] = max(1, min(free, share))
+        return self.grants[idx]
+
+    def release(self, idx):
+        self.grants.pop(idx, None)
+
+class Job(object):
+    def __init__(self, request, key=None, generation=0, onprogress=None):
+        self.request = request
+        self.key = key
+        self.generation = generation
+        self.onprogress = onprogress
+        self.superseded = False
+        self.reply = None
+        self.done = Event()
+        self.queued = time.monotonic()
+        self.waited = 0.0
+
+    def finish(self, reply):
+        self.reply = reply
+        self.done.set()
+
+    def wait(self):
+        self.done.wait()
+        return self
+
+class WorkerPool(object):
+    def __init__(self, size, handler, failure, superseded=None, onexit=None,
+                 cores=None, onthreads=None, initializer=None, initargs=()):
+        self.size = size
+        self.handler = handler
+        self.failure = failure
+        self.superseded = superseded or failure
+        self.onexit = onexit
+        self.onthreads = onthreads
+        self.initializer = initializer
+        self.initargs = initargs
+        self.budget = CoreBudget(cores or os.cpu_count() or 1)
+        self.jobs = Queue()
+        self.workers = []
+        self.threads = []
+        self.running = False
+
+        # Newest generation seen for each key, and what each worker is on.
+        self.lock = Lock()
+        self.latest = dict()
+        self.current = []
+        self.cancelled = 0
+
+    def spawn(self):
+        conn, childconn = FORKSERVER.Pipe()
+        proc = FORKSERVER.Process(target=workerLoop, daemon=True,
+                                  args=(childconn, self.handler, self.onthreads,
+                                        self.initializer, self.initargs))
+        proc.start()
+        childconn.close()
+        return proc, conn
+
+    # The forkserver starts with the first worker, and preloads the main
+    # module so workers start warm.
+    def start(self):
+        FORKSERVER.set_forkserver_preload(['__main__'])
+        self.running = True
+        self.workers = [self.spawn() for _ in range(self.size)]
+        self.current = [None] * self.size
+        for idx in range(self.size):
+            thread = Thread(target=self.dispatch, args=(idx,), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def dispatch(self, idx):
+        while self.running:
+            job = self.jobs.get()
+            if job is None: break
+            job.waited = time.monotonic() - job.queued
+
+            with self.lock:
+                if self.stale(job):
+                    self.cancelled += 1
+                    job.finish(self.superseded())
+                    continue
+                self.current[idx] = job
+                threads = self.budget.grant(idx, self.jobs.qsize())
+
+            # Killed while idle? Replace it before handing it anything.
+            if not self.workers[idx][0].is_alive():
+                self.respawn(idx)
+
+            proc, conn = self.workers[idx]
+            try:
+                conn.send((job.request, threads))
+                reply = conn.recv()
+                while isinstance(reply, Progress):
+                    if job.onprogress:
+                        job.onprogress(reply.msg)
+                    reply = conn.recv()
+            except (EOFError, OSError):
+                self.respawn(idx, quiet=job.superseded)
+                reply = self.superseded() if job.superseded else self.failure()
+
+            with self.lock:
+                self.current[idx] = None
+                self.budget.release(idx)
+            job.finish(reply)
+
+    def respawn(self, idx, quiet=False):
+        proc, conn = self.workers[idx]
+        conn.close()
+        proc.join()
+        # Let the owner clean up after it, e.g: half-written files.
+        if self.onexit:
+            self.onexit(proc.pid)
+        if not quiet:
+            print(f"Worker {proc.pid} died (exit code {proc.exitcode}). Respawning.")
+        self.workers[idx] = self.spawn()
+
+    # Call with self.lock held.
+    def stale(self, job):
+        if job.key is None: return False
+        return job.generation < self.latest.get(job.key, job.generation)
+
+    # Note that 'generation' is the newest for 'key', and stop any worker
+    # still on an older one. Returns False if something newer already came.
+    # Requests answered without the pool (e.g: from cache) call this too.
+    def supersede(self, key, generation):
+        if key is None: return True
+        with self.lock:
+            if generation < self.latest.get(key, generation):
+                return False
+            self.latest[key] = generation
+            for idx, running in enumerate(self.current):
+                if running is not None and not running.superseded and self.stale(running):
+                    running.superseded = True
+                    self.cancelled += 1
+                    self.workers[idx][0].kill()
+        return True
+
+    # Queue a request and wait for a worker to finish it. Anything older
+    # under the same key is superseded by it.
+    def submit(self, request, key=None, generation=0, onprogress=None):
+        job = Job(request, key, generation, onprogress)
+        if not self.supersede(key, generation):
+            with self.lock:
+                self.cancelled += 1
+            job.finish(self.superseded())
+            return job
+        self.jobs.put(job)
+        return job.wait()
+
+    def stats(self):
+        with self.lock:
+            return dict(
+                workers = self.size,
+                busy = sum(1 for job in self.current if job is not None),
+                queued = self.jobs.qsize(),
+                cancelled = self.cancelled,
+                cores = self.budget.cores,
+                allocated = self.budget.allocated(),
+                grants = [self.budget.grants.get(idx, 0) for idx in range(self.size)],
+            )
+
+    def stop(self):
+        self.running = False
+        for _ in self.threads:
+            self.jobs.put(None)
+        for proc, conn in self.workers:
+            conn.close()
+            proc.terminate()
+            proc.join()
+        self.workers = []
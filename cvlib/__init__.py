@@ -17,4 +17,7 @@ from . import basics, generators, custom
 
 from .typedefs import T, JSDict, TYPE_DECODERS
 
+# Running them tile by tile, for very big images.
+from .tiled import tiledApply, canTile
+
 # __all__ = ['effects', 'EF', 'register', 'INFO', 'T', 'JSDict', 'TYPE_DECODERS']
@@ -12,16 +12,17 @@
 import numpy as np
 from .effects import EF, cv, T
 
-@EF.register("Threshold (Adaptive)", T.grayscale)
+@EF.register("Threshold (Adaptive)", T.grayscale, halo=lambda args: args['blockSize'] // 2 + 1)
 def adaptiveThreshold(
             image : T.grayscale,
             cmax : T.int(min=0, max=255) = 255,
             method : T.select({"Gaussian": cv.ADAPTIVE_THRESH_GAUSSIAN_C, "Mean": cv.ADAPTIVE_THRESH_GAUSSIAN_C}) = cv.ADAPTIVE_THRESH_GAUSSIAN_C,
             target : T.select({"BINARY": cv.THRESH_BINARY, "INVERTED": cv.THRESH_BINARY_INV}) = cv.THRESH_BINARY,
             blockSize : T.int(min=1, step=2, title="Must be odd") = 27,
-            weight : T.int = 2
+            weight : T.int = 2,
+            dst = None,
         ):
-    return cv.adaptiveThreshold(image, cmax, method, target, blockSize, weight)
+    return cv.adaptiveThreshold(image, cmax, method, target, blockSize, weight, dst=dst)
 
 thresholdTarget = T.select({
     "Binary": cv.THRESH_BINARY,
@@ -31,7 +32,8 @@ thresholdTarget = T.select({
     "ToZero Inverted": cv.THRESH_TOZERO_INV,
 }, title="Threshold target", ctype='int')
 
-@EF.register("Threshold (Normal)", T.grayscale)
+# Otsu picks its threshold from the whole image: no tiles.
+@EF.register("Threshold (Normal)", T.grayscale, halo=lambda args: None if args['otsu'] else 0)
 def threshold(
             image : T.grayscale,
             cmax : T.int(min=0, max=255) = 255,
@@ -39,25 +41,26 @@ def threshold(
             high : T.byte(title="Above this is white") = 255,
             target : thresholdTarget = cv.THRESH_BINARY,
             otsu : T.bool(title="Use Otsu thresholding") = False,
+            dst = None,
         ):
     if otsu:
         target |= cv.THRESH_OTSU
-    _, ret = cv.threshold(image, low, high, target)
+    _, ret = cv.threshold(image, low, high, target, dst=dst)
     return ret
 
-@EF.register("Grayscale", T.grayscale, sort='high')
+@EF.register("Grayscale", T.grayscale, sort='high', buffers=EF.ALIASES, halo=0)
 def grayscale(image : T.color):
     if not EF.isColor(image):
         return image
     return cv.cvtColor(image, cv.COLOR_BGR2GRAY)
 
-@EF.register("Colorize", T.color, sort='high')
+@EF.register("Colorize", T.color, sort='high', buffers=EF.ALIASES)
 def colorize(image : T.grayscale):
     if not EF.isColor(image):
         return cv.cvtColor(image, cv.COLOR_GRAY2BGR)
     return image
 
-@EF.register("Remove Color", T.color)
+@EF.register("Remove Color", T.color, buffers=EF.INPLACE)
 def removeColor(
             image : T.color,
             channel : T.colorChannel = 1
@@ -65,16 +68,20 @@ def removeColor(
     image[:,:,channel] = 0
     return image
 
-@EF.register("Blur (Averaging)", T.image)
-def blurAverage(image : T.image, boxSize : T.complex(title="1x2 array such as [2,2]") = [3,3]):
-    return cv.blur(image, boxSize)
+@EF.register("Blur (Averaging)", T.image, halo=lambda args: max(args['boxSize']) // 2 + 1)
+def blurAverage(image : T.image, boxSize : T.complex(title="1x2 array such as [2,2]") = [3,3],
+                dst = None):
+    return cv.blur(image, boxSize, dst=dst)
 
-@EF.register("Blur (Median)", T.image)
+@EF.register("Blur (Median)", T.image, halo=lambda args: args['amount'] // 2 + 1)
 def blurMedian(
         image : T.image,
-        amount : T.int(min=1, step=2, max=255, title="Pixel range to blur (odd number)") = 5):
-    return cv.medianBlur(image, amount)
+        amount : T.int(min=1, step=2, max=255, title="Pixel range to blur (odd number)") = 5,
+        dst = None):
+    return cv.medianBlur(image, amount, dst=dst)
 
+# No halo: hysteresis can follow a weak edge any distance, so no tile sees
+# enough to give what the whole image would.
 @EF.register("Canny edge detection", T.image)
 def canny(
         image : T.image,
@@ -87,7 +94,7 @@ def canny(
     # that requires 16 bit ... So no l2gradient for now.
     return cv.Canny(image, threshold1, threshold2, apertureSize)
 
-@EF.register("Write text", T.color)
+@EF.register("Write text", T.color, buffers=EF.INPLACE)
 def writeOn(
             image : T.image,
             text : T.string = 'demo',
@@ -118,7 +125,7 @@ def writeOn(
     image = cv.putText(image, text, (calcx, calcy), font, size, color, weight)
     return image
 
-@EF.register("Grayscale from Color", T.grayscale)
+@EF.register("Grayscale from Color", T.grayscale, buffers=EF.ALIASES, halo=0)
 def colorToGray(
             image : T.color,
             channel : T.colorChannel = 1
@@ -135,9 +142,9 @@ def grayToColor(
     colored[:,:,channel] = image
     return colored
 
-@EF.register("Invert", T.image)
-def invert(image : T.image):
-    return 255 - image
+@EF.register("Invert", T.image, halo=0)
+def invert(image : T.image, dst = None):
+    return np.subtract(255, image, out=dst)
 
 @EF.register("Find Corners", [T.complex])
 def findCorners(image : T.grayscale):
@@ -145,23 +152,27 @@ def findCorners(image : T.grayscale):
     corners = np.int0(corners)
     return corners
 
-@EF.register("Morph (Dilate)", T.image)
+@EF.register("Morph (Dilate)", T.image,
+             halo=lambda args: max(args['width'], args['height']) // 2 * args['iterations'] + 1)
 def morphDilate(
             image : T.image,
             width : T.byte = 7,
             height : T.byte = 7,
             iterations : T.byte = 8,
+            dst = None,
             ):
-    return cv.dilate(image, np.ones((height, width)), iterations=iterations)
+    return cv.dilate(image, np.ones((height, width)), dst=dst, iterations=iterations)
 
-@EF.register("Morph (Erode)", T.image)
+@EF.register("Morph (Erode)", T.image,
+             halo=lambda args: max(args['width'], args['height']) // 2 * args['iterations'] + 1)
 def morphErode(
             image : T.image,
             width : T.byte = 7,
             height : T.byte = 7,
             iterations : T.byte = 8,
+            dst = None,
             ):
-    return cv.erode(image, np.ones((height, width)), iterations=iterations)
+    return cv.erode(image, np.ones((height, width)), dst=dst, iterations=iterations)
 
 @EF.register("Blend (addWeighted)", T.image)
 def blend(
@@ -170,10 +181,11 @@ def blend(
             weightA : T.percent = 0.5,
             weightB : T.percent = 0.5,
             gamma : T.byte = 0,
+            dst = None,
         ):
-    return cv.addWeighted(imageA, weightA, imageB, weightB, gamma)
+    return cv.addWeighted(imageA, weightA, imageB, weightB, gamma, dst=dst)
 
-@EF.register("Draw Polygon", T.image)
+@EF.register("Draw Polygon", T.image, buffers=EF.INPLACE)
 def drawPoly(
             image : T.image,
             poly  : T.complex(title="2D Polygon array"),
@@ -187,6 +199,6 @@ def drawPoly(
 
 # Register a way for complex to save itself. In theory, it
 # should return it as is just to be written.
-@EF.register("saveComplex", T.complex, sort="hidden")
+@EF.register("saveComplex", T.complex, sort="hidden", buffers=EF.ALIASES)
 def saveComplex(inp: T.complex):
     return inp
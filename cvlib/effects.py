@@ -30,9 +30,15 @@
 #
 # Using lazy apply, we can verify call chain. e.g: BGR->BGR calls.
 #
-# Lazy apply always starts with a copy unless you pass
-# copy=False. It should never modify the image you pass to it. Though any
-# images passed as arguments (e.g: EF.merge(otherImage)) don't have that copy.
+# Lazy apply never modifies the image you pass to it unless you pass
+# copy=False, and never hands back that same image. Though any images passed
+# as arguments (e.g: EF.merge(otherImage)) don't have that protection.
+#
+# It only copies when it has to: effects say how they treat their image (see
+# 'buffers' below), so it copies just before the first one that draws on it,
+# and effects that can write into a dst= buffer get handed one freed up by
+# an earlier step. A long chain ends up with just a couple of full-size
+# allocations.
 #
 # from effects import EF
 #
@@ -60,6 +66,7 @@
 import cv2 as cv
 import numpy as np
 import inspect
+import hashlib
 
 from .typedefs import T, JSDict
 
@@ -137,6 +144,9 @@ def jsify(func):
     params = sig.parameters
     args = []
     for arg, v in params.items():
+        # Where to put the output, not something to show.
+        if arg == 'dst':
+            continue
         argdef = {}
         if isinstance(v.annotation, JSDict):
             argdef = v.annotation.toDict()
@@ -151,6 +161,17 @@ def jsify(func):
 
     return args
 
+# Changes whenever the effect's code does: its source, from the register()
+# line (outputs, buffers) through its defaults and body. Cached outputs are
+# keyed on it, so editing an effect doesn't leave its old results around
+# to be served.
+def codeFingerprint(func):
+    try:
+        source = inspect.getsource(func)
+    except (OSError, TypeError):
+        source = func.__code__.co_code.hex()
+    return hashlib.md5(source.encode('utf-8')).hexdigest()
+
 def addEffectInfo(func, displayname, output, **kwargs):
     args = jsify(func)
     newEffect = dict(
@@ -159,6 +180,7 @@ def addEffectInfo(func, displayname, output, **kwargs):
         doc = func.__doc__,
         args = args,
         output = output,
+        fingerprint = codeFingerprint(func),
         **kwargs
     )
     INFO['effects'][func.__name__] = newEffect
@@ -203,6 +225,41 @@ C('iotypes',
 class Effects(object):
     pass
 
+####################################
+#
+# How an effect treats its image (its first argument). Passed to register as
+# buffers=..., so EF.apply and jsApply know when to copy and which buffers
+# they can reuse:
+#
+#   EF.ALLOCATES   Returns a new array, and leaves its image alone. The default.
+#   EF.INPLACE     Draws on its image. It's always given one nobody else has.
+#   EF.ALIASES     May return its image, or a view of it. Leaves it alone.
+#
+# Separately, an effect with a 'dst' argument writes its output into dst when
+# that's the right shape and type (just like cv's own functions), and
+# allocates otherwise. dst is never its image.
+#
+#   @EF.register("Invert", T.image)
+#   def invert(image : T.image, dst=None):
+#       return np.subtract(255, image, out=dst)
+#
+# Effects whose output pixels only depend on the input pixels near them can
+# also say how near, as halo=...: 0 for pointwise effects, or a function of
+# the (defaulted) args giving the radius in pixels, or None if it can't be
+# done piecewise with those args. Those can run tile by tile on images too
+# big to run whole; see tiled.py.
+#
+#   @EF.register("Blur (Median)", T.image, halo=lambda args: args['amount'] // 2)
+#
+####################################
+EF.ALLOCATES = 'allocates'
+EF.INPLACE = 'inplace'
+EF.ALIASES = 'aliases'
+
+# name: dict(buffers, dst, image, halo), image being the name of its image
+# argument. halo is None for effects that can't be tiled.
+BUFFERS = dict()
+
 ####################################
 #
 # Lazy Caller lets us chain a bunch of effects and apply them as groups, or
@@ -215,14 +272,24 @@ class LazyCaller(object):
         self.args = args
         self.kwargs = kwargs
         self.output = output
+        self.buffers = BUFFERS[func.__name__]['buffers']
+        self.dst = BUFFERS[func.__name__]['dst']
 
 # Add a function to both Effects for direct call, and EF for lazy.
-def register(displayname, *args, **effargs):
+def register(displayname, *args, buffers=EF.ALLOCATES, halo=None, **effargs):
     output = args
     def registerfunc(func):
         def lazyApply(*args, **kwargs):
             return LazyCaller(func, args, kwargs, output)
 
+        params = list(inspect.signature(func).parameters)
+        BUFFERS[func.__name__] = dict(
+            buffers = buffers,
+            dst = 'dst' in params,
+            image = params[0] if params else None,
+            halo = halo,
+        )
+
         addEffectInfo(func, displayname, output, **effargs)
 
         setattr(Effects, func.__name__, func)
@@ -238,8 +305,10 @@ def applyEffects(image, *all_effects, copy=True):
     if len(image.shape) == 2:
         channel = EF.GRAYSCALE
    
-    if copy:
-        image = image.copy()
+    # 'fresh' is whether we made 'image' here, so nobody else has it. 'spare'
+    # is an earlier fresh buffer that's done with, for a dst= effect to use.
+    fresh = False
+    spare = None
 
     for effect in all_effects:
 #        TODO: Type checking?
@@ -255,7 +324,28 @@ def applyEffects(image, *all_effects, copy=True):
 #        if effect.paramsto != EF.SAME:
 #            channel = effect.paramsto
 
-        image = effect.func(image, *effect.args, **effect.kwargs)
+        kwargs = effect.kwargs
+        if effect.buffers == EF.INPLACE and copy and not fresh:
+            image = image.copy()
+            fresh = True
+        if effect.dst and 'dst' not in kwargs and spare is not None \
+                and spare.shape == image.shape and spare.dtype == image.dtype:
+            kwargs = dict(kwargs, dst=spare)
+
+        previous = image
+        image = effect.func(image, *effect.args, **kwargs)
+
+        # Something new: whatever it was made from is free to reuse, if it's
+        # ours. Views of (or) the image we had don't change anything, and
+        # can't be reused themselves: opencv won't write into a view like
+        # image[:,:,1] (see EF.ALIASES).
+        if effect.buffers == EF.ALLOCATES and image is not previous:
+            owned = fresh and previous.base is None and previous.flags.c_contiguous
+            spare = previous if owned else None
+            fresh = True
+
+    if copy and not fresh:
+        image = image.copy()
 
     return image
 
@@ -263,8 +353,16 @@ def applyEffects(image, *all_effects, copy=True):
 def isColor(image):
     return len(image.shape) == 3
 
+# Effects that draw on their image get a copy of it, so whatever's passed in
+# (e.g: an image other ops are reading too) is left alone. Anything else gets
+# it as is.
 def jsApply(effect, args):
-    return getattr(Effects, effect)(**args)
+    func = getattr(Effects, effect)
+    image = BUFFERS[effect]['image']
+    if BUFFERS[effect]['buffers'] == EF.INPLACE and isinstance(args.get(image), np.ndarray):
+        args = dict(args)
+        args[image] = args[image].copy()
+    return func(**args)
 
 # Shorthand for implementation .py files:
 EF.isColor = isColor
@@ -0,0 +1,89 @@
+# tiled.py
+#
+####################################
+#
+# Running an effect on an image tile by tile, for images too big to run it
+# on whole (a gigapixel scan, and a few intermediates of it, don't fit in
+# memory).
+#
+# Effects that only look near each pixel say how near when they register
+# (halo=..., see effects.py). Each tile is cut out with that much of its
+# neighbours around it, run through jsApply, and just its middle copied into
+# the output, so the stitched result is what the whole image would have
+# given. Pointwise effects (halo 0) tile trivially. Tiled outputs are cached
+# under the same names as whole ones, so an effect only gets a halo if that
+# holds exactly: anything global (Otsu's threshold, canny's hysteresis)
+# doesn't get one, and never tiles.
+#
+#   if canTile('blurMedian', args):
+#       out = tiledApply('blurMedian', args)
+#
+# Tiles run on a pool of threads (opencv lets go of the GIL), a few at a
+# time, so memory goes with the tile size and the number of threads, not
+# the image. With 'alloc', the output goes wherever it says; a memory-mapped
+# file, say:
+#
+#   tiledApply('invert', args, alloc=lambda shape, dtype: np.lib.format.open_memmap(
+#       'out.npy', mode='w+', shape=shape, dtype=dtype))
+#
+# The image itself should be mapped too (np.load(..., mmap_mode='r')), so
+# only the tiles being worked on are ever read in.
+#
+####################################
+
+import os, inspect
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from .effects import Effects, BUFFERS, jsApply
+
+TILE_SIZE = 1024
+
+# The effect's halo for these args, or None if it can't be tiled.
+def haloFor(effect, args):
+    halo = BUFFERS.get(effect, {}).get('halo')
+    if not callable(halo):
+        return halo
+    bound = inspect.signature(getattr(Effects, effect)).bind_partial(**args)
+    bound.apply_defaults()
+    return halo(bound.arguments)
+
+# Whether tiledApply can run it: it has a halo, and its image is the only
+# image it's given.
+def canTile(effect, args):
+    if effect not in BUFFERS:
+        return False
+    image = args.get(BUFFERS[effect]['image'])
+    if not isinstance(image, np.ndarray) or image.ndim < 2:
+        return False
+    if any(isinstance(v, np.ndarray) for k, v in args.items() if k != BUFFERS[effect]['image']):
+        return False
+    return haloFor(effect, args) is not None
+
+def tiledApply(effect, args, tile=TILE_SIZE, threads=None, alloc=None):
+    name = BUFFERS[effect]['image']
+    image = args[name]
+    height, width = image.shape[:2]
+    halo = haloFor(effect, args)
+    threads = threads or os.cpu_count() or 1
+
+    def run(corner):
+        y, x = corner
+        y0, x0 = max(0, y - halo), max(0, x - halo)
+        y1, x1 = min(height, y + tile + halo), min(width, x + tile + halo)
+        result = jsApply(effect, dict(args, **{name: np.ascontiguousarray(image[y0:y1, x0:x1])}))
+        return corner, result[y - y0:min(height, y + tile) - y0, x - x0:min(width, x + tile) - x0]
+
+    corners = [(y, x) for y in range(0, height, tile) for x in range(0, width, tile)]
+    out = None
+    with ThreadPoolExecutor(threads) as pool:
+        # A couple of batches in flight at most: results wait here until
+        # they're copied out.
+        for start in range(0, len(corners), threads * 2):
+            for (y, x), result in pool.map(run, corners[start:start + threads * 2]):
+                if out is None:
+                    shape = (height, width) + result.shape[2:]
+                    out = alloc(shape, result.dtype) if alloc else np.empty(shape, result.dtype)
+                out[y:y + result.shape[0], x:x + result.shape[1]] = result
+    return out
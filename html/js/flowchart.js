@@ -49,7 +49,8 @@ function addImageBlock(imgjs) {
   populateElement(block, {
     '.block-image-frame': EL('img', {
       class: "block-image",
-      src: imgjs.path,
+      src: thumbPath(imgjs.path),
+      'data-full': imgjs.path,
       'data-name': imgjs.name,
       'data-uuid': imgjs.uuid,
       'data-idx': 0,
@@ -140,6 +140,19 @@ addTrigger('opChange', function(el, evt) {
   refreshOutputs();
 });
 
+// While a value is still being dragged or typed: a quick, scaled-down
+// preview. The 'change' when it settles (opChange) does the full run.
+addTrigger('opPreview', function(el, evt) {
+  const label = findParent(el, 'label');
+  const cname = el.dataset.cname;
+  if (cname in TYPEDEFS && TYPEDEFS[cname].parse) {
+    label.args.value = TYPEDEFS[cname].parse(name, el, label.args.name);
+  } else {
+    label.args.value = TYPEDEFS['string'].parse(name, el, label.args.name);
+  }
+  refreshOutputs(true);
+});
+
 // A single parameter to render.
 // name: name of arg.
 // opargs: existing json from previous changes or reloads.
@@ -156,6 +169,10 @@ function renderOp(name, opargs, argdef) {
     'data-name': name,
     'data-onchange': 'opChange',
   };
+  // Sliders and number fields get previews while they're being dragged.
+  if (['int', 'float', 'percent'].includes(cname)) {
+    jsargs['data-oninput'] = 'opPreview';
+  }
   const myargs = deepCopy(jsargs, argdef, opargs);
 
   let accepts = 'noaccept';
@@ -285,22 +302,18 @@ function getProviderListing(effect, opjs) {
 //  refreshOutputs: Load or reload every image that we have, that isn't
 //                   up to date.
 //
-//  Generate a sorted list of Ops. Sorted such that a given op will come after
-//  all ops, complexes, and images that it depends on.
-//
-//  An op is clear if its sources all terminate in images or complexes.
-//  Images and Complexes are 'clear'
+//  Build an opcall for every op that has all its args filled in, and hand
+//  them to the server along with our images and complexes. The server keeps
+//  the chart (applib/chartgraph.py): it sorts the ops, leaves out any that
+//  don't terminate in images or complexes (or are in a loop), and runs only
+//  the ops that changed and what's downstream of them.
 //
-//  Recursively travel down each op's sources until an op is seen as clear, or
-//  a loop is found.
+//  Only what's changed since the last refresh is sent.
 //
 ////////////////////////////////////
-function refreshOutputs() {
-  // sourceCache: A dictionary of [uuid]: [dependencies]
-  const sourceCache = {};
+function refreshOutputs(preview) {
   const opcalls = {};
   for (const [uuid, op] of Object.entries(CHART.ops)) {
-    const sources = [];
     const opcall = {
       uuid: uuid,
       effect: op.effect,
@@ -314,7 +327,6 @@ function refreshOutputs() {
     let good = true;
     for (const arg of op.args) {
       if (arg.source && arg.source.sourceid) {
-        sources.push(arg.source.sourceid);
         opcall.dependencies[arg.name] = arg.source;
       } else if (arg.value !== undefined) {
         opcall.args[arg.name] = arg.value;
@@ -323,177 +335,370 @@ function refreshOutputs() {
       }
     }
     if (good) {
-      sourceCache[uuid] = sources;
       opcalls[uuid] = opcall;
     }
   }
 
-  const clear = {};
+  // Now we enter async. Fire and forget.
+  if (preview) {
+    beginPreview(opcalls);
+  } else {
+    beginOpProcessing(opcalls);
+  }
+};
 
-  for (const image of Object.values(CHART.images)) {
-    clear[image.uuid] = true;
+// How long (seconds) a preview should take. The server picks a scale for
+// the inputs to fit it.
+const PREVIEW_BUDGET = 0.1;
+
+// Only one preview runs at a time: drags fire far more input events than
+// we can keep up with, so just the latest values get run next.
+let PREVIEW_RUNNING = false;
+let PREVIEW_NEXT = null;
+
+// Every refresh bumps this. A preview that comes back after a newer refresh
+// has started is stale, and mustn't replace anything.
+let REFRESH_COUNT = 0;
+
+// Requests are tagged with this page's session and their refresh count (the
+// generation). The effect server drops or stops anything from an older
+// generation once a newer one comes in, and replies 'superseded' for it.
+const SESSION = makeUUID('session') + Math.random().toString(36).slice(2);
+
+// Each op update and chart refresh is traced, from here to the worker; see
+// applib/tracing.py. Trace ids start with the session, so the page's traces
+// can be fetched together.
+let TRACE_COUNT = 0;
+
+function newTraceId(kind) {
+  TRACE_COUNT += 1;
+  return SESSION + '.' + kind + TRACE_COUNT;
+}
+
+// Seconds since the epoch, as the server's spans are timed.
+function wallTime() {
+  return (performance.timeOrigin + performance.now()) / 1000;
+}
+
+// Our side of a trace: how long it took, as the page saw it.
+function sendTraceSpan(trace, name, start, args) {
+  const span = {name: name, ts: start, dur: wallTime() - start, args: args || {}};
+  navigator.sendBeacon('/cv/tracespans', JSON.stringify({trace: trace, spans: [span]}));
+}
+
+// What the server's copy of our chart has: {ops, images, complexes}, each
+// {uuid: JSON string}. null until it's been sent, or when it needs sending
+// again from scratch.
+let CHART_SENT = null;
+
+// Whether anything has changed since the last full run went through. If
+// not, a refresh has nothing to ask for.
+let CHART_DIRTY = true;
+
+// Chart updates are deltas on top of each other, so they have to reach the
+// server in order: each POST waits until the one before it is answered.
+let CHART_POSTED = Promise.resolve();
+
+// Results are pushed down one event stream per page, each op as soon as
+// it's done, rather than coming back all at once in the POST's reply. While
+// the stream is down, runChart falls back to waiting on the POST.
+const EVENTS = new EventSource('/cv/events?session=' + SESSION);
+
+// Runs waiting on events, by generation:
+// {prepared: {hash: call}, early: [], finished, preview, done: resolve}.
+// Events can beat the POST's reply here; until it's in (and 'prepared'
+// says which op is which) they wait in 'early' and 'finished'.
+const STREAMING = {};
+
+EVENTS.addEventListener('op', (ev) => {
+  const js = JSON.parse(ev.data);
+  const run = STREAMING[js.generation];
+  if (!run) { return; }
+  if (!run.prepared) {
+    run.early.push(js);
+    return;
   }
+  showStreamedOp(run, js);
+});
 
-  for (const complex of Object.values(CHART.complexes)) {
-    clear[complex.uuid] = true;
+EVENTS.addEventListener('graph', (ev) => {
+  const js = JSON.parse(ev.data);
+  const run = STREAMING[js.generation];
+  if (!run) { return; }
+  if (!run.prepared) {
+    run.finished = js;
+    return;
   }
+  finishStream(js.generation, js);
+});
 
-  // Recursively check up the sources.
-  // 'seen' also works as a cache for bad ops.
-  const seen = {};
-  const ready = [];
+// Anything in flight when the stream drops won't hear back; let it go.
+EVENTS.addEventListener('error', () => {
+  for (const [generation, run] of Object.entries(STREAMING)) {
+    delete STREAMING[generation];
+    run.done();
+  }
+});
 
-  function checkClear(uuid) {
-    if (clear[uuid]) { return true; }
-    if (seen[uuid]) { return false; }
+function showStreamedOp(run, js) {
+  if (run.preview && js.generation !== REFRESH_COUNT) { return; }
+  const call = run.prepared[js.hash];
+  if (call) {
+    showOpUpdate(call.opcall, call.result, js.success, js.error, js.timings);
+  }
+}
 
-    seen[uuid] = true;
-    if (!(uuid in sourceCache)) return false;
+function finishStream(generation, js) {
+  const run = STREAMING[generation];
+  delete STREAMING[generation];
+  updateCacheSize(js.cachesize);
+  run.done(js);
+}
 
-    for (const nextuuid of sourceCache[uuid]) {
-      if (!checkClear(nextuuid)) {
-        return false;
-      }
-    }
-    seen[uuid] = false;
-    clear[uuid] = true;
-    ready.push(uuid);
-    return true;
+async function beginPreview(opcalls) {
+  if (PREVIEW_RUNNING) {
+    PREVIEW_NEXT = opcalls;
+    return;
   }
+  PREVIEW_RUNNING = true;
+  await beginOpProcessing(opcalls, true);
+  PREVIEW_RUNNING = false;
+
+  if (PREVIEW_NEXT) {
+    const next = PREVIEW_NEXT;
+    PREVIEW_NEXT = null;
+    beginPreview(next);
+  }
+}
 
-  for (const opuuid of Object.keys(sourceCache)) {
-    checkClear(opuuid);
+async function beginOpProcessing(opcalls, preview) {
+  REFRESH_COUNT += 1;
+  const refresh = REFRESH_COUNT;
+  const state = chartState(opcalls);
+
+  let sync = chartDelta(state);
+  CHART_DIRTY = CHART_DIRTY || sync.changed;
+  if (!CHART_DIRTY) {
+    // Nothing's changed since the last full run.
+    redrawAllLines();
+    return;
   }
 
-  const readyCalls = ready.map((r) => opcalls[r])
+  let js = await runChart(sync, state.calls, refresh, preview);
+  if (js && js.status === 'resync') {
+    // The server's lost our chart (it restarted, say). Send all of it.
+    CHART_SENT = null;
+    js = await runChart(chartDelta(state), state.calls, refresh, preview);
+  }
 
-  // Now we enter async. Fire and forget.
-  beginOpProcessing(readyCalls);
-};
+  if (!js) {
+    // No telling what the server got.
+    CHART_SENT = null;
+  } else if (!preview && refresh === REFRESH_COUNT) {
+    CHART_DIRTY = !js.success;
+  }
 
-async function beginOpProcessing(readyCalls) {
-  // 'opCache' is a cache (updated by processOpUpdate) of hashes and values
-  // passed along. As 'ready' is ordered, any dependencies will be in it.
-  // It also contains the information of images and complexes.
-  const opCache = {};
+  redrawAllLines();
+}
+
+// Our chart as the server keeps it, plus 'calls': the opcall for each op
+// and complex (complexes run as saveComplex ops), to show results with.
+function chartState(opcalls) {
+  const state = {ops: opcalls, images: {}, complexes: {}, calls: Object.assign({}, opcalls)};
 
   for (const image of Object.values(CHART.images)) {
-    opCache[image.uuid] = image.path;
+    state.images[image.uuid] = image.path;
   }
 
-  // Save our complexes on server side.
   for (const complex of Object.values(CHART.complexes)) {
-    const result = await processOpUpdate({
+    state.complexes[complex.uuid] = complex.json;
+    state.calls[complex.uuid] = {
       uuid: complex.uuid,
       effect: 'saveComplex',
       type: TYPE.complex,
       args: {inp: complex.json},
       output: [{cname: 'complex'}]
-    }, opCache);
-
-    result.outputs
-
-    opCache[complex.uuid] = result.hash;
-  }
-
-  // 'ready' is now consisting of ops uuids, in order of which they should be
-  // performed.
-  for (const call of readyCalls) {
-    const result = await processOpUpdate(call, opCache);
-    opCache[call.uuid] = result.hash;
+    };
   }
 
-  redrawAllLines();
+  return state;
 }
 
-// Process a single op action.
-// opcall has the information needed: uuid, effect, output, args.
-// opcache is to ID earlier hashes for dependencies.
-//
-// Once hashed, opcall needs it before being passed as a json
-// object btoa'd.
-//
-// opcall may have a dependencies: {name: uuids}, which should
-// be replaced with hashes from opCache, to look like
-// {name: 'cached/{hash}.png' for image.
-// {name: 'cached/{hash}.json' for complex.
-async function processOpUpdate(opcall, opCache) {
-
-  const jsargs = {
-    effect: opcall.effect,
-    args: opcall.args,
-    dependencies: {},
-    outputs: [],
+// What's changed since CHART_SENT, which is brought up to date. Returns
+// {reset, delta, changed}: removed entries are null in the delta, and reset
+// means the server should start from scratch.
+function chartDelta(state) {
+  const reset = CHART_SENT === null;
+  if (reset) {
+    CHART_SENT = {ops: {}, images: {}, complexes: {}};
   }
 
-  if (opcall.dependencies) {
-    for (const [k, v] of Object.entries(opcall.dependencies)) {
-      console.log("DepWhat", v);
-      if (v.cname.startsWith('complex')) {
-        jsargs.dependencies[k] = 'cached/' + opCache[v.sourceid] + '.' + v.idx + '.json';
-      } else {
-        if (v.sourceid.startsWith('images')) {
-          jsargs.dependencies[k] = opCache[v.sourceid];
-        } else {
-          jsargs.dependencies[k] = 'cached/' + opCache[v.sourceid] + '.' + v.idx + '.png';
-        }
+  const delta = {};
+  let changed = reset;
+  for (const name of ['ops', 'images', 'complexes']) {
+    const sent = CHART_SENT[name];
+    delta[name] = {};
+    for (const [uuid, value] of Object.entries(state[name])) {
+      const json = JSON.stringify(value);
+      if (sent[uuid] !== json) {
+        sent[uuid] = json;
+        delta[name][uuid] = value;
+        changed = true;
+      }
+    }
+    for (const uuid of Object.keys(sent)) {
+      if (!(uuid in state[name])) {
+        delete sent[uuid];
+        delta[name][uuid] = null;
+        changed = true;
       }
     }
   }
 
-  const result = {
-    uuid: opcall.uuid,
-    outputs: [],
-  };
+  return {reset: reset, delta: delta, changed: changed};
+}
 
-  result.hash = hashObject(jsargs);
-  jsargs.hash = result.hash;
+function postChart(body, trace) {
+  const posted = CHART_POSTED.then(() => fetch('/cv/chartgen', {
+    method: 'POST',
+    headers: {'Content-Type': 'application/json', 'X-Trace-Id': trace},
+    body: JSON.stringify(body),
+  }));
+  CHART_POSTED = posted.catch(() => null);
+  return posted;
+}
 
-  for (const [idx, output] of Object.entries(opcall.output)) {
-    const ret = {
-      uuid: opcall.uuid,
-    };
-    if (output.cname === 'image') {
-      ret.path = 'cached/' + result.hash + '.' + idx + '.png';
-      ret.type = TYPE.image;
-    } else {
-      ret.path = 'cached/' + result.hash + '.' + idx + '.json';
-      ret.type = TYPE.complex;
-    }
-    ret.idx = idx;
-    result.outputs.push(ret);
-    jsargs.outputs.push(ret);
-  }
+// Send a chart delta and show whatever the server runs for it. Returns the
+// final reply (or 'graph' event, when streamed), or null if the request
+// didn't go through.
+async function runChart(sync, calls, refresh, preview) {
+  const trace = newTraceId(preview ? 'preview' : 'chart');
+  const started = wallTime();
+  const js = await sendChart(sync, calls, refresh, preview, trace);
+  sendTraceSpan(trace, preview ? 'chart preview' : 'chart refresh', started,
+                {status: js ? js.status : 'failed', generation: refresh});
+  return js;
+}
 
-  const genpath = "/cv/imagegen?p=";
+// The work of runChart, under a trace id.
+async function sendChart(sync, calls, refresh, preview, trace) {
+  const body = {
+    session: SESSION,
+    generation: refresh,
+    reset: sync.reset,
+    delta: sync.delta,
+  };
+  if (preview) {
+    body.preview = {budget: PREVIEW_BUDGET};
+  }
 
-  const bargs = btoa(JSON.stringify(jsargs));
+  let streamed = null;
+  if (EVENTS.readyState === EventSource.OPEN) {
+    body.stream = true;
+    streamed = new Promise((resolve) => {
+      STREAMING[refresh] = {prepared: null, early: [], finished: null, preview: preview, done: resolve};
+    });
+  }
 
-  const resp = await fetch(genpath + bargs);
+  let resp = null;
+  try {
+    resp = await postChart(body, trace);
+  } catch (err) {
+    console.log("Chart update failed", err);
+  }
+  if (!resp || resp.status !== 200) {
+    delete STREAMING[refresh];
+    return null;
+  }
 
-  let good = true;
+  const js = await resp.json();
+  updateCacheSize(js.cachesize);
 
-  if (resp.status !== 200) { return; }
+  // The server hashed everything; this is how its results map to our ops.
+  const prepared = {};
+  for (const [uuid, result] of Object.entries(js.ops || {})) {
+    prepared[result.hash] = {opcall: calls[uuid], result: result};
+  }
 
-  const js = await resp.json();
+  if (js.status === 'accepted') {
+    // Ops show up through the event stream as they're done.
+    const run = STREAMING[refresh];
+    if (run) {
+      run.prepared = prepared;
+      for (const op of run.early) {
+        showStreamedOp(run, op);
+      }
+      if (run.finished) {
+        finishStream(refresh, run.finished);
+      }
+    }
+    return (await streamed) || {success: 0};
+  }
 
-  if (js.success === 0) {
-    good = false;
+  delete STREAMING[refresh];
+  if (js.status === 'superseded' || js.status === 'resync' || (preview && refresh !== REFRESH_COUNT)) {
+    // Something newer has started. Leave it be.
+  } else {
+    for (const call of Object.values(prepared)) {
+      showOpUpdate(call.opcall, call.result, js.results[call.result.hash],
+                   js.errors[call.result.hash], (js.optimings || {})[call.result.hash]);
+    }
   }
-  updateCacheSize(js.cachesize);
+  return js;
+}
 
-  if (good) {
+// Show the outcome of an op: its new outputs, or a brief error flash.
+// timings, if the server ran it, are seconds per phase.
+function showOpUpdate(opcall, result, success, error, timings) {
+  if (timings) {
+    showOpTimings(result.uuid, timings);
+  }
+  if (success) {
     updateOpResult(opcall, result);
   } else {
-    console.log("Good is false for", opcall);
+    console.log("Good is false for", opcall, error);
     const el = get('#' + result.uuid);
     el.classList.add('block-error');
     setTimeout(() => {
       el.classList.remove('block-error');
     }, 3000);
   }
+}
+
+// Where an op's time went, in its block's title: hover over it to see.
+const TIMING_PHASES = ['decode', 'deps', 'compute', 'encode', 'write'];
+
+function showOpTimings(uuid, timings) {
+  const el = get('#' + uuid);
+  if (!el) return;
+  const parts = [];
+  for (const phase of TIMING_PHASES) {
+    if (timings[phase] === undefined) continue;
+    parts.push(phase + ' ' + (timings[phase] * 1000).toFixed(1) + 'ms');
+  }
+  if (parts.length === 0) return;
+  const head = get('.block-head', el);
+  (head || el).title = parts.join(', ');
+}
 
-  return result;
+// Op blocks only show a small crop of each output, so ask for a rendition
+// about the size it's drawn at rather than the full image. The server snaps
+// the width to one of a few sizes.
+function renditionPath(path, frame) {
+  const scale = window.devicePixelRatio || 1;
+  // Images are drawn by height, so a wide one can overflow its frame.
+  const width = Math.max(frame.clientWidth, frame.clientHeight * 2) * scale;
+  if (!width) return path;
+  return 'rendition/' + path + '?w=' + Math.ceil(width);
+}
+
+// Library and chart images are drawn at about this wide (CSS pixels) before
+// they're in the page to measure. Uploads' renditions come from their
+// pyramid; see applib/uploadstore.py.
+const THUMB_WIDTH = 320;
+
+function thumbPath(path) {
+  return 'rendition/' + path + '?w=' + Math.ceil(THUMB_WIDTH * (window.devicePixelRatio || 1));
 }
 
 // Update the UI of op results.
@@ -515,13 +720,15 @@ function updateOpResult(opcall, result) {
       const imgTpl = template('opout-image', {
         '.opout-image-frame': EL('img', {
           'data-uuid': result.uuid,
+          'data-idx': output.idx,
           class: 'opout-image',
         }),
         '.block-output.op-edge': getProviderElement(opcall, output),
       });
       appendChildren(opOutputs, imgTpl);
       for (img of getAll('img[data-uuid="' + result.uuid + '"]')) {
-        img.src = output.path;
+        img.dataset.full = output.path;
+        img.src = renditionPath(output.path, img.parentElement);
       }
     } else if (output.type === TYPE.complex) {
       easyFetch(output.path, {}, {
@@ -543,3 +750,48 @@ function updateOpResult(opcall, result) {
 
   return;
 }
+
+////////////////////////////////////
+//
+// Video: ops played over a video in the chart, as an MJPEG stream from
+// /cv/video.mjpg. The chart has the video's first frame in it, the stream
+// swaps in each frame in turn.
+//
+////////////////////////////////////
+
+// The same as in videostream.py.
+const VIDEO_RE = /\.(mp4|avi|mov|mkv|webm|m4v|mpg|mpeg)$/i;
+const POSTER_SUFFIX = '.poster.png';
+const VIDEO_STATS_MS = 1000;
+
+function chartHasVideo() {
+  return Object.values(CHART.images).some(
+      (img) => img.path.endsWith(POSTER_SUFFIX) && VIDEO_RE.test(img.path.slice(0, -POSTER_SUFFIX.length)));
+}
+
+function videoStreamPath(uuid, idx) {
+  return '/cv/video.mjpg?session=' + SESSION + '&op=' + uuid + '&idx=' + (idx || 0);
+}
+
+// Show how a floater's video is keeping up in its title, for as long as
+// it's open.
+function watchVideoStats(floater) {
+  const title = get('.name', floater);
+  const name = title.innerText;
+  const large = get('img', floater);
+
+  const timer = setInterval(() => {
+    if (!floater.isConnected) {
+      clearInterval(timer);
+      return;
+    }
+    easyFetch('/cv/videostats?session=' + SESSION, {}, {
+      success: (resp) => {
+        const stats = resp[large.dataset.video];
+        if (!stats) return;
+        title.innerText = name + ' (' + stats.fps + ' / ' + stats.sourcefps + ' fps, ' +
+                          stats.dropped + ' dropped)' + (stats.error ? ' ' + stats.error : '');
+      },
+    });
+  }, VIDEO_STATS_MS);
+}
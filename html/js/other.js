@@ -19,6 +19,12 @@ addTrigger('clearCache', () => {
   });
 });
 
+// Everything this page's requests did, as Chrome trace-event JSON: load it
+// in chrome://tracing or ui.perfetto.dev.
+addTrigger('downloadTrace', () => {
+  window.open('/cv/traces.json?prefix=' + encodeURIComponent(SESSION + '.'));
+});
+
 addInitializer(() => {
   const JSChartEditor = new JSONEditor(EL.chartEditor, {
     mode: 'code',
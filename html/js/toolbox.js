@@ -8,13 +8,19 @@ function rebuildLibrary(paths) {
 
   appendChildren(library, template('library-complex', {}));
 
-  for (const path of paths) {
+  for (let path of paths) {
+    // Videos go in the chart as their first frame. See videostream.py.
+    if (path.endsWith(POSTER_SUFFIX)) continue;
     const name = basename(path);
+    if (VIDEO_RE.test(path)) {
+      path += POSTER_SUFFIX;
+    }
     const pane = template('library-image', (tpl) => {
       const img = get('img', tpl);
       const span = get('span', tpl);
 
-      img.src = path;
+      img.src = thumbPath(path);
+      img.dataset.full = path;
       img.dataset.name = name;
       span.innerText = name;
     });
@@ -98,11 +104,22 @@ addTrigger('showLargeChildImage', function(el) {
   const img = get('img', el);
   let name = el.dataset.name;
   if (!name) { name = img.dataset.name; }
-  showFloater(name, 'large-image', (el) => {
+  const video = img.classList.contains('opout-image') && chartHasVideo();
+  const floater = showFloater(name, 'large-image', (el) => {
     const large = get('img', el);
-    large.src = img.src;
     large.dataset.uuid = img.dataset.uuid;
+    if (video) {
+      // Play the op over the chart's video instead.
+      large.src = videoStreamPath(img.dataset.uuid, img.dataset.idx);
+      large.dataset.video = img.dataset.uuid + '.' + (img.dataset.idx || 0);
+    } else {
+      // Thumbnails are small renditions; the large view wants the original.
+      large.src = img.dataset.full || img.src;
+    }
   });
+  if (video) {
+    watchVideoStats(floater);
+  }
 });
 
 function buildEffectBlock(effect) {
@@ -270,23 +270,3 @@ function deepCopy(...objs) {
   const newobj = Object.assign({}, ...objs);
   return structuredClone(newobj);
 }
-
-// Generate a consistent hash for an object. JSON.stringify isn't consistent
-// in its ordering.
-function hashObject(obj) {
-  const stringValues = [];
-  function add(v) {
-    const ret = [];
-    if (isSafeIterable(v)) {
-      for (const k of Object.keys(v).sort()) {
-        add(k);
-        add(v[k]);
-      }
-    } else {
-      stringValues.push(v)
-    }
-  }
-  add(obj);
-
-  return SparkMD5.hash(stringValues.join('.'));
-}
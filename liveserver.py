@@ -6,21 +6,20 @@
 #
 # Serves up HTML/js/etc, and the backend operations for opencv effects.
 #
-# Additional: Create all the sample images, if they don't exist (spot check
-# latest)
+# Additional: Remake the sample images of any effects that changed since they
+# were made (see applib/imagegen.py). That runs in the background, once the
+# server is taking requests, so startup doesn't wait on it.
 #
-# LATEST_SAMPLE is path to latest sample. In other words, if we manage a new
-# sample generation, change this to that sample.
+# This process never imports cvlib (or opencv): what the page needs of the
+# effect registry comes from applib/registry.py.
 #
 ####################################
 
-LATEST_SAMPLE = 'html/samples/blend.png'
-
 TEMPLATE_BASE = 'index'
 TEMPLATE_DIR = 'templates'
 TEMPLATE_OUT = 'html/index.html'
 
-import os, sys, time, threading, argparse
+import os, sys, time, socket, threading, subprocess, argparse
 from glob import glob
 
 cwd = os.getcwd()
@@ -35,13 +34,27 @@ if cwd not in sys.path:
 
 from applib.flaskapp import app
 
-# Load OpenCV stuff
-from cvlib import EF, INFO
-
 # And routes for OpenCV
 from applib import cveffects
+from applib.util import debug
+
+# Wait for the server to answer on bind:port, then run applib/imagegen.py at
+# low priority. Only in the process that actually serves: with the reloader,
+# that's the child.
+def startSampleBuilder(bind, port):
+    if os.environ.get('WERKZEUG_RUN_MAIN') != 'true':
+        return
 
-from applib.imagegen import rebuildEffectImages
+    def build():
+        for _ in range(300):
+            try:
+                socket.create_connection((bind or 'localhost', port), timeout=1).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+        subprocess.run([sys.executable, '-m', 'applib.imagegen'], preexec_fn=lambda: os.nice(10))
+
+    threading.Thread(target=build, daemon=True).start()
 
 ####################################
 #
@@ -59,16 +72,20 @@ def main():
     # This server.
     parser.add_argument('-b', '--bind', default='localhost', type=str)
     parser.add_argument('-p', '--port', default='8838', type=int)
-    # Effect fork-and-process server
+    # Effect server and its pool of worker processes
     parser.add_argument('-e', '--ebind', default='', type=str)
     parser.add_argument('-f', '--eport', default='8839', type=int)
+    parser.add_argument('-m', '--ecache', default='512', type=int,
+                        help="MB of decoded images the effect server keeps in memory, split between its workers")
+    parser.add_argument('-d', '--edisk', default='2048', type=int,
+                        help="MB of disk the effect server's html/cached/ may use")
+    parser.add_argument('-n', '--eworkers', default=os.cpu_count() or 1, type=int,
+                        help="Number of effect server worker processes (independent graph branches run on them at once)")
     # Launch browser?
     parser.add_argument('-w', '--browser', action='store_true', default=False)
 
     args = parser.parse_args()
 
-    rebuildEffectImages()
-
     if args.browser:
         import webbrowser
         def openBrowser():
@@ -76,13 +93,17 @@ def main():
                 time.sleep(2)
                 webbrowser.open(f"http://{args.bind}:{args.port}", new=1)
             except:
-                debug("Unable to open browser", file=sys.stderr)
+                debug("Unable to open browser")
         browserthread = threading.Thread(target=openBrowser)
         browserthread.start()
 
     try:
-        cveffects.EFLaunchServer(args.ebind, args.eport)
-        app.run(host=args.bind, port=args.port, threaded=True, debug=True, use_reloader=True)
+        cveffects.EFLaunchServer(args.ebind, args.eport, args.ecache, args.eworkers, args.edisk)
+        startSampleBuilder(args.bind, args.port)
+        # cvlib isn't imported here, so tell the reloader to watch it: an
+        # effect changing means new samples.
+        app.run(host=args.bind, port=args.port, threaded=True, debug=True, use_reloader=True,
+                extra_files=glob('cvlib/*.py'))
     except KeyboardInterrupt:
         pass
 
@@ -8,9 +8,9 @@ BASE_PATH = 'html'
 CACHE_DIR = 'cached'
 UPLOAD_DIR = 'uploads'
 
-from threading import Thread
-import os, sys, socket, signal, traceback
-import base64
+from threading import Thread, Lock
+from queue import Queue
+import os, sys, socket, time, traceback
 
 from glob import glob
 
@@ -26,56 +26,826 @@ if cwd not in sys.path:
     sys.path.append(cwd)
 
 from applib.util import ejson, debug
-from cvlib import INFO, Effects, jsApply, cv
-
+from applib.imagecache import ImageCache
+from applib.cacheindex import CacheIndex, INDEX_FILE
+from applib.workerpool import WorkerPool, progress, jobThreads
+from applib.protocol import sendFrame, recvFrame, errorReply
+from applib.batch import addArguments as addBatchArguments, runBatch
+from applib.metrics import Metrics, newPhases
+from applib.tracing import newSpan
+from applib.videostream import VideoStream, makePoster
+from applib.uploadstore import storeKey, rawPath, levelPath, pyramidLevel, isIngested, PYRAMID_MIN
+from cvlib import INFO, Effects, jsApply, cv, tiledApply, canTile
+import numpy as np
+
+# Decoded images, keyed by their path under BASE_PATH (uploads, by path and
+# version). Each worker has its own, sized by configureWorker() to its share
+# of --cache-mb.
+IMAGE_CACHE = ImageCache(512 * 1024 * 1024)
+
+# Sizes, last use and cost of every file in html/cached/. A reaper thread in
+# the server process keeps it under the disk budget set by main().
+CACHE_INDEX = CacheIndex(INDEX_FILE, BASE_PATH)
+
+# Per-effect phase timings and per-request totals, in the server process.
+# Served through /cv/stats; see applib/metrics.py.
+METRICS = Metrics()
+
+def cachekey(filename):
+    return os.path.relpath(filename, BASE_PATH)
+
+def isCacheFile(filename):
+    return cachekey(filename).startswith(CACHE_DIR + '/')
+
+# Image outputs in html/cached/ are named .png everywhere (the browser and
+# the client-side hashing only know those names), but what's stored is a raw
+# .npy next to it: no zlib on the way in or out, and it can be mapped
+# straight into memory. The .png itself is only made when the browser asks
+# for it. Returns None for anything that isn't a cached image.
+def rawpath(filename):
+    root, ext = os.path.splitext(filename)
+    if ext != '.png' or not isCacheFile(filename):
+        return None
+    return root + '.npy'
+
+# Reads check IMAGE_CACHE before touching disk. Cached arrays are read-only
+# and shared, and handed out as they are: jsApply copies for the effects that
+# draw on their input (see 'buffers' in cvlib/effects.py), and anything else
+# that tries to write to one gets an error rather than corrupting it.
+#
+# Uploads that have been through the store (see applib/uploadstore.py) are
+# mapped from their decoded copy too, as is any .npy asked for by name.
 def cvread(filename):
     if filename.endswith('.json'):
         with open(filename, 'r', encoding='utf-8') as fin:
             return ejson.load(fin)
-    # filename passed around is .png. Convert to .tiff
-    return cv.imread(filename, cv.IMREAD_UNCHANGED)
-
-def cvwrite(img, filename):
+    if filename.endswith('.npy'):
+        return np.load(filename, mmap_mode='c')
+
+    key = cachekey(filename)
+    raw = rawpath(filename)
+    stored = None if raw else storeKey(filename)
+    if raw:
+        CACHE_INDEX.touch(cachekey(raw))
+    elif stored and isIngested(BASE_PATH, stored):
+        return np.load(rawPath(BASE_PATH, stored), mmap_mode='c')
+    elif not isCacheFile(filename):
+        # Uploads can be replaced under the same name: key them by version.
+        try:
+            st = os.stat(filename)
+            key = f"{key}@{st.st_mtime_ns}:{st.st_size}"
+        except OSError:
+            pass
+
+    img = IMAGE_CACHE.get(key)
+    if img is not None:
+        return img
+
+    # A copy-on-write mapping: no decode and no copy up front, and an effect
+    # that draws on its input only dirties private pages.
+    if raw and os.path.exists(raw):
+        return np.load(raw, mmap_mode='c')
+
+    img = cv.imread(filename, cv.IMREAD_UNCHANGED)
+    IMAGE_CACHE.put(key, img)
+    return img
+
+# Writes go to a temporary name first and are then renamed into place, so
+# nobody checking the cache ever sees a half-written output. Cache files get
+# indexed, with 'cost' (seconds it took to make) plus however long the write
+# itself took.
+TMP_TAG = '.tmp'
+
+# Clear away anything a killed worker was halfway through writing.
+def removePartials(pid):
+    for tmpname in glob(f"{BASE_PATH}/{CACHE_DIR}/*.{pid}{TMP_TAG}*"):
+        try:
+            os.remove(tmpname)
+        except OSError:
+            pass
+
+def tmpName(filename):
+    root, ext = os.path.splitext(filename)
+    return f"{root}.{os.getpid()}{TMP_TAG}{ext}"
+
+def replaceInto(filename, write, cost=0.0):
+    start = time.monotonic()
+    tmpname = tmpName(filename)
+    ret = write(tmpname)
+    os.replace(tmpname, filename)
+    if isCacheFile(filename):
+        CACHE_INDEX.record(cachekey(filename), cost + time.monotonic() - start)
+    return ret
+
+def writeBytes(tmpname, data):
+    with open(tmpname, 'wb') as fout:
+        fout.write(data)
+    return True
+
+# Encoding and writing are timed apart, and added to 'phases' if given.
+def cvwrite(img, filename, cost=0.0, phases=None):
+    start = time.monotonic()
+    raw = None
     if filename.endswith('.json'):
-        with open(filename, 'w', encoding='utf-8') as fout:
-            return ejson.dump(img, fout)
-    return cv.imwrite(filename, img)
-
-def cleanchild(*args):
-    os.wait()
-
-# Generate an opencv image, using passed parameters.
-def handle(client):
-    # Parse input for args.
-    try:
-        b64input = client.recv(16384)
-
-        jsobj = ejson.loads(base64.b64decode(b64input))
-
-        effect = jsobj['effect']
-        args = jsobj['args']
+        data = bytes(ejson.dumps(img), 'utf-8')
+    else:
+        # Tiled outputs are already on disk, and too big to keep.
+        if not isinstance(img, np.memmap):
+            IMAGE_CACHE.put(cachekey(filename), img)
+        # Raw outputs are saved as they are: nothing to encode.
+        raw = rawpath(filename)
+        if not raw:
+            ok, data = cv.imencode(os.path.splitext(filename)[1], img)
+            if not ok:
+                raise ValueError(f"Unable to encode {filename}")
+    encoded = time.monotonic()
+
+    cost += encoded - start
+    if raw and isinstance(img, np.memmap) and img.filename == os.path.abspath(tmpName(raw)):
+        ret = replaceInto(raw, lambda tmpname: img.flush() or True, cost)
+    elif raw:
+        ret = replaceInto(raw, lambda tmpname: np.save(tmpname, img) or True, cost)
+    else:
+        ret = replaceInto(filename, lambda tmpname: writeBytes(tmpname, data), cost)
+
+    if phases is not None:
+        phases['encode'] += encoded - start
+        phases['write'] += time.monotonic() - encoded
+    return ret
+
+# Previews are rewritten under the same name at whatever scale each run
+# picks (see runGraph), so what was made from the last one (its .png and
+# renditions) has to go: it'd be made again, from the new one, when asked.
+def dropDerived(filename):
+    root = filename[:-len('.png')]
+    for path in [filename] + glob(f"{root}.w*.png"):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            continue
+        CACHE_INDEX.forget(cachekey(path))
+
+# Make the browser-facing .png for a cached image output.
+def encodePNG(filename):
+    start = time.monotonic()
+    img = cvread(filename)
+    return replaceInto(filename, lambda tmpname: cv.imwrite(tmpname, img),
+                       time.monotonic() - start)
+
+# A .png of a cached image, scaled down to 'width' if it's any wider.
+# Stored uploads start from their pyramid.
+def renderPNG(source, filename, width):
+    start = time.monotonic()
+    img = cvread(source)
+    height, full = img.shape[:2]
+    if full > width:
+        img = cv.resize(storedLevel(source, width / full, img), (width, max(1, round(height * width / full))),
+                        interpolation=cv.INTER_AREA)
+    return replaceInto(filename, lambda tmpname: cv.imwrite(tmpname, img),
+                       time.monotonic() - start)
+
+# Decode an upload once, into the store: each pyramid level, halving until
+# it's no more than PYRAMID_MIN across, then the full image, which says it's
+# done. See applib/uploadstore.py.
+def ingestUpload(filename):
+    key = storeKey(filename)
+    if key is None:
+        raise ValueError(f"{cachekey(filename)} isn't in the upload store")
+    full = cv.imread(filename, cv.IMREAD_UNCHANGED)
+    if full is None:
+        raise ValueError(f"Unable to decode {cachekey(filename)}")
+
+    img = full
+    level = 0
+    while max(img.shape[:2]) > PYRAMID_MIN:
+        level += 1
+        height, width = img.shape[:2]
+        img = cv.resize(img, (max(1, width // 2), max(1, height // 2)), interpolation=cv.INTER_AREA)
+        replaceInto(levelPath(BASE_PATH, key, level), lambda tmpname: np.save(tmpname, img) or True)
+    replaceInto(rawPath(BASE_PATH, key), lambda tmpname: np.save(tmpname, full) or True)
+    return level
+
+# The smallest pyramid level of a stored upload that's at least 'scale' of
+# it, mapped; or 'img' (the full image) if there isn't one.
+def storedLevel(filename, scale, img):
+    key = storeKey(filename)
+    found = pyramidLevel(BASE_PATH, key, scale) if key else None
+    return np.load(found[1], mmap_mode='c') if found else img
+
+# Is an output (named as the browser names it) on disk, in either form?
+def isOnDisk(path):
+    filename = f"{BASE_PATH}/{path}"
+    raw = rawpath(filename)
+    return os.path.exists(filename) or (raw is not None and os.path.exists(raw))
+
+# Mark a request's outputs as used, for the reaper.
+def touchOutputs(jsobj):
+    if 'graph' in jsobj:
+        for call in jsobj['graph']:
+            touchOutputs(call)
+        return
+    for out in jsobj.get('outputs', []):
+        filename = f"{BASE_PATH}/{out['path']}"
+        CACHE_INDEX.touch(cachekey(rawpath(filename) or filename))
 
-        if 'dependencies' in jsobj:
-            for k, v in jsobj['dependencies'].items():
-                print(v)
-                path = f"{BASE_PATH}/{v}"
-                print(f"{k}: {path}")
-                args[k] = cvread(path)
-        
+# Output paths are content-addressed: the client hashes effect, args and
+# dependencies into the filename. If they're all on disk already, there's
+# nothing left to do.
+#
+# Except for previews: their names don't say what scale they were made at,
+# and that changes from run to run (see previewScale), so a preview graph
+# is always run.
+def isCached(jsobj):
+    if 'video' in jsobj:
+        return False
+    if 'poster' in jsobj:
+        return os.path.exists(f"{BASE_PATH}/{jsobj['poster']}")
+    if 'ingest' in jsobj:
+        key = storeKey(f"{BASE_PATH}/{jsobj['ingest']}")
+        return key is not None and isIngested(BASE_PATH, key)
+    if 'encode' in jsobj:
+        return os.path.exists(f"{BASE_PATH}/{jsobj['encode']}")
+    if 'rendition' in jsobj:
+        return os.path.exists(f"{BASE_PATH}/{jsobj['rendition']}")
+    if 'graph' in jsobj:
+        return not jsobj.get('preview') and all(isCached(call) for call in jsobj['graph'])
+    return all(isOnDisk(out['path']) for out in jsobj['outputs'])
+
+####################################
+#
+# Preview mode: while a slider is being dragged, a graph can be run on
+# scaled-down copies of its inputs, picked so the whole run should fit in
+# a time budget. How long each effect takes per megapixel is learned from
+# every op that runs (OP_COSTS goes back with each reply, and the server
+# process keeps the averages in EFFECT_COSTS).
+#
+####################################
+
+# (effect, seconds, megapixels, phases) of the ops this worker ran for the
+# current request. phases is how long each part of the op took; see
+# applib/metrics.py.
+OP_COSTS = []
+
+# Spans recorded for the current request, if it's being traced; see
+# applib/tracing.py. They go back with the reply.
+TRACE = None
+SPANS = []
+
+def addSpan(name, start, end=None, **args):
+    if TRACE:
+        SPANS.append(newSpan(name, start, end or time.time(), f"worker {os.getpid()}", 'worker', **args))
+
+# Seconds per megapixel we assume for an effect we haven't timed yet.
+DEFAULT_COST = 0.02
+# Never scale previews below this.
+MIN_PREVIEW_SCALE = 0.05
+
+# Lives in the server process: running averages of seconds per megapixel.
+class EffectCosts(object):
+    def __init__(self, weight=0.3):
+        self.weight = weight
+        self.costs = dict()
+        self.lock = Lock()
+
+    def record(self, effect, seconds, mp):
+        if mp <= 0: return
+        rate = seconds / mp
+        with self.lock:
+            old = self.costs.get(effect)
+            self.costs[effect] = rate if old is None else old + self.weight * (rate - old)
+
+    def table(self):
+        with self.lock:
+            return dict(self.costs)
+
+EFFECT_COSTS = EffectCosts()
+
+def megapixels(values):
+    sizes = [v.shape[0] * v.shape[1] for v in values
+             if isinstance(v, np.ndarray) and v.ndim >= 2]
+    return max(sizes, default=0) / 1e6
+
+# The scale that should bring a graph in under budget seconds, given its
+# largest input is mp megapixels. Cost goes with area, hence the sqrt.
+def previewScale(calls, mp, costs, budget):
+    estimate = mp * sum(costs.get(call['effect'], DEFAULT_COST) for call in calls)
+    if estimate <= budget:
+        return 1.0
+    return max(MIN_PREVIEW_SCALE, (budget / estimate) ** 0.5)
+
+# 'img' at 'scale'. 'source', if given, is a smaller copy to resize from
+# instead (a pyramid level).
+def scaleImage(img, scale, source=None):
+    if scale >= 1.0 or not isinstance(img, np.ndarray) or img.ndim < 2:
+        return img
+    height, width = img.shape[:2]
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    return cv.resize(img if source is None else source, size, interpolation=cv.INTER_AREA)
+
+# Intermediates are shared by every op that reads them, the same way cached
+# images are; see cvread.
+def readOnly(img):
+    if isinstance(img, np.ndarray):
+        img = img.view()
+        img.flags.writeable = False
+    return img
+
+# Images at least this big (megapixels) are run tile by tile, when the
+# effect can be, straight into their .npy in html/cached/: memory goes with
+# the tile size, not the image. See cvlib/tiled.py. Set by main().
+TILE_MIN_MP = 64
+
+# An alloc for tiledApply: the output, mapped from where cvwrite will look
+# for it.
+def mappedOutput(filename):
+    def alloc(shape, dtype):
+        return np.lib.format.open_memmap(tmpName(rawpath(filename)), mode='w+', shape=shape, dtype=dtype)
+    return alloc
+
+# Run a single op. 'loaded' is a dict of path->image of dependencies we already
+# have in memory (from a graph run). Anything not in it is read from disk.
+#
+# Returns (pairs, phases): a list of (output, result) pairs, one per output,
+# and seconds spent in each phase.
+def runOp(jsobj, loaded=None):
+    if loaded is None: loaded = dict()
+    args = jsobj['args']
+    phases = newPhases()
+    began = time.time()
+
+    if 'dependencies' in jsobj:
+        for k, v in jsobj['dependencies'].items():
+            depstart = time.monotonic()
+            if v in loaded:
+                args[k] = loaded[v]
+            else:
+                args[k] = cvread(f"{BASE_PATH}/{v}")
+            phases['decode' if v.endswith('.json') else 'deps'] += time.monotonic() - depstart
+
+    start = time.monotonic()
+    computing = time.time()
+    addSpan('deps', began, computing, decode = phases['decode'], deps = phases['deps'])
+    outs = jsobj['outputs']
+    tiled = len(outs) == 1 and rawpath(f"{BASE_PATH}/{outs[0]['path']}") is not None and \
+            megapixels(args.values()) >= TILE_MIN_MP and canTile(jsobj['effect'], args)
+    if tiled:
+        # The job's cores go to tiles instead: one opencv thread each.
+        cv.setNumThreads(1)
+        try:
+            results = tiledApply(jsobj['effect'], args, threads=jobThreads(),
+                                 alloc=mappedOutput(f"{BASE_PATH}/{outs[0]['path']}"))
+        finally:
+            cv.setNumThreads(jobThreads())
+    else:
         results = jsApply(jsobj['effect'], args)
+    phases['compute'] = time.monotonic() - start
+    writing = time.time()
+    addSpan(jsobj['effect'], computing, writing, hash = jsobj.get('hash', ''), tiled = int(tiled))
 
-        outs = jsobj['outputs']
+    if len(outs) > 1:
+        pairs = list(zip(outs, results))
+    else:
+        pairs = [(outs[0], results)]
+
+    computed = (time.monotonic() - start) / len(pairs)
+    for out, result in pairs:
+        cvwrite(result, f"{BASE_PATH}/{out['path']}", computed, phases)
+        if out['path'].endswith('.preview.png'):
+            dropDerived(f"{BASE_PATH}/{out['path']}")
+    addSpan('write', writing, encode = phases['encode'], write = phases['write'])
+
+    # Writing the output scales with the image too, so it counts.
+    OP_COSTS.append((jsobj['effect'], time.monotonic() - start, megapixels(args.values()), phases))
+
+    return pairs, phases
+
+# Order a graph's calls so every call comes after the calls that produce its
+# dependencies. Dependencies not produced inside the graph (uploads, or
+# outputs cached from earlier runs) are read from disk as usual.
+def sortGraph(calls):
+    producers = dict()
+    for call in calls:
+        for out in call['outputs']:
+            producers[out['path']] = call['hash']
+
+    byhash = dict((call['hash'], call) for call in calls)
+    ordered = []
+    state = dict()
+
+    def visit(call):
+        mark = state.get(call['hash'])
+        if mark == 'done': return
+        if mark == 'visiting':
+            raise ValueError(f"Loop in graph at {call['effect']}")
+        state[call['hash']] = 'visiting'
+        for dep in call.get('dependencies', {}).values():
+            if dep in producers:
+                visit(byhash[producers[dep]])
+        state[call['hash']] = 'done'
+        ordered.append(call)
+
+    for call in calls:
+        visit(call)
+
+    return ordered
+
+# Run a whole chart's worth of ready ops in one go. Intermediates stay in
+# memory as ndarrays and are dropped as soon as their last consumer has run.
+# Every output is still written to html/cached/ for the browser. Ops whose
+# outputs are already cached are skipped; anything downstream of them reads
+# those from disk.
+#
+# With 'preview' (dict(budget=seconds)), the images the graph starts from
+# are read up front and scaled down to fit the budget; see previewScale.
+# Every op runs, cached or not, so they're all at the same scale.
+#
+# With 'stream', each op's outcome is also sent as progress as soon as it's
+# known, so the browser can show it before the rest of the graph is done.
+#
+# Returns (results, cached, errors, scale, timings): results and cached are
+# dict(hash: 1 or 0), errors is dict(hash: message) for those that failed,
+# and timings is dict(hash: phases) for those that ran. An op fails if it
+# raises, or if anything it depends on failed.
+def runGraph(calls, preview=None, costs=None, stream=False):
+    ordered = sortGraph(calls)
+
+    # How many ops still want each in-graph output.
+    consumers = dict()
+    for call in ordered:
+        for dep in call.get('dependencies', {}).values():
+            consumers[dep] = consumers.get(dep, 0) + 1
+
+    loaded = dict()
+    scale = 1.0
+    if preview:
+        produced = set(out['path'] for call in ordered for out in call['outputs'])
+        for dep in consumers:
+            if dep not in produced and not dep.endswith('.json'):
+                loaded[dep] = cvread(f"{BASE_PATH}/{dep}")
+        scale = previewScale(ordered, megapixels(loaded.values()), costs or {}, preview['budget'])
+        for dep, img in loaded.items():
+            if scale < 1.0 and isinstance(img, np.ndarray):
+                loaded[dep] = scaleImage(img, scale, storedLevel(f"{BASE_PATH}/{dep}", scale, img))
+
+    failed = set()
+    results = dict()
+    cached = dict()
+    errors = dict()
+    timings = dict()
+
+    for call in ordered:
+        deps = call.get('dependencies', {}).values()
+        cached[call['hash']] = int(not preview and isCached(call))
+        try:
+            if any(dep in failed for dep in deps):
+                raise ValueError(f"{call['effect']}: a dependency failed")
+            if not cached[call['hash']]:
+                pairs, timings[call['hash']] = runOp(call, loaded)
+                for out, result in pairs:
+                    if consumers.get(out['path'], 0) > 0:
+                        loaded[out['path']] = readOnly(result)
+            results[call['hash']] = 1
+        except Exception as err:
+            # Bad args come by the dozen while a slider's dragged: one line.
+            print(f"error in {call['effect']}: {err}")
+            for out in call['outputs']:
+                failed.add(out['path'])
+            results[call['hash']] = 0
+            errors[call['hash']] = str(err)
+
+        # Let flask pass each op on to the browser as soon as it's done.
+        if stream:
+            progress(dict(hash = call['hash'], success = results[call['hash']],
+                          cached = cached[call['hash']], error = errors.get(call['hash'], ''),
+                          timings = timings.get(call['hash'], {})))
+
+        for dep in deps:
+            consumers[dep] -= 1
+            if consumers[dep] == 0:
+                loaded.pop(dep, None)
+
+    return results, cached, errors, scale, timings
+
+# Play a chart over a video (see applib/videostream.py), sending each JPEG
+# back as progress, with how the stream's keeping up. Runs until it fails,
+# or until it's superseded and this worker with it.
+def streamVideo(video):
+    stream = VideoStream(video['calls'], video['images'], video['show'], video.get('idx', 0))
+    try:
+        error = stream.start()
+        if not error:
+            for jpeg in stream.jpegs():
+                progress(dict(blob = jpeg, stats = stream.stats()))
+            error = stream.error or "Video stream stopped"
+    finally:
+        stream.stop()
+    return dict(status = 'error', success = 0, cached = 0, error = error)
+
+# Generate an opencv image (or a whole graph of them), using passed
+# parameters. Returns the reply sent back to flask.
+def handle(jsobj):
+    global TRACE
+    TRACE = jsobj.get('trace')
+    began = time.time()
+    start = time.monotonic()
+    timings = dict()
+    optimings = None
+    try:
+        if 'ingest' in jsobj:
+            levels = ingestUpload(f"{BASE_PATH}/{jsobj['ingest']}")
+            reply = dict(status = 'ok', success = 1, cached = 0, error = '', levels = levels)
+        elif 'video' in jsobj:
+            reply = streamVideo(jsobj['video'])
+        elif 'poster' in jsobj:
+            if not makePoster(jsobj['poster']):
+                raise ValueError(f"Unable to read {jsobj['poster']}")
+            reply = dict(status = 'ok', success = 1, cached = 0, error = '')
+        elif 'encode' in jsobj:
+            encodePNG(f"{BASE_PATH}/{jsobj['encode']}")
+            reply = dict(status = 'ok', success = 1, cached = 0, error = '')
+        elif 'rendition' in jsobj:
+            renderPNG(f"{BASE_PATH}/{jsobj['source']}", f"{BASE_PATH}/{jsobj['rendition']}",
+                      jsobj['width'])
+            reply = dict(status = 'ok', success = 1, cached = 0, error = '')
+        elif 'graph' in jsobj:
+            results, cached, errors, scale, optimings = runGraph(jsobj['graph'], jsobj.get('preview'),
+                                                                 jsobj.get('costs'), jsobj.get('stream'))
+            success = int(all(results.values()))
+            reply = dict(
+                status = 'ok' if success else 'error',
+                success = success,
+                results = results,
+                cached = cached,
+                errors = errors,
+                error = '; '.join(errors.values()),
+                scale = scale,
+            )
+        else:
+            pairs, timings = runOp(jsobj)
+            reply = dict(status = 'ok', success = 1, cached = 0, error = '')
+    except Exception as err:
+        print(f"error in {jsobj.get('effect', 'request')}: {err}")
+        reply = dict(status = 'error', success = 0, cached = 0, error = str(err))
+
+    # A single op's timings are its phases. A graph's are per op, by hash.
+    reply['timings'] = dict(timings, handle = time.monotonic() - start)
+    if optimings is not None:
+        reply['optimings'] = optimings
+    reply['imagecache'] = IMAGE_CACHE.stats()
+    reply['opcosts'] = OP_COSTS[:]
+    OP_COSTS.clear()
+    if TRACE:
+        addSpan('handle', began, ops = len(jsobj.get('graph', [jsobj])), threads = jobThreads())
+        reply['spans'] = SPANS[:]
+    SPANS.clear()
+    return reply
+
+# A request whose outputs all exist gets answered by the server process
+# itself: no worker, no compute.
+def cachedReply(jsobj):
+    touchOutputs(jsobj)
+    if 'graph' in jsobj:
+        hits = dict((call['hash'], 1) for call in jsobj['graph'])
+        return dict(status = 'ok', success = 1, results = hits, cached = hits,
+                    errors = {}, error = '', timings = {})
+    return dict(status = 'ok', success = 1, cached = 1, error = '', timings = {})
+
+# Jobs can carry a session (one per page load) and a generation (which
+# refresh of that page they came from). A newer generation supersedes older
+# ones for the same session and target: a whole chart for graph jobs, one op
+# otherwise. Untagged jobs always run.
+def supersedeKey(jsobj):
+    session = jsobj.get('session')
+    if not session:
+        return None, 0
+    target = 'graph' if 'graph' in jsobj else jsobj.get('op', jsobj.get('hash'))
+    return (session, target), jsobj.get('generation', 0)
+
+def supersededReply():
+    return dict(status = 'superseded', success = 0, cached = 0, error = 'Superseded by a newer request',
+                results = {}, errors = {}, timings = {})
+
+# What kind of request a job is, for METRICS.
+def requestKind(jsobj):
+    for kind in ('graph', 'encode', 'rendition', 'ingest', 'poster', 'video'):
+        if kind in jsobj:
+            return 'preview' if kind == 'graph' and jsobj.get('preview') else kind
+    return 'op'
+
+# Everything /cv/stats shows.
+def statsReply(pool):
+    return dict(status = 'ok', success = 1, cached = 0, error = '', timings = {},
+                stats = dict(METRICS.snapshot(), pool = pool.stats(),
+                             cache = dict(files = CACHE_INDEX.count(), bytes = CACHE_INDEX.bytes())))
+
+def serveRequest(client, wlock, header, pool):
+    start = time.monotonic()
+    began = time.time()
+    job = header.get('job')
+    kind = None
+    fromcache = False
+    spans = []
+
+    def forward(msg):
+        blob = msg.pop('blob', b'')
+        try:
+            with wlock:
+                sendFrame(client, dict(id = header.get('id'), progress = msg), blob)
+        except OSError:
+            pass
 
-        if len(outs) > 1:
-            for out, result in zip(outs, results):
-                cvwrite(result, 'html/' + out['path'])
+    try:
+        if job.get('stats'):
+            reply = statsReply(pool)
+        elif job.get('cancel'):
+            # Stops anything older for the same session and target: a video
+            # stream, say, once nobody's watching it.
+            pool.supersede(*supersedeKey(job))
+            reply = dict(status = 'ok', success = 1, cached = 0, error = '', timings = {})
+        elif isCached(job):
+            spans.append(newSpan('cache check', began, time.time(), 'runeffect', hit = 1))
+            kind = requestKind(job)
+            fromcache = True
+            pool.supersede(*supersedeKey(job))
+            reply = cachedReply(job)
         else:
-            cvwrite(results, 'html/' + outs[0]['path'])
-        return True
+            spans.append(newSpan('cache check', began, time.time(), 'runeffect', hit = 0))
+            kind = requestKind(job)
+            onprogress = forward if job.get('stream') else None
+            if job.get('preview'):
+                job['costs'] = EFFECT_COSTS.table()
+                done = pool.submit(job, *supersedeKey(job), onprogress=onprogress)
+                reply, waited = done.reply, done.waited
+            elif 'graph' in job:
+                reply, waited = runChains(job, pool, onprogress)
+            else:
+                done = pool.submit(job, *supersedeKey(job), onprogress=onprogress)
+                reply, waited = done.reply, done.waited
+            reply['timings']['queue'] = waited
     except Exception as err:
-        print("error")
         print(traceback.format_exc())
-        return False
+        reply = errorReply(f"Malformed request: {err}")
+
+    for effect, seconds, mp, phases in reply.pop('opcosts', []):
+        EFFECT_COSTS.record(effect, seconds, mp)
+        METRICS.effect(effect, phases)
+
+    reply['id'] = header.get('id')
+    reply['timings']['total'] = time.monotonic() - start
+    if kind and reply.get('status') != 'superseded':
+        METRICS.request(kind, reply['timings']['total'], fromcache)
+    if job and job.get('trace'):
+        spans.append(newSpan(f"{kind} request", began, time.time(), 'runeffect',
+                             status = reply.get('status'), queue = reply['timings'].get('queue', 0.0)))
+        reply['spans'] = spans + reply.get('spans', [])
+    try:
+        with wlock:
+            sendFrame(client, reply)
+    except OSError:
+        pass
+
+####################################
+#
+# Independent branches of a graph run on different workers at once.
+#
+# The graph is cut into chains: runs of ops where each feeds only the next,
+# and the next is fed only by it. A chain runs start to finish on one worker
+# with its intermediates in memory, as runGraph does. A chain that needs
+# another chain's output waits until that's done, then reads it from its
+# .npy in html/cached/ (mmapped, so no decoding). Chains that don't need each
+# other are in the pool at the same time, so a chart with four branches
+# takes about as long as its longest one.
+#
+# Previews still run in one go: their scale is picked for the whole graph.
+#
+####################################
+
+# Returns (chains, needs): chains is a list of lists of calls, in order;
+# needs[i] is the set of chains that chain i reads outputs of.
+def splitChains(calls):
+    ordered = sortGraph(calls)
+    producers = dict()
+    for call in ordered:
+        for out in call['outputs']:
+            producers[out['path']] = call['hash']
+
+    parents = dict()
+    children = dict((call['hash'], set()) for call in ordered)
+    for call in ordered:
+        parents[call['hash']] = set(producers[dep] for dep in call.get('dependencies', {}).values()
+                                    if dep in producers)
+        for parent in parents[call['hash']]:
+            children[parent].add(call['hash'])
+
+    chains = []
+    chainof = dict()
+    for call in ordered:
+        ps = parents[call['hash']]
+        if len(ps) == 1:
+            parent, = ps
+            chain = chainof[parent]
+            if len(children[parent]) == 1 and chains[chain][-1]['hash'] == parent:
+                chains[chain].append(call)
+                chainof[call['hash']] = chain
+                continue
+        chainof[call['hash']] = len(chains)
+        chains.append([call])
+
+    needs = [set(chainof[parent] for parent in parents[chain[0]['hash']]) for chain in chains]
+    return chains, needs
+
+# Run a graph job as chains on the pool. Returns a reply shaped like a
+# single worker's, and the longest any chain waited in the queue.
+def runChains(job, pool, onprogress=None):
+    chains, needs = splitChains(job['graph'])
+    if len(chains) < 2:
+        done = pool.submit(job, *supersedeKey(job), onprogress=onprogress)
+        return done.reply, done.waited
+
+    finished = Queue()
+    def runChain(idx):
+        subjob = dict(job, graph = chains[idx])
+        finished.put((idx, pool.submit(subjob, *supersedeKey(job), onprogress=onprogress)))
+
+    results, cached, errors, optimings = dict(), dict(), dict(), dict()
+    opcosts, spans = [], []
+    handled, waited = 0.0, 0.0
+    imagecache = None
+    superseded = False
+
+    started, done, failed = set(), set(), set()
+    while len(done) < len(chains):
+        for idx in range(len(chains)):
+            if idx in started or not needs[idx] <= done: continue
+            started.add(idx)
+            # Anything downstream of a failed op fails without running.
+            if superseded or needs[idx] & failed:
+                for call in chains[idx]:
+                    results[call['hash']] = 0
+                    cached[call['hash']] = 0
+                    errors[call['hash']] = f"{call['effect']}: a dependency failed"
+                    if onprogress and not superseded:
+                        onprogress(dict(hash = call['hash'], success = 0, cached = 0,
+                                        error = errors[call['hash']], timings = {}))
+                failed.add(idx)
+                finished.put((idx, None))
+            else:
+                Thread(target=runChain, args=(idx,), daemon=True).start()
+
+        idx, sub = finished.get()
+        done.add(idx)
+        if sub is None: continue
+
+        reply = sub.reply
+        waited = max(waited, sub.waited)
+        if reply.get('status') == 'superseded':
+            superseded = True
+            continue
+        results.update(reply.get('results', {}))
+        cached.update(reply.get('cached', {}))
+        errors.update(reply.get('errors', {}))
+        optimings.update(reply.get('optimings', {}))
+        opcosts.extend(reply.get('opcosts', []))
+        spans.extend(reply.get('spans', []))
+        handled += reply.get('timings', {}).get('handle', 0.0)
+        imagecache = reply.get('imagecache', imagecache)
+        if not reply.get('success'):
+            failed.add(idx)
+
+    if superseded:
+        return supersededReply(), waited
+
+    success = int(all(results.values()))
+    return dict(
+        status = 'ok' if success else 'error',
+        success = success,
+        results = results,
+        cached = cached,
+        errors = errors,
+        error = '; '.join(errors.values()),
+        scale = 1.0,
+        timings = dict(handle = handled),
+        optimings = optimings,
+        imagecache = imagecache,
+        opcosts = opcosts,
+        spans = spans,
+    ), waited
+
+# Each connection gets a thread in the server process, reading frames off
+# it. Every request on it gets a thread of its own, so they can be in flight
+# together; those only check the cache and wait on the pool. Workers do the
+# actual opencv work.
+def serveClient(client, pool):
+    wlock = Lock()
+    try:
+        while True:
+            frame = recvFrame(client)
+            if frame is None: break
+            header, blob = frame
+            Thread(target=serveRequest, args=(client, wlock, header, pool), daemon=True).start()
+    except (OSError, ValueError):
+        pass
+    client.close()
 
 RUNNING = True
 RESTART = False
@@ -118,10 +888,20 @@ def startWatcher(bind, port):
     s.close()
 
 
-def main(bind, port, test=False):
+# Run in each worker before its first job: workers come from the pool's
+# forkserver, not from this process, so they don't see what main() set.
+def configureWorker(cachebudget, tilemp):
+    global TILE_MIN_MP
+    IMAGE_CACHE.budget = cachebudget
+    TILE_MIN_MP = tilemp
+
+def main(bind, port, test=False, cachemb=512, workers=4, diskmb=2048, tilemp=TILE_MIN_MP, cores=None):
     global RUNNING
     global RESTART
-    signal.signal(signal.SIGCHLD, cleanchild)
+    global TILE_MIN_MP
+
+    IMAGE_CACHE.budget = cachemb * 1024 * 1024
+    TILE_MIN_MP = tilemp
 
     try:
         server = socket.socket()
@@ -133,44 +913,47 @@ def main(bind, port, test=False):
         print("No worries, exiting..")
         return
 
+    if test:
+        client, addr = server.accept()
+        frame = recvFrame(client)
+        if frame is not None:
+            header, blob = frame
+            reply = handle(header['job'])
+            reply['id'] = header.get('id')
+            sendFrame(client, reply)
+        client.close()
+        server.close()
+        return
+
+    # The workers share 'cores' between them, and set opencv's threads to
+    # their job's share. Each has its own image cache: they split the budget.
+    pool = WorkerPool(workers, handle, failure=lambda: errorReply("Worker died"),
+                      superseded=supersededReply, onexit=removePartials,
+                      cores=cores, onthreads=cv.setNumThreads,
+                      initializer=configureWorker, initargs=(IMAGE_CACHE.budget // workers, TILE_MIN_MP))
+    pool.start()
+    print(f"Started {workers} workers sharing {pool.budget.cores} cores.")
+
+    CACHE_INDEX.sync(f"{CACHE_DIR}/*")
+    CACHE_INDEX.startReaper(diskmb * 1024 * 1024)
+
     if (inotify.adapters):
         thread = Thread(target=startWatcher, args=(bind, port))
         thread.start()
 
     try:
-    
-        success = bytes('1', 'utf-8')
-        failure = bytes('0', 'utf-8')
         while RUNNING:
             client, addr = server.accept()
-            if test:
-                handle(client)
-                client.close()
-                return
-            kid = os.fork()
-            if kid == 0:
-                server.close()
-                try:
-                    if handle(client):
-                        client.send(success)
-                    else:
-                        client.send(failure)
-                    client.shutdown(socket.SHUT_WR)
-                    client.close()
-                except Exception as err:
-                    client.send(failure)
-                    client.shutdown(socket.SHUT_WR)
-                    client.close()
-                sys.exit(0)
-            # Close parent's copy.
-            client.close()
+            Thread(target=serveClient, args=(client, pool), daemon=True).start()
     except KeyboardInterrupt as kbe:
         RUNNING=False
+        pool.stop()
         stopWatcher()
         if (inotify.adapters):
             thread.join()
         sys.exit(0)
 
+    pool.stop()
     server.close()
     if (inotify.adapters):
         thread.join()
@@ -178,23 +961,51 @@ def main(bind, port, test=False):
 
 
 if __name__ == '__main__':
-    cmd, opt, bind, port = sys.argv[:4]
-    test = False
-    if len(sys.argv) > 4 and sys.argv[4] == 'test':
-        test = True
-    if opt == 'detach':
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog=sys.argv[0],
+        description="The opencvlive effect server.",
+    )
+    subparsers = parser.add_subparsers(dest='opt', required=True)
+
+    server = argparse.ArgumentParser(add_help=False)
+    server.add_argument('bind', type=str)
+    server.add_argument('port', type=int)
+    server.add_argument('test', nargs='?', choices=['test'])
+    # Memory budget, in MB, for decoded images kept between ops: all the
+    # workers' caches together.
+    server.add_argument('--cache-mb', default=512, type=int)
+    # How many long-lived worker processes run effects.
+    server.add_argument('--workers', default=4, type=int)
+    # Disk budget, in MB, for html/cached/.
+    server.add_argument('--disk-mb', default=2048, type=int)
+    # Images this many megapixels or more run tile by tile, where they can.
+    server.add_argument('--tile-mp', default=TILE_MIN_MP, type=float)
+    # Cores the workers share (default: all of them).
+    server.add_argument('--cores', type=int)
+    subparsers.add_parser('detach', parents=[server])
+    subparsers.add_parser('run', parents=[server])
+
+    # Run a saved chart over a directory of images. See applib/batch.py.
+    addBatchArguments(subparsers.add_parser('batch', help="Run a chart over a directory of images"))
+
+    cmd = sys.argv[0]
+    args = parser.parse_args()
+
+    if args.opt == 'detach':
         # Detach from parent process.
         kid = os.fork()
         if kid == 0:
             os.execv(cmd, [cmd, 'run'] + sys.argv[2:])
         sys.exit(0)
-    elif opt == 'run':
-        port = int(port)
-        main(bind, port, test=test)
+    elif args.opt == 'batch':
+        sys.exit(runBatch(args))
+    elif args.opt == 'run':
+        main(args.bind, args.port, test=bool(args.test), cachemb=args.cache_mb,
+             workers=args.workers, diskmb=args.disk_mb, tilemp=args.tile_mp,
+             cores=args.cores)
         if RESTART:
             print("File changed. Triggering restart.")
             os.execv(cmd, sys.argv)
         else:
             sys.exit(0)
-    else:
-        print("Invalid command")